@@ -0,0 +1,90 @@
+import argparse
+import random
+import time
+from chunking import *
+
+# Chunker as it was before offset slicing, kept as the benchmark baseline.
+# It decodes every window again; its overlap condition always held, so it
+# effectively produced chunks without overlap.
+def legacy_chunk_text_by_tokens(text, chunk_size=CHUNK_SIZE_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS):
+    tokens = get_tokenizer().encode(text)
+    chunks = []
+    start = 0
+    while start < len(tokens):
+        end = min(start + chunk_size, len(tokens))
+        chunk_tokens = tokens[start:end]
+        chunk_text = get_tokenizer().decode(chunk_tokens)
+        chunks.append(chunk_text)
+        start = end - chunk_overlap
+        if start < 0 or start + chunk_overlap == end:
+            start = end  # Avoid negative start
+    return chunks
+
+# Same windows as chunk_text_by_tokens, but decoding each window: the baseline with working overlap
+def decoding_chunk_text_by_tokens(text, chunk_size=CHUNK_SIZE_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS):
+    tokens = get_tokenizer().encode(text)
+    return [get_tokenizer().decode(tokens[start:end]) for start, end in get_token_windows(len(tokens), chunk_size, chunk_overlap)]
+
+WORDS = ["播客", "节目", "嘉宾", "我们", "今天", "聊一聊", "人工智能", "投资", "创业", "其实", "就是", "然后",
+         "podcast", "startup", "model", "market", "the", "and", "really", "think", "GPT", "2025"]
+
+def generate_transcript(chars, seed=0):
+    """Generates a synthetic transcript of about `chars` characters with speaker and timestamp lines."""
+    rng = random.Random(seed)
+    lines = []
+    length = 0
+    seconds = 0
+    while length < chars:
+        seconds += rng.randint(3, 40)
+        words = " ".join(rng.choice(WORDS) for _ in range(rng.randint(5, 60)))
+        line = f"[{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}] 说话人{rng.randint(1, 3)}: {words}"
+        lines.append(line)
+        length += len(line) + 1
+    return "\n".join(lines)
+
+def timeit(function, repeat):
+    best = float("inf")
+    for _ in range(repeat):
+        start = time.perf_counter()
+        result = function()
+        best = min(best, time.perf_counter() - start)
+    return best, result
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the token chunker")
+    parser.add_argument('--chars', type=int, default=200000, help='Characters per synthetic transcript')
+    parser.add_argument('--transcripts', type=int, default=20, help='Number of synthetic transcripts')
+    parser.add_argument('--repeat', type=int, default=3, help='Runs per implementation, the best is reported')
+    parser.add_argument('--threads', type=int, default=8, help='Threads for the batch chunker')
+    args = parser.parse_args()
+
+    texts = [generate_transcript(args.chars, seed) for seed in range(args.transcripts)]
+    total_chars = sum(len(text) for text in texts)
+    print(f"{args.transcripts} transcripts, {total_chars} characters")
+
+    # Warm up the token byte length table so it is not part of the timings
+    chunk_text_by_tokens(texts[0][:1000])
+
+    implementations = [
+        ("legacy (decode per window, no overlap)", lambda: [legacy_chunk_text_by_tokens(text) for text in texts]),
+        ("decode per window, with overlap", lambda: [decoding_chunk_text_by_tokens(text) for text in texts]),
+        ("offset slicing", lambda: [chunk_text_by_tokens(text) for text in texts]),
+        (f"offset slicing, encode_batch x{args.threads}", lambda: chunk_texts_by_tokens(texts, num_threads=args.threads)),
+    ]
+    results = {}
+    baseline = None
+    for name, function in implementations:
+        seconds, chunks = timeit(function, args.repeat)
+        results[name] = chunks
+        baseline = baseline or seconds
+        print(f"{name:45s} {seconds * 1000:9.1f} ms  {total_chars / seconds / 1e6:7.2f} Mchar/s  {sum(map(len, chunks)):6d} chunks  x{baseline / seconds:.2f}")
+
+    # Offset slicing returns the same chunks as decoding the same windows, except
+    # where a window boundary splits a character: decode() yields U+FFFD there
+    decoded = [chunk for chunks in results["decode per window, with overlap"] for chunk in chunks]
+    sliced = [chunk for chunks in results["offset slicing"] for chunk in chunks]
+    mismatches = sum(1 for a, b in zip(decoded, sliced) if a != b and "\ufffd" not in a)
+    print(f"Chunks differing from per-window decoding (excluding split characters): {mismatches}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,116 @@
+import os
+import sys
+import time
+import shutil
+import argparse
+import tempfile
+import statistics
+import subprocess
+
+MODULES = ["util", "chunking", "context_assembler", "keyword_index", "embedding_cache", "vector_store",
+           "download", "transcribe", "summarize", "index", "query"]
+
+# Discard port on localhost, requests to it fail at once
+UNREACHABLE_URL = "http://127.0.0.1:9"
+
+def get_import_env():
+    """Returns the environment of the timed imports.
+
+    Before the __main__ guards, importing a script ran it. The API keys are
+    dummies and every HTTP request goes to an unreachable proxy, so such an
+    import can't call Gemini, OpenAI or a podcast feed.
+    """
+    env = dict(os.environ, GEMINI_API_KEY="bench-import", OPENAI_API_KEY="bench-import",
+               OPENAI_BASE_URL=UNREACHABLE_URL + "/v1", HTTP_PROXY=UNREACHABLE_URL, HTTPS_PROXY=UNREACHABLE_URL,
+               http_proxy=UNREACHABLE_URL, https_proxy=UNREACHABLE_URL, PODCAST_RAG_NO_LLM_CACHE="1")
+    env.pop("NO_PROXY", None)
+    env.pop("no_proxy", None)
+    return env
+
+def time_import(module, cwd, repeat, timeout):
+    """Returns the median wall time in seconds of importing module in a fresh interpreter, or an error string."""
+    times = []
+    for _ in range(repeat):
+        start = time.perf_counter()
+        try:
+            result = subprocess.run([sys.executable, "-c", f"import {module}"], cwd=cwd, capture_output=True, text=True, timeout=timeout,
+                                    env=get_import_env())
+        except subprocess.TimeoutExpired:
+            # Before the __main__ guards, importing a script could start it
+            return "timeout"
+        if result.returncode != 0:
+            error = result.stderr.strip().splitlines()
+            return f"failed: {error[-1] if error else result.returncode}"
+        times.append(time.perf_counter() - start)
+    return statistics.median(times)
+
+def slowest_imports(module, cwd, count):
+    """Returns the (cumulative microseconds, package) of the slowest imports of module, from python -X importtime."""
+    result = subprocess.run([sys.executable, "-X", "importtime", "-c", f"import {module}"], cwd=cwd, capture_output=True, text=True,
+                            env=get_import_env())
+    imports = []
+    for line in result.stderr.splitlines():
+        parts = line.split("|")
+        if len(parts) == 3 and parts[1].strip().isdigit():
+            name = parts[2].strip()
+            # Top-level packages only, nested entries are counted in their parent
+            if "." not in name:
+                imports.append((int(parts[1]), name))
+    return sorted(imports, reverse=True)[:count]
+
+def export_tree(ref):
+    """Exports the files of a git ref into a temporary directory with an empty data directory.
+
+    Relative data paths of CONFIG resolve against the exported tree, so scripts of
+    the ref that run on import find an empty podcast list and stores, and never
+    touch the real data.
+    """
+    directory = tempfile.mkdtemp(prefix="bench_import_")
+    archive = subprocess.run(["git", "archive", "--format=tar", ref], capture_output=True, check=True)
+    subprocess.run(["tar", "-x", "-C", directory], input=archive.stdout, check=True)
+    os.makedirs(os.path.join(directory, "data"), exist_ok=True)
+    with open(os.path.join(directory, "data", "podcasts.csv"), "w", encoding="utf-8") as outfile:
+        outfile.write("podcast_name,language,rss_url\n")
+    # The prompts are only read, a copy keeps the working tree out of reach
+    if os.path.exists("podcast_prompts.tsv") and not os.path.exists(os.path.join(directory, "podcast_prompts.tsv")):
+        shutil.copy("podcast_prompts.tsv", directory)
+    return directory
+
+def format_time(value):
+    return f"{value * 1000:9.0f} ms" if isinstance(value, float) else value
+
+def main():
+    parser = argparse.ArgumentParser(description="Measure the import time of each module in fresh interpreters")
+    parser.add_argument('--modules', nargs='+', default=MODULES, help='Modules to import')
+    parser.add_argument('--repeat', type=int, default=5, help='Imports per module, the median is reported')
+    parser.add_argument('--ref', help='Git ref to compare against, e.g. HEAD~1')
+    parser.add_argument('--timeout', type=float, default=60, help='Seconds before an import is reported as blocked')
+    parser.add_argument('--slowest', type=int, default=0, help='Also list the slowest imported packages of each module')
+    args = parser.parse_args()
+
+    base = time_import("os", ".", args.repeat, args.timeout)
+    print(f"Interpreter startup: {format_time(base).strip()}, included in the times below")
+    ref_directory = export_tree(args.ref) if args.ref else None
+    try:
+        header = f"{'module':20s} {'import':>12s}"
+        if ref_directory:
+            header += f" {args.ref:>12s}"
+        print(header)
+        for module in args.modules:
+            current = time_import(module, ".", args.repeat, args.timeout)
+            line = f"{module:20s} {format_time(current):>12s}"
+            if ref_directory:
+                previous = time_import(module, ref_directory, 1 if not isinstance(current, float) else args.repeat, args.timeout)
+                line += f" {format_time(previous):>12s}"
+                if isinstance(current, float) and isinstance(previous, float):
+                    line += f"  {previous / current:5.1f}x"
+            print(line)
+            if args.slowest and isinstance(current, float):
+                for microseconds, name in slowest_imports(module, ".", args.slowest):
+                    print(f"    {name:24s} {microseconds / 1000:9.0f} ms")
+    finally:
+        if ref_directory:
+            shutil.rmtree(ref_directory, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
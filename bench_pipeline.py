@@ -0,0 +1,522 @@
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import random
+import shutil
+import base64
+import asyncio
+import argparse
+import tempfile
+import threading
+import subprocess
+from collections import deque
+from email.utils import format_datetime
+from datetime import datetime, timedelta, timezone
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+import numpy as np
+
+STAGES = ("download", "transcribe", "summarize", "index", "query", "pipeline")
+SYLLABLES = ["ka", "lo", "mi", "ne", "su", "ta", "ri", "po", "de", "va", "gu", "shi", "ron", "bel", "tor", "zan"]
+WORD_RE = re.compile(r"\w+")
+
+def make_vocabulary(size, seed=0):
+    """Returns size distinct pseudo-words, the vocabulary of the synthetic transcripts and queries."""
+    rng = random.Random(seed)
+    words = set()
+    while len(words) < size:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(2, 4))))
+    return sorted(words)
+
+def make_transcript(seed, chars, vocabulary):
+    """Returns a transcript of about chars characters with speaker labels and timestamps, like Gemini's."""
+    rng = random.Random(seed)
+    # Each episode talks about a few topics, so retrieval has something to find
+    topics = rng.sample(vocabulary, 20)
+    lines = []
+    length = 0
+    seconds = 0
+    while length < chars:
+        words = [rng.choice(topics) if rng.random() < 0.3 else rng.choice(vocabulary) for _ in range(rng.randint(10, 40))]
+        line = f"[{seconds // 3600:02d}:{seconds // 60 % 60:02d}:{seconds % 60:02d}] Speaker {rng.randint(1, 3)}: {' '.join(words)}."
+        lines.append(line)
+        length += len(line) + 1
+        seconds += rng.randint(5, 30)
+    return "\n".join(lines)
+
+def hash_embedding(text, dim):
+    """Embeds text as signed hashed word counts, so texts sharing words get similar vectors."""
+    vector = np.zeros(dim, dtype=np.float32)
+    for word in WORD_RE.findall(text.lower()):
+        digest = zlib.crc32(word.encode("utf-8"))
+        vector[digest % dim] += 1.0 if digest & 0x80000000 else -1.0
+    norm = np.linalg.norm(vector)
+    return vector / norm if norm else vector
+
+class RequestLimiter:
+    """Sliding one minute window of requests, for the rate limits of the fake APIs."""
+    def __init__(self, rpm):
+        self.rpm = rpm
+        self.times = deque()
+        self.lock = threading.Lock()
+
+    def allow(self):
+        if not self.rpm:
+            return True
+        with self.lock:
+            now = time.monotonic()
+            while self.times and self.times[0] < now - 60:
+                self.times.popleft()
+            if len(self.times) >= self.rpm:
+                return False
+            self.times.append(now)
+            return True
+
+class FakeServer:
+    """Local HTTP server with synthetic RSS feeds and audio, and an OpenAI compatible embeddings endpoint.
+
+    /feeds/<podcast>.xml   RSS feed of a podcast, newest episode first
+    /audio/<podcast>/<episode>.mp3   audio bytes, with HEAD and Range support
+    /v1/embeddings   hashed word count embeddings, with configurable latency,
+                     rate limit (429) and failure rate (500)
+    """
+    def __init__(self, episodes, audio_bytes, dim, latency=0.0, rpm=0, failure_rate=0.0):
+        self.episodes = episodes
+        self.audio_bytes = audio_bytes
+        self.dim = dim
+        self.latency = latency
+        self.limiter = RequestLimiter(rpm)
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.counters = {"embedding_requests": 0, "embeddings": 0, "rate_limited": 0, "failures": 0, "audio_bytes": 0}
+        server = self
+
+        class Handler(BaseHTTPRequestHandler):
+            protocol_version = "HTTP/1.1"
+
+            def log_message(self, format, *args):
+                pass
+
+            def do_HEAD(self):
+                server.handle_get(self, head=True)
+
+            def do_GET(self):
+                server.handle_get(self)
+
+            def do_POST(self):
+                server.handle_post(self)
+
+        self.httpd = ThreadingHTTPServer(("127.0.0.1", 0), Handler)
+        self.httpd.daemon_threads = True
+        self.url = f"http://127.0.0.1:{self.httpd.server_address[1]}"
+        self.thread = threading.Thread(target=self.httpd.serve_forever, daemon=True)
+
+    def start(self):
+        self.thread.start()
+        return self
+
+    def close(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
+
+    def count(self, name, value=1):
+        with self.lock:
+            self.counters[name] += value
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.counters)
+
+    def feed(self, podcast):
+        now = datetime(2025, 1, 1, tzinfo=timezone.utc)
+        items = []
+        for episode in reversed(range(self.episodes)):
+            pub_date = format_datetime(now - timedelta(days=self.episodes - episode))
+            items.append(f"""<item><title>Episode {episode}</title><link>{self.url}/episodes/{podcast}/{episode}</link>
+<description>&lt;p&gt;Show notes of episode {episode}&lt;/p&gt;</description><pubDate>{pub_date}</pubDate><guid>{podcast}-{episode}</guid>
+<enclosure url="{self.url}/audio/{podcast}/{episode}.mp3" length="{self.audio_bytes}" type="audio/mpeg"/></item>""")
+        return f"""<?xml version="1.0" encoding="UTF-8"?><rss version="2.0"><channel><title>Podcast {podcast}</title>
+<link>{self.url}</link><description>Synthetic podcast {podcast}</description>{''.join(items)}</channel></rss>""".encode("utf-8")
+
+    def audio(self, name):
+        # Deterministic per episode, so the upload registry and caches see distinct files
+        pattern = (name.encode("utf-8") + b"\0") * 64
+        return (pattern * (self.audio_bytes // len(pattern) + 1))[:self.audio_bytes]
+
+    def send(self, handler, status, body, content_type, extra_headers=None, head=False):
+        handler.send_response(status)
+        handler.send_header("Content-Type", content_type)
+        handler.send_header("Content-Length", str(len(body)))
+        for name, value in (extra_headers or {}).items():
+            handler.send_header(name, value)
+        handler.end_headers()
+        if not head:
+            handler.wfile.write(body)
+
+    def handle_get(self, handler, head=False):
+        match = re.fullmatch(r"/feeds/([\w-]+)\.xml", handler.path)
+        if match:
+            return self.send(handler, 200, self.feed(match.group(1)), "application/rss+xml", head=head)
+        match = re.fullmatch(r"/audio/([\w-]+)/(\d+)\.mp3", handler.path)
+        if not match:
+            return self.send(handler, 404, b"not found", "text/plain", head=head)
+        body = self.audio(f"{match.group(1)}-{match.group(2)}")
+        headers = {"ETag": f'"{zlib.crc32(body):08x}"', "Accept-Ranges": "bytes"}
+        range_match = re.fullmatch(r"bytes=(\d+)-", handler.headers.get("Range", ""))
+        if range_match and handler.headers.get("If-Range") in (None, headers["ETag"]):
+            start = int(range_match.group(1))
+            if start >= len(body):
+                return self.send(handler, 416, b"", "audio/mpeg", head=head)
+            headers["Content-Range"] = f"bytes {start}-{len(body) - 1}/{len(body)}"
+            body = body[start:]
+            status = 206
+        else:
+            status = 200
+        if not head:
+            self.count("audio_bytes", len(body))
+        self.send(handler, status, body, "audio/mpeg", headers, head=head)
+
+    def handle_post(self, handler):
+        request = json.loads(handler.rfile.read(int(handler.headers.get("Content-Length", 0))) or b"{}")
+        if not handler.path.endswith("/embeddings"):
+            return self.send(handler, 404, b"not found", "text/plain")
+        self.count("embedding_requests")
+        if self.latency:
+            time.sleep(self.latency)
+        if not self.limiter.allow():
+            self.count("rate_limited")
+            error = {"error": {"message": "Rate limit reached", "type": "requests", "code": "rate_limit_exceeded"}}
+            return self.send(handler, 429, json.dumps(error).encode("utf-8"), "application/json", {"Retry-After": "1"})
+        if random.random() < self.failure_rate:
+            self.count("failures")
+            error = {"error": {"message": "Injected failure", "type": "server_error"}}
+            return self.send(handler, 500, json.dumps(error).encode("utf-8"), "application/json")
+        inputs = request.get("input", [])
+        inputs = [inputs] if isinstance(inputs, str) else inputs
+        data = []
+        for i, text in enumerate(inputs):
+            vector = hash_embedding(text, self.dim)
+            if request.get("encoding_format") == "base64":
+                embedding = base64.b64encode(vector.astype("<f4").tobytes()).decode("ascii")
+            else:
+                embedding = vector.tolist()
+            data.append({"object": "embedding", "index": i, "embedding": embedding})
+        self.count("embeddings", len(inputs))
+        tokens = sum(len(text) // 4 for text in inputs)
+        response = {"object": "list", "data": data, "model": request.get("model"), "usage": {"prompt_tokens": tokens, "total_tokens": tokens}}
+        self.send(handler, 200, json.dumps(response).encode("utf-8"), "application/json")
+
+# --- In-process stand-in for Gemini, used by the stage processes ---
+
+class FinishReason:
+    def __init__(self, name):
+        self.name = name
+
+    def __str__(self):
+        return f"FinishReason.{self.name}"
+
+class FakeResponse:
+    def __init__(self, text, finish_reason="STOP"):
+        self.text = text
+        self.candidates = [type("Candidate", (), {"finish_reason": FinishReason(finish_reason)})()]
+
+class FakeFile:
+    def __init__(self, path):
+        self.name = f"files/{zlib.crc32(path.encode('utf-8')):08x}"
+        self.display_name = os.path.basename(path)
+        self.uri = f"fake://{self.name}"
+
+class FakeStream:
+    def __init__(self, text, pieces, delay):
+        self.text = text
+        self.pieces = pieces
+        self.delay = delay
+
+    async def __aiter__(self):
+        step = max(1, len(self.text) // self.pieces)
+        for start in range(0, len(self.text), step):
+            await asyncio.sleep(self.delay)
+            yield FakeResponse(self.text[start : start + step])
+
+class FakeChat:
+    def __init__(self, model, audio_file):
+        self.model = model
+        self.audio_file = audio_file
+        self.turn = 0
+
+    def send_message(self, prompt, request_options=None):
+        self.model.call()
+        # The transcript is returned over several turns to exercise the continuation loop
+        transcript = make_transcript(self.audio_file.display_name, self.model.transcript_chars, self.model.vocabulary)
+        step = len(transcript) // self.model.turns + 1
+        text = transcript[self.turn * step : (self.turn + 1) * step]
+        self.turn += 1
+        return FakeResponse(text, "STOP" if self.turn >= self.model.turns else "MAX_TOKENS")
+
+class FakeGemini:
+    """Stand-in for the Gemini model and file API with configurable latency, rate limit and failures.
+
+    Rate limited calls raise ResourceExhausted and failed calls ServiceUnavailable,
+    like the SDK does, so the callers' retry and backoff paths run as well.
+    """
+    def __init__(self, vocabulary, transcript_chars, turns=2, latency=0.0, rpm=0, failure_rate=0.0):
+        self.vocabulary = vocabulary
+        self.transcript_chars = transcript_chars
+        self.turns = turns
+        self.latency = latency
+        self.limiter = RequestLimiter(rpm)
+        self.failure_rate = failure_rate
+        self.lock = threading.Lock()
+        self.counters = {"gemini_calls": 0, "gemini_rate_limited": 0, "gemini_failures": 0}
+
+    def count(self, name):
+        with self.lock:
+            self.counters[name] += 1
+
+    def check(self, limited=True):
+        from google.api_core.exceptions import ResourceExhausted, ServiceUnavailable
+        self.count("gemini_calls")
+        if limited and not self.limiter.allow():
+            self.count("gemini_rate_limited")
+            raise ResourceExhausted("Fake Gemini quota exceeded")
+        if random.random() < self.failure_rate:
+            self.count("gemini_failures")
+            raise ServiceUnavailable("Injected Gemini failure")
+
+    def call(self, limited=True):
+        time.sleep(self.latency)
+        self.check(limited)
+
+    def upload_file(self, path, mime_type=None, registry=None):
+        # The file API has its own quota, only generation requests count against the rate limit
+        self.call(limited=False)
+        file = FakeFile(path)
+        if registry is not None:
+            registry.add(registry.content_hash(path), file)
+        return file
+
+    def start_chat(self, history=None):
+        return FakeChat(self, history[0]["parts"][0])
+
+    def answer(self, prompt):
+        rng = random.Random(zlib.crc32(str(prompt).encode("utf-8")))
+        return " ".join(rng.choice(self.vocabulary) for _ in range(200))
+
+    def generate_content(self, prompt):
+        self.call()
+        return FakeResponse(self.answer(prompt))
+
+    async def generate_content_async(self, prompt, stream=False):
+        await asyncio.sleep(self.latency)
+        self.check()
+        text = self.answer(prompt)
+        return FakeStream(text, 10, self.latency / 10) if stream else FakeResponse(text)
+
+# --- Stage processes ---
+
+def configure(settings, root):
+    """Points the CONFIG paths of the stage process at root and installs the fake Gemini model."""
+    import util
+    for key, value in util.CONFIG.items():
+        if isinstance(value, str) and value.startswith(util.data_dir + "/"):
+            util.CONFIG[key] = os.path.join(root, value[len(util.data_dir) + 1:])
+    util.CONFIG["prompts_file"] = os.path.join(settings["workdir"], "prompts.tsv")
+    if settings["vector_backend"]:
+        util.CONFIG["vector_backend"] = settings["vector_backend"]
+    model = FakeGemini(make_vocabulary(settings["vocabulary"]), settings["transcript_chars"], settings["transcript_turns"],
+                       settings["gemini_latency"], settings["gemini_rpm_limit"], settings["gemini_failure_rate"])
+    util.set_model(model)
+    return model
+
+def count_episodes(stage):
+    """Returns the number of episodes that completed a stage."""
+    from util import read_podcast_list, CONFIG
+    from manifest import EpisodeManifest
+    manifest = EpisodeManifest()
+    return sum(1 for podcast in read_podcast_list(CONFIG["podcast_list_file"])
+               for episode in manifest.episodes(podcast["podcast_name"]) if episode[f"{stage}_at"])
+
+async def run_queries(queries, concurrency):
+    import query
+    semaphore = asyncio.Semaphore(concurrency)
+    first_latencies = []
+    latencies = []
+
+    async def ask(question):
+        async with semaphore:
+            start = time.perf_counter()
+            first = None
+            async for _ in query.chatbot(question):
+                if first is None:
+                    first = time.perf_counter() - start
+            latencies.append(time.perf_counter() - start)
+            first_latencies.append(first)
+
+    await asyncio.gather(*(ask(question) for question in queries))
+    return first_latencies, latencies
+
+def run_stage(stage, settings):
+    """Runs one stage against the fake services and returns its measurements."""
+    root = os.path.join(settings["workdir"], "pipeline" if stage == "pipeline" else "staged")
+    model = configure(settings, root)
+    workers = settings["workers"]
+    gemini = {"rpm": settings["rpm"], "tpm": settings["tpm"]}
+    start = time.perf_counter()
+    result = {}
+    if stage == "download":
+        import download
+        sys.argv = ["download.py", "--workers", str(workers), "--per-host", str(workers), "--host-delay", "0"]
+        download.download_podcast()
+        result["episodes"] = count_episodes("downloaded")
+    elif stage == "transcribe":
+        import transcribe
+        transcribe.upload_to_gemini = model.upload_file
+        transcribe.process_podcast_data(workers=workers, **gemini)
+        result["episodes"] = count_episodes("transcribed")
+    elif stage == "summarize":
+        import summarize
+        summarize.process_podcast_data(workers=workers, **gemini)
+        result["episodes"] = count_episodes("summarized")
+    elif stage == "index":
+        import index
+        index.index_transcript(embed_workers=workers)
+        result["episodes"] = count_episodes("indexed")
+    elif stage == "query":
+        rng = random.Random(1)
+        vocabulary = make_vocabulary(settings["vocabulary"])
+        queries = [f"What did they say about {' '.join(rng.sample(vocabulary, 3))}?" for _ in range(settings["queries"])]
+        first_latencies, latencies = asyncio.run(run_queries(queries, settings["query_concurrency"]))
+        result["queries"] = len(latencies)
+        for name, values in (("first", first_latencies), ("total", latencies)):
+            values = np.array([value for value in values if value is not None]) * 1000
+            if len(values):
+                result[f"{name}_p50_ms"] = float(np.percentile(values, 50))
+                result[f"{name}_p99_ms"] = float(np.percentile(values, 99))
+    elif stage == "pipeline":
+        import pipeline, transcribe
+        transcribe.upload_to_gemini = model.upload_file
+        pipeline.run_pipeline(download_workers=workers, per_host=workers, host_delay=0, transcribe_workers=workers,
+                              summarize_workers=workers, embed_workers=workers, **gemini)
+        result["episodes"] = count_episodes("indexed")
+    result["seconds"] = time.perf_counter() - start
+    result.update(model.counters)
+    return result
+
+# --- Driver ---
+
+def write_inputs(settings, server):
+    """Writes the podcast list and the prompts of both data roots."""
+    with open(os.path.join(settings["workdir"], "prompts.tsv"), "w", encoding="utf-8") as outfile:
+        outfile.write("language\tinitial_prompt\tcontinuous_prompt\n")
+        outfile.write("en\tTranscribe episode {podcast_title} of {podcast_name}. Show notes: {podcast_shownotes}\tContinue the transcript\n")
+    for root in ("staged", "pipeline"):
+        os.makedirs(os.path.join(settings["workdir"], root), exist_ok=True)
+        with open(os.path.join(settings["workdir"], root, "podcasts.csv"), "w", encoding="utf-8") as outfile:
+            outfile.write("podcast_name,rss_url,language\n")
+            for podcast in range(settings["podcasts"]):
+                outfile.write(f"Podcast {podcast},{server.url}/feeds/podcast{podcast}.xml,en\n")
+
+def spawn_stage(stage, settings, server):
+    """Runs a stage in a child process. Returns its measurements, with its peak RSS and the fake server counters."""
+    before = server.snapshot()
+    env = dict(os.environ, OPENAI_API_KEY="bench", OPENAI_BASE_URL=server.url + "/v1", GEMINI_API_KEY="bench",
+               NO_PROXY="127.0.0.1,localhost", no_proxy="127.0.0.1,localhost")
+    result_file = os.path.join(settings["workdir"], f"{stage}.json")
+    log_file = os.path.join(settings["workdir"], f"{stage}.log")
+    with open(log_file, "w") as log:
+        process = subprocess.Popen([sys.executable, os.path.abspath(__file__), "--run-stage", stage, "--workdir", settings["workdir"]],
+                                   stdout=log, stderr=subprocess.STDOUT, env=env)
+        # wait4 returns the resource usage of this child alone
+        _, status, usage = os.wait4(process.pid, 0)
+        process.returncode = os.waitstatus_to_exitcode(status)
+    if process.returncode != 0 or not os.path.exists(result_file):
+        print(f"{stage} failed with exit code {process.returncode}, see {log_file}")
+        return None
+    with open(result_file, encoding="utf-8") as infile:
+        result = json.load(infile)
+    after = server.snapshot()
+    result.update({name: after[name] - before[name] for name in after})
+    result["peak_rss_mb"] = usage.ru_maxrss / 1024
+    return result
+
+def report(stage, result):
+    line = f"{stage:10s} {result['seconds']:8.1f}s  peak RSS {result['peak_rss_mb']:6.0f} MB"
+    seconds = max(result["seconds"], 1e-9)
+    if "episodes" in result:
+        line += f"  {result['episodes']:5d} episodes  {result['episodes'] / seconds:7.2f} episodes/s"
+    if result.get("audio_bytes"):
+        line += f"  {result['audio_bytes'] / seconds / 1e6:7.1f} MB/s"
+    if result.get("embeddings"):
+        line += f"  {result['embeddings'] / seconds:8.0f} embeddings/s"
+    if "queries" in result:
+        line += f"  {result['queries']} queries  first chunk p50 {result.get('first_p50_ms', 0):.0f} ms p99 {result.get('first_p99_ms', 0):.0f} ms"
+        line += f"  answer p50 {result.get('total_p50_ms', 0):.0f} ms p99 {result.get('total_p99_ms', 0):.0f} ms"
+    if result.get("rate_limited") or result.get("failures"):
+        line += f"  ({result['rate_limited']} rate limited, {result['failures']} failed embedding requests)"
+    if result.get("gemini_calls"):
+        line += f"  {result['gemini_calls']} Gemini calls ({result['gemini_rate_limited']} rate limited, {result['gemini_failures']} failed)"
+    print(line)
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the scripts offline against a local feed server and fake Gemini and OpenAI APIs")
+    parser.add_argument('--stages', nargs='+', choices=STAGES, default=list(STAGES), help='Stages to run, in order')
+    parser.add_argument('--podcasts', type=int, default=4, help='Number of synthetic podcasts')
+    parser.add_argument('--episodes', type=int, default=10, help='Episodes per podcast')
+    parser.add_argument('--audio-kb', type=int, default=1024, help='Size of each audio file in KB')
+    parser.add_argument('--transcript-chars', type=int, default=30000, help='Length of each transcript in characters')
+    parser.add_argument('--transcript-turns', type=int, default=2, help='Responses each transcript is returned in')
+    parser.add_argument('--vocabulary', type=int, default=5000, help='Distinct words of the synthetic transcripts')
+    parser.add_argument('--workers', type=int, default=4, help='Workers of every stage')
+    parser.add_argument('--rpm', type=int, default=0, help='Gemini requests per minute allowed by the scripts, 0 for no limit')
+    parser.add_argument('--tpm', type=int, default=0, help='Gemini tokens per minute allowed by the scripts, 0 for no limit')
+    parser.add_argument('--gemini-latency', type=float, default=0.2, help='Seconds each fake Gemini call takes')
+    parser.add_argument('--gemini-rpm-limit', type=int, default=0, help='Requests per minute before fake Gemini raises ResourceExhausted')
+    parser.add_argument('--gemini-failure-rate', type=float, default=0.0, help='Fraction of fake Gemini calls that fail')
+    parser.add_argument('--embedding-latency', type=float, default=0.05, help='Seconds each fake embedding request takes')
+    parser.add_argument('--embedding-rpm-limit', type=int, default=0, help='Embedding requests per minute before the fake API returns 429')
+    parser.add_argument('--embedding-failure-rate', type=float, default=0.0, help='Fraction of embedding requests that return 500')
+    parser.add_argument('--dim', type=int, default=1536, help='Dimension of the fake embeddings')
+    parser.add_argument('--queries', type=int, default=50, help='Chatbot questions asked in the query stage')
+    parser.add_argument('--query-concurrency', type=int, default=4, help='Chatbot questions asked at once')
+    parser.add_argument('--vector-backend', choices=["chroma", "local"], help='Vector store, CONFIG["vector_backend"] by default')
+    parser.add_argument('--output', help='Also write the measurements to this JSON file')
+    parser.add_argument('--keep', action='store_true', help='Keep the work directory with the generated data and stage logs')
+    parser.add_argument('--run-stage', choices=STAGES, help=argparse.SUPPRESS)
+    parser.add_argument('--workdir', help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run_stage:
+        with open(os.path.join(args.workdir, "settings.json"), encoding="utf-8") as infile:
+            settings = json.load(infile)
+        result = run_stage(args.run_stage, settings)
+        with open(os.path.join(args.workdir, f"{args.run_stage}.json"), "w", encoding="utf-8") as outfile:
+            json.dump(result, outfile)
+        return
+
+    settings = {name: value for name, value in vars(args).items() if name not in ("run_stage", "workdir", "output", "keep", "stages")}
+    settings["workdir"] = tempfile.mkdtemp(prefix="bench_pipeline_")
+    server = FakeServer(args.episodes, args.audio_kb * 1024, args.dim, args.embedding_latency,
+                        args.embedding_rpm_limit, args.embedding_failure_rate).start()
+    results = {}
+    try:
+        write_inputs(settings, server)
+        with open(os.path.join(settings["workdir"], "settings.json"), "w", encoding="utf-8") as outfile:
+            json.dump(settings, outfile)
+        print(f"{args.podcasts} podcasts x {args.episodes} episodes, data in {settings['workdir']}")
+        for stage in args.stages:
+            result = spawn_stage(stage, settings, server)
+            if result:
+                results[stage] = result
+                report(stage, result)
+        if args.output:
+            with open(args.output, "w", encoding="utf-8") as outfile:
+                json.dump({"settings": settings, "results": results}, outfile, indent=2)
+    finally:
+        server.close()
+        if not args.keep:
+            shutil.rmtree(settings["workdir"], ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,106 @@
+import os
+import time
+import shutil
+import argparse
+import resource
+import tempfile
+import numpy as np
+from vector_store import ChromaStore, LocalVectorStore, LOCAL_DTYPES
+
+def generate_vectors(count, dim, seed=0, clusters=256):
+    """Generates normalized vectors around random centers, closer to real embeddings than uniform noise."""
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(clusters, dim)).astype(np.float32)
+    vectors = centers[rng.integers(0, clusters, count)] + 0.5 * rng.normal(size=(count, dim)).astype(np.float32)
+    return vectors / np.linalg.norm(vectors, axis=1, keepdims=True)
+
+def load_chroma_vectors(batch_size=1000):
+    """Returns the ids, vectors, documents and metadatas of the Chroma collection."""
+    from embedding_cache import get_cached_embedding_function
+    store = ChromaStore(get_cached_embedding_function())
+    ids, vectors, documents, metadatas = [], [], [], []
+    for results in store.scan(batch_size, include_embeddings=True):
+        ids.extend(results["ids"])
+        vectors.extend(results["embeddings"])
+        documents.extend(results["documents"])
+        metadatas.extend(results["metadatas"])
+    vectors = np.asarray(vectors, dtype=np.float32)
+    return store, ids, vectors / np.linalg.norm(vectors, axis=1, keepdims=True), documents, metadatas
+
+def fill(store, ids, vectors, documents, metadatas, batch_size=1000):
+    for i in range(0, len(ids), batch_size):
+        store.upsert(ids[i : i + batch_size], vectors[i : i + batch_size].tolist() if isinstance(store, ChromaStore) else vectors[i : i + batch_size],
+                     documents[i : i + batch_size], metadatas[i : i + batch_size])
+
+def directory_size(directory):
+    return sum(os.path.getsize(os.path.join(root, name)) for root, _, names in os.walk(directory) for name in names)
+
+def run(name, store, queries, truth, k, filters=None):
+    latencies = []
+    hits = 0
+    for query, expected in zip(queries, truth):
+        start = time.perf_counter()
+        results = store.query(query, k, filters)
+        latencies.append(time.perf_counter() - start)
+        hits += len(set(results["ids"]) & expected)
+    latencies = np.array(latencies) * 1000
+    print(f"{name:28s} p50 {np.percentile(latencies, 50):8.2f} ms  p99 {np.percentile(latencies, 99):8.2f} ms  recall@{k} {hits / (k * len(queries)):.3f}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the local vector store against Chroma")
+    parser.add_argument('--synthetic', type=int, default=100000, help='Number of synthetic vectors, 0 to use the Chroma collection')
+    parser.add_argument('--dim', type=int, default=1536, help='Dimension of synthetic vectors')
+    parser.add_argument('--queries', type=int, default=200, help='Number of queries')
+    parser.add_argument('--k', type=int, default=10, help='Results per query')
+    parser.add_argument('--podcasts', type=int, default=20, help='Number of synthetic podcasts, one is used as a filter')
+    args = parser.parse_args()
+
+    workdir = tempfile.mkdtemp(prefix="bench_vector_store_")
+    try:
+        if args.synthetic:
+            vectors = generate_vectors(args.synthetic, args.dim)
+            ids = [f"chunk_{i}" for i in range(len(vectors))]
+            documents = [""] * len(vectors)
+            metadatas = [{"podcast": f"podcast_{i % args.podcasts}"} for i in range(len(vectors))]
+            chroma = ChromaStore(None, "bench", os.path.join(workdir, "chroma"))
+            start = time.perf_counter()
+            fill(chroma, ids, vectors, documents, metadatas)
+            print(f"Chroma filled with {len(ids)} vectors in {time.perf_counter() - start:.1f} s, {directory_size(os.path.join(workdir, 'chroma')) / 1e6:.0f} MB")
+        else:
+            chroma, ids, vectors, documents, metadatas = load_chroma_vectors()
+            print(f"Loaded {len(ids)} vectors from the Chroma collection")
+        if not ids:
+            print("No vectors to benchmark")
+            return
+
+        rng = np.random.default_rng(1)
+        query_rows = rng.integers(0, len(vectors), args.queries)
+        queries = vectors[query_rows] + 0.05 * rng.normal(size=(args.queries, vectors.shape[1])).astype(np.float32)
+        # Exact float32 top k is the ground truth of the recall
+        scores = queries @ vectors.T
+        truth = [set(ids[i] for i in np.argsort(-row)[:args.k]) for row in scores]
+        podcast = metadatas[0].get("podcast")
+        podcast_rows = np.array([metadata.get("podcast") == podcast for metadata in metadatas])
+        filtered_scores = np.where(podcast_rows, scores, -np.inf)
+        filtered_truth = [set(ids[i] for i in np.argsort(-row)[:args.k]) for row in filtered_scores]
+        del scores, filtered_scores
+
+        stores = [("chroma", chroma)]
+        for dtype in LOCAL_DTYPES:
+            store = LocalVectorStore(os.path.join(workdir, dtype), dtype)
+            start = time.perf_counter()
+            fill(store, ids, vectors, documents, metadatas)
+            print(f"Local {dtype} filled in {time.perf_counter() - start:.1f} s, {directory_size(os.path.join(workdir, dtype)) / 1e6:.0f} MB")
+            stores.append((f"local {dtype}", store))
+
+        for name, store in stores:
+            # The first query loads indexes and memory maps
+            store.query(queries[0], args.k)
+            run(name, store, queries, truth, args.k)
+            run(f"{name} podcast filter", store, queries, filtered_truth, args.k, {"podcasts": [podcast]})
+        print(f"Peak RSS of the benchmark process: {resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024:.0f} MB")
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    main()
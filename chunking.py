@@ -0,0 +1,252 @@
+import re
+import threading
+from itertools import accumulate
+from util import *
+
+try:
+    import numpy as np
+except ImportError:  # Offsets are then accumulated over a Python list
+    np = None
+
+CHUNK_SIZE_TOKENS = 2000  # Chunk size in tokens
+CHUNK_OVERLAP_TOKENS = 200  # Overlap in tokens
+GPT4_ENCODING = "cl100k_base"
+
+_tokenizer = None
+_tokenizer_lock = threading.Lock()
+
+def get_tokenizer():
+    """Returns the tiktoken encoding, loaded on first use since loading its BPE ranks takes a while."""
+    global _tokenizer
+    with _tokenizer_lock:
+        if _tokenizer is None:
+            import tiktoken
+            _tokenizer = tiktoken.get_encoding(GPT4_ENCODING)
+        return _tokenizer
+
+def __getattr__(name):
+    # chunking.tokenizer used to be loaded at import time
+    if name == "tokenizer":
+        return get_tokenizer()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
+def count_tokens(text):
+    """Returns the number of tokens of text, an estimate of its Gemini tokens as well."""
+    return len(get_tokenizer().encode(text))
+
+def chunk_text(text, chunk_size=500, chunk_overlap=50):
+    """Splits text into smaller chunks with overlap."""
+    chunks = []
+    start = 0
+    while start < len(text):
+        end = min(start + chunk_size, len(text))
+        chunks.append(text[start:end])
+        start += chunk_size - chunk_overlap
+    return chunks
+
+def get_token_windows(token_count, chunk_size=CHUNK_SIZE_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS):
+    """Returns the (start, end) token ranges of the chunks, each overlapping the next by chunk_overlap tokens."""
+    if chunk_overlap >= chunk_size:
+        raise ValueError("chunk_overlap must be smaller than chunk_size")
+    windows = []
+    start = 0
+    while start < token_count:
+        end = min(start + chunk_size, token_count)
+        windows.append((start, end))
+        if end == token_count:
+            break
+        start = end - chunk_overlap
+    return windows
+
+token_byte_lengths = None
+
+def get_token_byte_lengths():
+    """Returns the UTF-8 byte length of every token of the tokenizer, computed once."""
+    global token_byte_lengths
+    if token_byte_lengths is None:
+        tokenizer = get_tokenizer()
+        lengths = []
+        for token in range(tokenizer.n_vocab):
+            try:
+                lengths.append(len(tokenizer.decode_single_token_bytes(token)))
+            except KeyError:
+                # Unused ids between the regular and the special tokens
+                lengths.append(0)
+        token_byte_lengths = np.array(lengths, dtype=np.int64) if np is not None else lengths
+    return token_byte_lengths
+
+def get_byte_offsets(tokens):
+    """Returns the byte offset at which every token starts, plus the total length, in the UTF-8 text."""
+    lengths = get_token_byte_lengths()
+    if np is not None:
+        offsets = np.zeros(len(tokens) + 1, dtype=np.int64)
+        np.cumsum(lengths[np.asarray(tokens, dtype=np.int64)], out=offsets[1:])
+        return offsets
+    return [0] + list(accumulate(lengths[token] for token in tokens))
+
+def slice_chunks(text_bytes, byte_offsets, windows):
+    """Cuts the UTF-8 text at the byte offsets of the token windows.
+
+    A token can end in the middle of a multi-byte character. Such a boundary is
+    moved back to the start of the character, so every chunk decodes cleanly.
+    """
+    def char_boundary(offset):
+        while 0 < offset < len(text_bytes) and (text_bytes[offset] & 0xC0) == 0x80:
+            offset -= 1
+        return offset
+    return [text_bytes[char_boundary(int(byte_offsets[start])):char_boundary(int(byte_offsets[end]))].decode("utf-8")
+            for start, end in windows]
+
+def chunk_tokens(text, tokens, chunk_size=CHUNK_SIZE_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS):
+    """Splits text into chunks given its tokens, without decoding any token."""
+    windows = get_token_windows(len(tokens), chunk_size, chunk_overlap)
+    if not windows:
+        return []
+    return slice_chunks(text.encode("utf-8"), get_byte_offsets(tokens), windows)
+
+def chunk_text_by_tokens(text, chunk_size=CHUNK_SIZE_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS):
+    """Splits text into smaller chunks based on token count using tiktoken with overlap.
+
+    The text is encoded once. Chunks are cut from the original text at the byte
+    offsets of their first and last token, so no token is decoded.
+    """
+    tokenizer = get_tokenizer()
+    if np is not None and hasattr(tokenizer, "encode_to_numpy"):
+        tokens = tokenizer.encode_to_numpy(text)
+    else:
+        tokens = tokenizer.encode(text)
+    return chunk_tokens(text, tokens, chunk_size, chunk_overlap)
+
+def chunk_texts_by_tokens(texts, chunk_size=CHUNK_SIZE_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS, num_threads=8):
+    """Batch version of chunk_text_by_tokens, encoding the texts on num_threads threads."""
+    token_lists = get_tokenizer().encode_batch(texts, num_threads=num_threads)
+    return [chunk_tokens(text, tokens, chunk_size, chunk_overlap) for text, tokens in zip(texts, token_lists)]
+
+# Turns are packed into chunks whole, so chunks only repeat the last turns of
+# the previous chunk, up to this many tokens, instead of a fixed token overlap
+TURN_OVERLAP_TOKENS = 100
+# Speaker labels at the start of a line are at most this long
+MAX_SPEAKER_LENGTH = 30
+# A line starts a turn when a timestamp appears within its first characters
+TURN_TIMESTAMP_MAX_OFFSET = 10
+# A speaker label looks like a name: a capitalized word or up to six CJK characters with an optional
+# letter or number ("主持人", "嘉宾B"), then up to two more such words or numbers ("Speaker 1", "Dr. Li"),
+# optionally followed by a parenthesized name ("主持人（张三）"), then a colon. A colon followed by a
+# digit belongs to a time and one followed by // to a URL.
+SPEAKER_NAME = r"(?:[A-Z][\w.'&-]*|[\u4e00-\u9fff]{1,6}[A-Za-z0-9]?)"
+SPEAKER_RE = re.compile(r"^(%s(?: (?:%s|\d+)){0,2}(?:\s*[(（][^()（）:：\n]{1,20}[)）])?)[*\]】)）]*\s*[:：](?!\d|//)" % (SPEAKER_NAME, SPEAKER_NAME))
+# Name-like words that introduce a sentence or a quote rather than a speaker's turn
+NOT_SPEAKERS = {"note", "notes", "ps", "p.s.", "tip", "update", "edit", "example", "warning", "summary", "source", "link",
+                "比如", "比如说", "例如", "就是说", "也就是说", "注意", "总结", "总之", "所以", "但是", "然后", "其实",
+                "我觉得", "我说", "他说", "她说", "问题是", "结果"}
+LABEL_STRIP_CHARS = " \t*#>-–—[]()（）【】|"
+
+def parse_turn_line(line):
+    """Returns (start seconds, speaker) of a line that starts a speaker turn, or None.
+
+    Lines like "[00:12:30] 主持人: ...", "**01:05** Speaker A：..." or "嘉宾：..."
+    start turns. A line starts a turn when it has a timestamp near its start or a
+    short speaker label followed by a colon.
+    """
+    start = None
+    rest = line
+    match = TIMESTAMP_RE.search(line, 0, TURN_TIMESTAMP_MAX_OFFSET + 8)
+    if match and match.start() <= TURN_TIMESTAMP_MAX_OFFSET and not line[:match.start()].strip(LABEL_STRIP_CHARS):
+        start = parse_timestamp(match)
+        rest = line[match.end():]
+    rest = rest.lstrip(LABEL_STRIP_CHARS)
+    speaker = None
+    match = SPEAKER_RE.match(rest)
+    if match and len(match.group(1)) <= MAX_SPEAKER_LENGTH and match.group(1).lower() not in NOT_SPEAKERS:
+        speaker = match.group(1).strip()
+    if start is None and speaker is None:
+        return None
+    return start, speaker
+
+def parse_turns(text):
+    """Splits a transcript into speaker turns.
+
+    Returns a list of dicts with the character range of the turn in the text
+    ("begin", "end"), its "start" time in seconds and its "speaker", either of
+    which can be None. Lines that don't start a turn belong to the turn above.
+    """
+    turns = []
+    offset = 0
+    for line in text.splitlines(keepends=True):
+        parsed = parse_turn_line(line.strip())
+        if parsed is not None or not turns:
+            start, speaker = parsed or (None, None)
+            if turns and speaker is None and start is not None:
+                # A timestamp without a label continues the speaker of the previous turn
+                speaker = turns[-1]["speaker"]
+            turns.append({"begin": offset, "end": offset + len(line), "start": start, "speaker": speaker})
+        else:
+            turns[-1]["end"] = offset + len(line)
+        offset += len(line)
+    return turns
+
+def get_turn_chunk(content, turns, end_time=None):
+    """Returns the chunk dict of the text of consecutive turns, end_time being the start of the turn after them."""
+    chunk = {"text": content.strip()}
+    times = [turn["start"] for turn in turns if turn["start"] is not None]
+    if times:
+        chunk["start"] = times[0]
+        chunk["end"] = max(end_time if end_time is not None else times[-1], times[-1])
+    speakers = list(dict.fromkeys(turn["speaker"] for turn in turns if turn["speaker"]))
+    if speakers:
+        chunk["speakers"] = ", ".join(speakers)
+    return chunk
+
+def chunk_transcript(text, chunk_size=CHUNK_SIZE_TOKENS, turn_overlap=TURN_OVERLAP_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS):
+    """Splits a transcript into chunks along speaker turn and timestamp boundaries.
+
+    Consecutive turns are packed into chunks of at most chunk_size tokens. Each
+    chunk starts with the trailing turns of the previous one that fit in
+    turn_overlap tokens. A turn longer than chunk_size is split by tokens with
+    chunk_overlap, as by chunk_text_by_tokens. Text without turns is chunked
+    like that as a whole.
+
+    Returns a list of dicts with the chunk "text" and, when the transcript has
+    them, its "start" and "end" time in seconds and its comma-separated "speakers".
+    """
+    turns = [turn for turn in parse_turns(text) if text[turn["begin"]:turn["end"]].strip()]
+    if not turns:
+        return []
+    token_counts = [len(tokens) for tokens in get_tokenizer().encode_batch([text[turn["begin"]:turn["end"]] for turn in turns])]
+    # A chunk ends when the next turn starts
+    next_starts = [None] * len(turns)
+    next_start = None
+    for i in range(len(turns) - 1, -1, -1):
+        next_starts[i] = next_start
+        if turns[i]["start"] is not None:
+            next_start = turns[i]["start"]
+
+    chunks = []
+    first = 0
+    while first < len(turns):
+        last = first
+        size = token_counts[first]
+        if size > chunk_size:
+            # The turn alone exceeds the budget, it is split by tokens
+            turn = turns[first]
+            turn_text = text[turn["begin"]:turn["end"]]
+            for piece in chunk_text_by_tokens(turn_text, chunk_size, chunk_overlap):
+                chunk = get_turn_chunk(piece, [turn], next_starts[first])
+                if chunk["text"]:
+                    chunks.append(chunk)
+            first += 1
+            continue
+        while last + 1 < len(turns) and size + token_counts[last + 1] <= chunk_size:
+            last += 1
+            size += token_counts[last]
+        chunks.append(get_turn_chunk(text[turns[first]["begin"]:turns[last]["end"]], turns[first:last + 1], next_starts[last]))
+        if last + 1 == len(turns):
+            break
+        # Repeat the trailing turns that fit in turn_overlap, without getting stuck on the same turns
+        next_first = last + 1
+        overlap = 0
+        while next_first - 1 > first and overlap + token_counts[next_first - 1] <= turn_overlap:
+            next_first -= 1
+            overlap += token_counts[next_first]
+        first = next_first
+    return chunks
@@ -0,0 +1,130 @@
+from util import *
+from chunking import get_tokenizer, chunk_tokens
+from keyword_index import tokenize
+
+# Weight of relevance against novelty in maximal marginal relevance
+MMR_LAMBDA = 0.7
+# Characters at the start of a chunk looked up in the previous chunk to find their overlap
+OVERLAP_ANCHOR_CHARS = 8
+# A chunk that doesn't fit is cut to the remaining budget, unless less than this is left
+MIN_PACK_TOKENS = 200
+
+def term_similarity(a, b):
+    """Jaccard similarity of two term sets."""
+    if not a or not b:
+        return 0.0
+    return len(a & b) / len(a | b)
+
+def order_by_mmr(documents, lambda_=MMR_LAMBDA):
+    """Returns the indexes of the documents, given best first, in maximal marginal relevance order.
+
+    Relevance decreases linearly with the retrieval rank, and similarity is the
+    Jaccard similarity of the keyword terms, so no embeddings are needed.
+    """
+    terms = [set(tokenize(document)) for document in documents]
+    relevance = [1 - rank / len(documents) for rank in range(len(documents))]
+    remaining = list(range(len(documents)))
+    order = []
+    while remaining:
+        def mmr(i):
+            redundancy = max((term_similarity(terms[i], terms[j]) for j in order), default=0.0)
+            return lambda_ * relevance[i] - (1 - lambda_) * redundancy
+        best = max(remaining, key=mmr)
+        order.append(best)
+        remaining.remove(best)
+    return order
+
+def merge_overlap(a, b):
+    """Joins two consecutive chunks, dropping the start of b that repeats the end of a."""
+    anchor = b[:OVERLAP_ANCHOR_CHARS]
+    # The overlap is at most as long as b, and the longest one is found first
+    start = a.find(anchor, max(0, len(a) - len(b))) if anchor else -1
+    while start != -1:
+        if b.startswith(a[start:]):
+            return a + b[len(a) - start:]
+        start = a.find(anchor, start + 1)
+    return a + "\n" + b
+
+def merge_metadata(metadatas):
+    """Returns the metadata of consecutive chunks merged into one block."""
+    merged = dict(metadatas[0])
+    times = [metadata for metadata in metadatas if "start_time" in metadata]
+    if times:
+        merged["start_time"] = min(metadata["start_time"] for metadata in times)
+        merged["end_time"] = max(metadata["end_time"] for metadata in times)
+    speakers = [speaker for metadata in metadatas for speaker in metadata.get("speakers", "").split(", ") if speaker]
+    if speakers:
+        merged["speakers"] = ", ".join(dict.fromkeys(speakers))
+    return merged
+
+def merge_adjacent_chunks(selected):
+    """Merges selected chunks that follow each other in the same transcript.
+
+    Args:
+        selected: A list of (document, metadata) tuples, best first.
+
+    Returns a list of (document, metadata) blocks, ordered by their best chunk.
+    """
+    groups = {}
+    for rank, (document, metadata) in enumerate(selected):
+        groups.setdefault(metadata.get("source"), []).append((metadata.get("chunk", -1), rank, document, metadata))
+    blocks = []
+    for chunks in groups.values():
+        chunks.sort(key=lambda chunk: chunk[0])
+        run = [chunks[0]]
+        for chunk in chunks[1:]:
+            if chunk[0] == run[-1][0] + 1 and chunk[0] >= 0:
+                run.append(chunk)
+                continue
+            blocks.append(run)
+            run = [chunk]
+        blocks.append(run)
+    blocks.sort(key=lambda run: min(chunk[1] for chunk in run))
+    merged = []
+    for run in blocks:
+        document = run[0][2]
+        for chunk in run[1:]:
+            document = merge_overlap(document, chunk[2])
+        merged.append((document, merge_metadata([chunk[3] for chunk in run])))
+    return merged
+
+def assemble_context(documents, metadatas, token_budget=None, lambda_=MMR_LAMBDA):
+    """Selects and merges retrieved chunks into a context of at most token_budget tokens.
+
+    Chunks are taken in MMR order while they fit in the budget, and later chunks
+    that still fit whole are taken after one that doesn't. The budget left after
+    that is filled with the best chunk that didn't fit, cut to it, unless less
+    than MIN_PACK_TOKENS are left. The selected chunks that follow each other in
+    a transcript are merged into one block without their overlap.
+
+    Args:
+        documents: Retrieved chunks, best first.
+        metadatas: Their metadata.
+        token_budget: Budget in tiktoken tokens, CONFIG["context_token_budget"] by default.
+
+    Returns (documents, metadatas) of the context blocks, best first.
+    """
+    token_budget = token_budget or CONFIG["context_token_budget"]
+    if not documents:
+        return [], []
+    metadatas = [metadata or {} for metadata in (metadatas or [{}] * len(documents))]
+    # (MMR rank, document, metadata) of the chosen chunks
+    selected = []
+    too_long = []
+    remaining = token_budget
+    for rank, i in enumerate(order_by_mmr(documents, lambda_)):
+        if remaining < MIN_PACK_TOKENS:
+            break
+        tokens = get_tokenizer().encode(documents[i])
+        if len(tokens) > remaining:
+            too_long.append((rank, i, tokens))
+            continue
+        selected.append((rank, documents[i], metadatas[i]))
+        remaining -= len(tokens)
+    if too_long and remaining >= MIN_PACK_TOKENS:
+        rank, i, tokens = too_long[0]
+        # Cut by byte offsets like the chunker, so no character is split
+        selected.append((rank, chunk_tokens(documents[i], tokens, remaining, 0)[0], metadatas[i]))
+    selected.sort(key=lambda chunk: chunk[0])
+    blocks = merge_adjacent_chunks([(document, metadata) for _, document, metadata in selected])
+    return [document for document, _ in blocks], [metadata for _, metadata in blocks]
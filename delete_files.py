@@ -4,7 +4,40 @@ import argparse
 from datetime import datetime, timedelta
 import os
 from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor
 from util import *
+from upload_registry import get_upload_registry
+
+DELETE_WORKERS = 8
+
+def delete_registered_file(registry, content_hash, entry):
+    """Deletes a file recorded in the upload registry and drops its entry. Returns True on success."""
+    try:
+        genai.delete_file(entry["name"])
+        print(f"File {entry['name']} with display_name {entry['display_name']} deleted successfully.")
+    except Exception as e:
+        # Files older than 48 hours are purged by Gemini, the entry is stale either way
+        if "not found" not in str(e).lower() and "404" not in str(e) and "403" not in str(e):
+            print(f"Error deleting file {entry['name']}: {e}")
+            return False
+        print(f"File {entry['name']} no longer exists.")
+    registry.remove(content_hash)
+    return True
+
+def delete_old_registered_files(api_key, hours=24):
+    """Deletes the uploads recorded in the upload registry that are older than hours, in parallel.
+
+    Unlike delete_old_files() this needs no listing of the remote files.
+    """
+    genai.configure(api_key=api_key)
+    registry = get_upload_registry()
+    expired = registry.expired(hours)
+    if not expired:
+        print("\nNo registered files were deleted.")
+        return
+    with ThreadPoolExecutor(max_workers=DELETE_WORKERS) as executor:
+        results = list(executor.map(lambda item: delete_registered_file(registry, *item), expired))
+    print(f"\nDeleted {sum(results)} of {len(expired)} registered files older than {hours} hours.")
 
 def delete_old_files(api_key, hours=24):
     genai.configure(api_key=api_key)
@@ -45,18 +78,21 @@ def delete_old_files(api_key, hours=24):
     else:
         print("\nNo files were deleted.")
 
-def get_retention():
+def get_args():
     parser = argparse.ArgumentParser(description="Retention time in hours")
     parser.add_argument('--hours',
                         type=int,  # Expect a string value
                         help='Number of hours of file retention')
-    args = parser.parse_args()
-    return args.hours
+    parser.add_argument('--all-remote',
+                        action='store_true',
+                        help='List every remote file instead of using the upload registry, to also delete files uploaded elsewhere')
+    return parser.parse_args()
 
 if __name__ == "__main__":
     api_key = get_gemini_key()
-    hours = get_retention()
-    if hours:
-        delete_old_files(api_key, hours)
+    args = get_args()
+    delete = delete_old_files if args.all_remote else delete_old_registered_files
+    if args.hours:
+        delete(api_key, args.hours)
     else:
-        delete_old_files(api_key)
\ No newline at end of file
+        delete(api_key)
\ No newline at end of file
@@ -2,13 +2,19 @@ import csv
 import requests
 import xml.etree.ElementTree as ET
 import json
+import io
 import os
 from bs4 import BeautifulSoup
 import time
 import argparse
+import hashlib
+import threading
+from collections import deque
+from concurrent.futures import Future, ThreadPoolExecutor, wait
 from datetime import datetime
 from urllib.parse import urlparse
 from util import *
+from manifest import EpisodeManifest
 
 headers = {"User-Agent": "Mozilla/5.0 (Windows NT 10.0; Win64; x64) AppleWebKit/537.36 (KHTML, like Gecko) Chrome/131.0.0.0 Safari/537.36"}
 
@@ -23,60 +29,161 @@ def fetch_rss_feed(rss_url):
         print(f"Error fetching RSS feed from {rss_url}: {e}")
         return None
 
+# Function to fetch RSS feed content only if it changed since the cached fetch
+def fetch_rss_feed_conditional(rss_url, cache_entry=None):
+    """Fetches an RSS feed with If-None-Match/If-Modified-Since from a cached entry.
+
+    Args:
+        rss_url: The feed URL.
+        cache_entry: The FeedCache entry of the previous fetch, if any.
+
+    Returns:
+        A tuple (rss_content, new_cache_entry). rss_content is None if the feed is
+        unchanged (304 or same content hash) or could not be fetched. new_cache_entry
+        is None on error.
+    """
+    print(rss_url)
+    cache_entry = cache_entry or {}
+    request_headers = dict(headers)
+    if cache_entry.get("etag"):
+        request_headers["If-None-Match"] = cache_entry["etag"]
+    if cache_entry.get("last_modified"):
+        request_headers["If-Modified-Since"] = cache_entry["last_modified"]
+    try:
+        with metrics.span("download.feed"):
+            response = requests.get(rss_url, timeout=10, headers=request_headers)
+        metrics.count("api_calls", api="http", op="feed", status=response.status_code)
+        if response.status_code == 304:
+            print(f"RSS feed not modified: {rss_url}")
+            return (None, cache_entry)
+        response.raise_for_status()  # Raise an exception for bad status codes
+    except requests.exceptions.RequestException as e:
+        print(f"Error fetching RSS feed from {rss_url}: {e}")
+        return (None, None)
+
+    new_cache_entry = {
+        "etag": response.headers.get("ETag"),
+        "last_modified": response.headers.get("Last-Modified"),
+        "sha256": hashlib.sha256(response.content).hexdigest(),
+    }
+    if new_cache_entry["sha256"] == cache_entry.get("sha256"):
+        print(f"RSS feed content unchanged: {rss_url}")
+        return (None, new_cache_entry)
+    return (response.content, new_cache_entry)
+
+class FeedCache:
+    """Persistent per-feed cache of HTTP validators (ETag, Last-Modified) and content hash.
+
+    An entry is only stored once its feed has been fully processed, so a feed whose
+    processing was interrupted is fetched and parsed again on the next run.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename or CONFIG["feed_cache_file"]
+        self.lock = threading.Lock()
+        self.entries = {}
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r', encoding='utf-8') as infile:
+                    self.entries = json.load(infile)
+            except Exception as e:
+                print(f"Error loading feed cache {self.filename}: {e}")
+
+    def get(self, rss_url):
+        with self.lock:
+            return self.entries.get(rss_url)
+
+    def update(self, rss_url, cache_entry):
+        with self.lock:
+            self.entries[rss_url] = cache_entry
+            os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+            tmp_filename = self.filename + ".tmp"
+            with open(tmp_filename, 'w', encoding='utf-8') as outfile:
+                json.dump(self.entries, outfile, indent=4)
+            os.replace(tmp_filename, self.filename)
+
 # Function to strip HTML tags from a string
 def strip_html_tags(html_string):
     soup = BeautifulSoup(html_string, "html.parser")
     return soup.get_text(separator=" ", strip=True)
 
-# Function to parse RSS XML and convert to JSON
-def parse_rss_and_convert_to_json(rss_content):
-    podcast_data = {"episodes": []}
+# Function to stream episodes out of RSS XML
+def iter_rss_episodes(rss_content, podcast_data=None, known_guids=None, stop_at_known=False):
+    """Parses RSS XML incrementally with iterparse and yields episodes one at a time.
+
+    Each item is cleared once parsed, so memory stays bounded on large feeds.
+
+    Args:
+        rss_content: The RSS XML (bytes).
+        podcast_data: Optional dict that receives the channel title, description and link.
+        known_guids: GUIDs of episodes that are already known. Those items are skipped
+            before their description is stripped of HTML.
+        stop_at_known: Stop at the first known item once the feed is seen to be ordered
+            newest-first, as every item after it is older and therefore known as well.
+    """
+    known_guids = known_guids or set()
+    stack = []
+    channel = None
+    last_timestamp = None
+    order_checked = False
+    newest_first = True
     try:
-        root = ET.fromstring(rss_content)
-        channel = root.find("channel")
-        if channel is not None:
-            podcast_data["title"] = channel.findtext("title")
-            podcast_data["description"] = strip_html_tags(channel.findtext("description", ""))
-            podcast_data["link"] = channel.findtext("link")
-
-            for item in channel.findall("item"):
-                episode = {
-                    "title": item.findtext("title"),
-                    "link": item.findtext("link"),
-                    "description": strip_html_tags(item.findtext("description", "")),
-                    "pubDate": item.findtext("pubDate"),
-                    "enclosure_url": None,
-                    "enclosure_type": None,
-                    "guid": item.findtext("guid") # Assuming guid is available
-                }
-                enclosure = item.find("enclosure")
-                if enclosure is not None:
-                    episode["enclosure_url"] = enclosure.get("url")
-                    episode["enclosure_type"] = enclosure.get("type")
-                podcast_data["episodes"].append(episode)
+        for event, elem in ET.iterparse(io.BytesIO(rss_content), events=("start", "end")):
+            if event == "start":
+                stack.append(elem)
+                if elem.tag == "channel" and channel is None:
+                    channel = elem
+                continue
+
+            stack.pop()
+            parent = stack[-1] if stack else None
+            if parent is not channel or channel is None:
+                continue
+
+            if elem.tag == "item":
+                guid = elem.findtext("guid") # Assuming guid is available
+                pub_date_str = elem.findtext("pubDate")
+                pub_date = parse_pub_date(pub_date_str) if pub_date_str else None
+                if pub_date:
+                    timestamp = pub_date.timestamp()
+                    if last_timestamp is not None:
+                        order_checked = True
+                        newest_first = newest_first and timestamp <= last_timestamp
+                    last_timestamp = timestamp
+
+                if guid and guid in known_guids:
+                    if stop_at_known and order_checked and newest_first:
+                        return
+                else:
+                    episode = {
+                        "title": elem.findtext("title"),
+                        "link": elem.findtext("link"),
+                        "description": strip_html_tags(elem.findtext("description", "")),
+                        "pubDate": pub_date_str,
+                        "enclosure_url": None,
+                        "enclosure_type": None,
+                        "guid": guid
+                    }
+                    enclosure = elem.find("enclosure")
+                    if enclosure is not None:
+                        episode["enclosure_url"] = enclosure.get("url")
+                        episode["enclosure_type"] = enclosure.get("type")
+                    yield episode
+                elem.clear()
+                channel.remove(elem)
+            elif podcast_data is not None and elem.tag == "title":
+                podcast_data["title"] = elem.text
+            elif podcast_data is not None and elem.tag == "description":
+                podcast_data["description"] = strip_html_tags(elem.text or "")
+            elif podcast_data is not None and elem.tag == "link":
+                podcast_data["link"] = elem.text
     except ET.ParseError as e:
         print(f"Error parsing RSS XML: {e}")
-    return podcast_data
 
-# Helper function to parse pubDate string to datetime object
-def parse_pub_date(date_string):
-    # Attempt to parse with different common formats
-    formats = [
-        "%a, %d %b %Y %H:%M:%S %Z",
-        "%a, %d %b %Y %H:%M:%S %z",
-        "%a, %d %b %Y %H:%M %Z",
-        "%a, %d %b %Y %H:%M %z",
-        "%d %b %Y %H:%M:%S %Z",
-        "%d %b %Y %H:%M:%S %z",
-        "%Y-%m-%dT%H:%M:%S%z",
-        "%Y-%m-%dT%H:%M:%SZ",
-    ]
-    for fmt in formats:
-        try:
-            return datetime.strptime(date_string, fmt)
-        except ValueError:
-            pass
-    return None
+# Function to parse RSS XML and convert to JSON
+def parse_rss_and_convert_to_json(rss_content):
+    podcast_data = {"episodes": []}
+    podcast_data["episodes"] = list(iter_rss_episodes(rss_content, podcast_data))
+    return podcast_data
 
 def get_file_extension(url):
     """Extracts the file extension from a URL.
@@ -101,13 +208,17 @@ def get_file_extension(url):
     else:
         return None
 
+def is_downloadable(episode_data):
+    enclosure_url = episode_data.get("enclosure_url")
+    return bool(enclosure_url and (enclosure_url.endswith(".mp3") or enclosure_url.endswith(".m4a")))
+
 # Hook function to process an episode (stub)
 def process_episode(episode_data, podcast_name):
-    enclosure_url = episode_data.get("enclosure_url")
-    if enclosure_url and (enclosure_url.endswith(".mp3") or enclosure_url.endswith(".m4a")):
+    if is_downloadable(episode_data):
         print("Processing episode: " + episode_data["enclosure_url"])
-        (episode_data["filename"], episode_data["filesize"]) = download_audio(
-            episode_data["enclosure_url"], podcast_name, episode_data["title"], episode_data.get("pubDate"))
+        with metrics.span("download.episode"):
+            (episode_data["filename"], episode_data["filesize"]) = download_audio(
+                episode_data["enclosure_url"], podcast_name, episode_data["title"], episode_data.get("pubDate"))
     else:
         print(f"No MP3/M4A enclosure found for episode: {episode_data.get('title')}")
 
@@ -136,7 +247,8 @@ def download_audio(audio_url, podcast_name, episode_title, pub_date_str):
             existing_file_size = os.path.getsize(filename)
 
             # Get the size of the file at the URL using HEAD request
-            head_response = requests.head(audio_url, allow_redirects=True, headers=headers)
+            with metrics.span("download.head"):
+                head_response = requests.head(audio_url, allow_redirects=True, headers=headers)
             head_response.raise_for_status()  # Raise an exception for bad status codes
             remote_file_size = int(head_response.headers.get('Content-Length', 0))
 
@@ -144,6 +256,8 @@ def download_audio(audio_url, podcast_name, episode_title, pub_date_str):
                 print(f"This {filename} already exists and skip downloading.")
                 return (short_filename, remote_file_size)
             else:
+                # The remote episode changed (re-published, ads inserted), the file is not a prefix of it.
+                # Only .part files journaled by download_with_resume are resumed.
                 print(f"File {filename} exists but size mismatch. Old size: {existing_file_size}, New size: {remote_file_size}. Removing existing file.")
                 os.remove(filename)
         except requests.exceptions.RequestException as e:
@@ -154,17 +268,8 @@ def download_audio(audio_url, podcast_name, episode_title, pub_date_str):
     # Download the file if it doesn't exist or the size doesn't match
     try:
         print(f"Downloading audio for '{episode_title}' from '{podcast_name}' (published {date_str if date_str else 'unknown date'})...")
-        response = requests.get(audio_url, stream=True, headers=headers)
-        response.raise_for_status()
-        written_size = 0
-        
-        with open(filename, 'wb') as outfile:
-            for chunk in response.iter_content(chunk_size=8192):
-                outfile.write(chunk)
-                written_size += len(chunk)
+        written_size = download_with_resume(audio_url, filename)
         print(f"Audio downloaded to: {filename}")
-        # Sleep 10 seconds after successful download otherwise might be banned
-        time.sleep(10)
         return (short_filename, written_size)
     except requests.exceptions.RequestException as e:
         print(f"Error downloading audio from {audio_url}: {e}")
@@ -173,6 +278,200 @@ def download_audio(audio_url, podcast_name, episode_title, pub_date_str):
         print(f"An error occurred during audio download: {e}")
         return ("", 0)
 
+# Number of attempts to complete a download, each attempt resumes from the last byte written
+DOWNLOAD_ATTEMPTS = 5
+
+def get_strong_etag(response_headers):
+    """Returns the ETag of a response, or None if it is missing or weak (weak ETags can't be used in If-Range)."""
+    etag = response_headers.get("ETag")
+    if etag and not etag.startswith("W/"):
+        return etag
+    return None
+
+def read_part_journal(journal_filename):
+    """Reads the journal describing a partial download, returns {} if there is none."""
+    try:
+        with open(journal_filename, 'r', encoding='utf-8') as infile:
+            return json.load(infile)
+    except (OSError, ValueError):
+        return {}
+
+def write_part_journal(journal_filename, journal):
+    with open(journal_filename, 'w', encoding='utf-8') as outfile:
+        json.dump(journal, outfile)
+
+def parse_content_range(content_range):
+    """Parses a 'bytes start-end/total' Content-Range header into (start, total). total is None if unknown."""
+    try:
+        unit, byte_range = content_range.split(" ", 1)
+        span, total = byte_range.split("/", 1)
+        start = int(span.split("-", 1)[0])
+        return (start, None if total == "*" else int(total))
+    except (AttributeError, ValueError):
+        return (None, None)
+
+def download_with_resume(audio_url, filename, attempts=DOWNLOAD_ATTEMPTS):
+    """Downloads a URL to filename, resuming from partial data where possible.
+
+    Data is written to `<filename>.part` and the validators of the response (ETag,
+    Last-Modified, Content-Length) are journaled next to it in `<filename>.part.json`.
+    A failed attempt, or a later run, resumes with a Range request guarded by If-Range,
+    so only the missing bytes are fetched unless the remote file changed. The .part
+    file is renamed to filename once its size matches the expected length.
+
+    Returns:
+        The size of the downloaded file in bytes.
+    """
+    part_filename = filename + ".part"
+    journal_filename = part_filename + ".json"
+    journal = read_part_journal(journal_filename)
+    if journal.get("url") != audio_url and os.path.exists(part_filename):
+        # Partial data from another URL can't be resumed
+        os.remove(part_filename)
+
+    last_error = None
+    for attempt in range(attempts):
+        offset = os.path.getsize(part_filename) if os.path.exists(part_filename) else 0
+        validator = journal.get("etag") or journal.get("last_modified") if journal.get("url") == audio_url else None
+        request_headers = dict(headers)
+        if offset > 0 and validator:
+            request_headers["Range"] = f"bytes={offset}-"
+            request_headers["If-Range"] = validator
+        try:
+            with requests.get(audio_url, stream=True, headers=request_headers, timeout=60) as response:
+                if response.status_code == 416:
+                    if journal.get("total") == offset:
+                        # The previous run had already fetched everything
+                        os.replace(part_filename, filename)
+                        os.remove(journal_filename)
+                        return offset
+                    os.remove(part_filename)
+                    raise IOError(f"Partial file of {offset} bytes is not valid for {audio_url}")
+                response.raise_for_status()
+
+                if response.status_code == 206 and parse_content_range(response.headers.get("Content-Range"))[0] != offset:
+                    # A range we did not ask for can't be appended, the next attempt starts over without Range
+                    for stale_filename in (part_filename, journal_filename):
+                        if os.path.exists(stale_filename):
+                            os.remove(stale_filename)
+                    journal = {}
+                    raise IOError(f"Unexpected Content-Range {response.headers.get('Content-Range')} for {audio_url} at byte {offset}")
+                if response.status_code == 206:
+                    print(f"Resuming download of {audio_url} at byte {offset}")
+                    total = parse_content_range(response.headers.get("Content-Range"))[1] or journal.get("total")
+                    mode = 'ab'
+                else:
+                    # Full response: either a fresh download or the remote file changed
+                    if offset > 0:
+                        print(f"Cannot resume {audio_url}, restarting download")
+                    content_length = response.headers.get("Content-Length")
+                    total = int(content_length) if content_length and response.status_code == 200 else None
+                    journal = {
+                        "url": audio_url,
+                        "etag": get_strong_etag(response.headers),
+                        "last_modified": response.headers.get("Last-Modified"),
+                        "total": total,
+                    }
+                    write_part_journal(journal_filename, journal)
+                    mode = 'wb'
+
+                with open(part_filename, mode) as outfile, metrics.span("download.body"):
+                    for chunk in response.iter_content(chunk_size=65536):
+                        outfile.write(chunk)
+                    metrics.count("download_bytes", outfile.tell() - (offset if mode == 'ab' else 0))
+
+            written_size = os.path.getsize(part_filename)
+            if total is not None and written_size != total:
+                raise IOError(f"Incomplete download: got {written_size} of {total} bytes")
+            os.replace(part_filename, filename)
+            if os.path.exists(journal_filename):
+                os.remove(journal_filename)
+            return written_size
+        except (requests.exceptions.RequestException, IOError) as e:
+            last_error = e
+            print(f"Download of {audio_url} interrupted (attempt {attempt + 1}/{attempts}): {e}")
+            metrics.count("retries", api="http", op="download")
+            if attempt + 1 < attempts:
+                time.sleep(min(2 ** attempt, 30))
+    raise last_error
+
+# Minimum number of seconds between two downloads from the same host, otherwise might be banned
+HOST_DELAY_SECONDS = 10
+
+class DownloadEngine:
+    """Downloads episodes on a thread pool.
+
+    Downloads from different hosts run in parallel. Each host runs at most `per_host`
+    downloads at once and is paced by a token bucket, so a new download starts on a
+    host at most once every `host_delay` seconds. Episodes waiting for a busy or
+    paced host are queued per host instead of blocking a worker thread; a paced
+    host is dispatched again by a timer when its bucket refills.
+    """
+    def __init__(self, workers=4, per_host=1, host_delay=HOST_DELAY_SECONDS):
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.per_host = per_host
+        self.host_delay = host_delay
+        self.hosts = {}
+        self.lock = threading.Lock()
+
+    def submit(self, episode_data, podcast_name):
+        """Queues an episode for download and returns a Future resolving to the episode."""
+        future = Future()
+        host = urlparse(episode_data.get("enclosure_url") or "").netloc
+        with self.lock:
+            if host not in self.hosts:
+                bucket = TokenBucket(1.0 / self.host_delay) if self.host_delay > 0 else None
+                self.hosts[host] = {"active": 0, "pending": deque(), "bucket": bucket, "timer": None}
+            state = self.hosts[host]
+            state["pending"].append((future, episode_data, podcast_name))
+            self._dispatch(state)
+        return future
+
+    def _dispatch(self, state):
+        # Must be called with self.lock held
+        while state["active"] < self.per_host and state["pending"]:
+            job = state["pending"][0]
+            if state["bucket"] and is_downloadable(job[1]):
+                delay = state["bucket"].try_acquire()
+                if delay > 0:
+                    # Wait for the bucket on a timer, the worker threads stay free for other hosts
+                    if state["timer"] is None:
+                        state["timer"] = threading.Timer(delay, self._wake, (state,))
+                        state["timer"].daemon = True
+                        state["timer"].start()
+                    return
+            state["pending"].popleft()
+            state["active"] += 1
+            self.executor.submit(self._run, state, job)
+
+    def _wake(self, state):
+        with self.lock:
+            state["timer"] = None
+            self._dispatch(state)
+
+    def _run(self, state, job):
+        future, episode_data, podcast_name = job
+        try:
+            process_episode(episode_data, podcast_name)
+            future.set_result(episode_data)
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                state["active"] -= 1
+                self._dispatch(state)
+
+    def download_all(self, episodes, podcast_name):
+        """Downloads the episodes of a podcast and waits until all of them are done."""
+        futures = [self.submit(episode, podcast_name) for episode in episodes]
+        wait(futures)
+        for future in futures:
+            if future.exception():
+                print(f"Error processing episode for {podcast_name}: {future.exception()}")
+
+    def close(self):
+        self.executor.shutdown(wait=True)
+
 # Function to save podcast data to a JSON file
 def save_podcast_data(podcast_name, podcast_data):
     os.makedirs(CONFIG["output_directory"], exist_ok=True)
@@ -186,68 +485,72 @@ def save_podcast_data(podcast_name, podcast_data):
         print(f"Error saving podcast data to {filename}: {e}")
 
 # Function for full mode processing
-def process_podcast_full(podcast):
+def process_podcast_full(podcast, engine, manifest, feed_cache=None):
     print(f"Processing podcast (Full Mode): {podcast['podcast_name']}")
-    rss_content = fetch_rss_feed(podcast['rss_url'])
+    # Full mode always fetches, the cache entry is only refreshed for later incremental runs
+    rss_content, feed_cache_entry = fetch_rss_feed_conditional(podcast['rss_url'])
     if rss_content:
         podcast_data = parse_rss_and_convert_to_json(rss_content)
         # Sort episodes by pubDate ascending
         podcast_data["episodes"].sort(key=lambda x: parse_pub_date(x.get("pubDate")) if x.get("pubDate") else datetime.min)
+        manifest.upsert_episodes(podcast['podcast_name'], podcast_data["episodes"])
+        engine.download_all(podcast_data.get("episodes", []), podcast['podcast_name'])
+        manifest.upsert_episodes(podcast['podcast_name'], podcast_data["episodes"])
+        # A JSON snapshot of the full feed is still written for reference
         save_podcast_data(podcast['podcast_name'], podcast_data)
-        for episode in podcast_data.get("episodes", []):
-            process_episode(episode, podcast['podcast_name'])
+        if feed_cache:
+            feed_cache.update(podcast['rss_url'], feed_cache_entry)
 
-# Function for incremental mode processing
-def process_podcast_incremental(podcast):
-    print(f"Processing podcast (Incremental Mode): {podcast['podcast_name']}")
-    safe_podcast_name = "".join(c if c.isalnum() else '_' for c in podcast['podcast_name'])
-    previous_data_file = os.path.join(CONFIG["output_directory"], f"{safe_podcast_name}.json")
-    previous_episodes = {}
-    if os.path.exists(previous_data_file):
-        try:
-            with open(previous_data_file, 'r', encoding='utf-8') as infile:
-                previous_data = json.load(infile)
-                previous_episodes = {ep["guid"]: ep for ep in previous_data.get("episodes", []) if ep.get("guid")}
-        except Exception as e:
-            print(f"Error loading previous data for {podcast['podcast_name']}: {e}")
+def find_incremental_episodes(podcast, manifest, feed_cache=None):
+    """Returns the episodes of a podcast to download: unseen feed episodes, and earlier failed downloads.
 
-    rss_content = fetch_rss_feed(podcast['rss_url'])
-    print(f"RSS Length:{len(rss_content)}")
+    Unseen episodes are recorded in the manifest first. Also returns the new
+    feed cache entry, to be saved once the downloads are done.
+    """
+    previous_episodes = manifest.known_guids(podcast['podcast_name'])
+
+    new_episodes = []
+    feed_cache_entry = feed_cache.get(podcast['rss_url']) if feed_cache else None
+    rss_content, feed_cache_entry = fetch_rss_feed_conditional(podcast['rss_url'], feed_cache_entry)
     if rss_content:
-        current_podcast_data = parse_rss_and_convert_to_json(rss_content)
+        print(f"RSS Length:{len(rss_content)}")
+        # Known episodes are skipped while parsing, so only unseen episodes are returned here
+        current_podcast_data = {"episodes": []}
+        current_podcast_data["episodes"] = list(iter_rss_episodes(
+            rss_content, current_podcast_data, known_guids=previous_episodes, stop_at_known=True))
         # Sort episodes by pubDate ascending
         current_podcast_data["episodes"].sort(key=lambda x: parse_pub_date(x.get("pubDate")) if x.get("pubDate") else datetime.min)
-        print("current_podcast_data: " + str(len(current_podcast_data.get("episodes", []))))
+        print("unseen episodes in current_podcast_data: " + str(len(current_podcast_data.get("episodes", []))))
         #print(current_podcast_data)
         print("previous_episodes: " + str(len(previous_episodes)))
-        new_episodes = []
         for episode in current_podcast_data.get("episodes", []):
-            if episode.get("guid") and episode["guid"] not in previous_episodes:
+            if episode.get("guid"):
                 new_episodes.append(episode)
-                process_episode(episode, podcast['podcast_name'])
+        # Recorded before downloading so an interrupted run retries the downloads next time
+        manifest.upsert_episodes(podcast['podcast_name'], new_episodes)
 
-        if new_episodes:
-            print(f"Found {len(new_episodes)} new episodes for {podcast['podcast_name']}")
-            # Update and save the podcast data with new episodes
-            if os.path.exists(previous_data_file):
-                try:
-                    with open(previous_data_file, 'r+', encoding='utf-8') as infile:
-                        previous_data = json.load(infile)
-                        existing_guids = {ep.get("guid") for ep in previous_data.get("episodes", []) if ep.get("guid")}
-                        for new_ep in new_episodes:
-                            if new_ep.get("guid") and new_ep["guid"] not in existing_guids:
-                                previous_data["episodes"].append(new_ep)
-                        # Sort the combined episodes before saving
-                        previous_data["episodes"].sort(key=lambda x: parse_pub_date(x.get("pubDate")) if x.get("pubDate") else datetime.min)
-                        infile.seek(0)
-                        json.dump(previous_data, infile, indent=4, ensure_ascii=False)
-                        infile.truncate()
-                except Exception as e:
-                    print(f"Error updating previous data for {podcast['podcast_name']}: {e}")
-            else:
-                save_podcast_data(podcast['podcast_name'], current_podcast_data) # Save all if no previous data
-        else:
-            print(f"No new episodes found for {podcast['podcast_name']}")
+    if new_episodes:
+        print(f"Found {len(new_episodes)} new episodes for {podcast['podcast_name']}")
+    else:
+        print(f"No new episodes found for {podcast['podcast_name']}")
+
+    # Known episodes whose download failed in an earlier run are retried as well
+    new_guids = {episode["guid"] for episode in new_episodes}
+    retry_episodes = [episode for episode in manifest.pending("downloaded", podcast['podcast_name'])
+                      if episode["guid"] not in new_guids and is_downloadable(episode)]
+    if retry_episodes:
+        print(f"Retrying {len(retry_episodes)} failed downloads for {podcast['podcast_name']}")
+    return new_episodes + retry_episodes, feed_cache_entry
+
+# Function for incremental mode processing
+def process_podcast_incremental(podcast, engine, manifest, feed_cache=None):
+    print(f"Processing podcast (Incremental Mode): {podcast['podcast_name']}")
+    episodes, feed_cache_entry = find_incremental_episodes(podcast, manifest, feed_cache)
+    engine.download_all(episodes, podcast['podcast_name'])
+    manifest.upsert_episodes(podcast['podcast_name'], episodes)
+
+    if feed_cache and feed_cache_entry:
+        feed_cache.update(podcast['rss_url'], feed_cache_entry)
 
 
 
@@ -257,7 +560,25 @@ def download_podcast():
     parser.add_argument('--mode',
                     type=str,  # Expect a string value
                     help='The mode to run the script in (e.g., full, incremental)')
+    parser.add_argument('--workers',
+                    type=positive_int,
+                    default=4,
+                    help='Number of concurrent downloads across all hosts')
+    parser.add_argument('--per-host',
+                    type=positive_int,
+                    default=1,
+                    help='Maximum number of concurrent downloads from the same host')
+    parser.add_argument('--host-delay',
+                    type=float,
+                    default=HOST_DELAY_SECONDS,
+                    help='Minimum number of seconds between two downloads from the same host')
+    parser.add_argument('--ignore-feed-cache',
+                    action='store_true',
+                    help='Fetch and parse every RSS feed even if it has not changed since the last run')
+    metrics.add_profile_argument(parser)
     args = parser.parse_args()
+    if args.profile:
+        metrics.enable_profile()
     # Choose mode: 'full' or 'incremental'
     mode = 'incremental'  # Change to 'full' for full mode
     if args.mode:
@@ -270,13 +591,30 @@ def download_podcast():
     os.makedirs(CONFIG["output_directory"], exist_ok = True)
 
     if mode == 'full':
-        for podcast in podcasts:
-            process_podcast_full(podcast)
+        process_podcast = process_podcast_full
     elif mode == 'incremental':
-        for podcast in podcasts:
-            process_podcast_incremental(podcast)
+        process_podcast = process_podcast_incremental
     else:
         print("Invalid mode selected.")
+        return
+
+    # Feeds are processed concurrently and share one engine, so downloads from
+    # different hosts overlap while each host stays within its own limits
+    engine = DownloadEngine(workers=args.workers, per_host=args.per_host, host_delay=args.host_delay)
+    manifest = EpisodeManifest()
+    feed_cache = FeedCache()
+    if args.ignore_feed_cache:
+        feed_cache.entries = {}
+    try:
+        with ThreadPoolExecutor(max_workers=args.workers) as feed_executor:
+            futures = [(p, feed_executor.submit(process_podcast, p, engine, manifest, feed_cache)) for p in podcasts]
+            for podcast, future in futures:
+                try:
+                    future.result()
+                except Exception as e:
+                    print(f"Error processing podcast {podcast['podcast_name']}: {e}")
+    finally:
+        engine.close()
 
 if __name__ == "__main__":
     download_podcast()
\ No newline at end of file
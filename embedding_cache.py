@@ -0,0 +1,168 @@
+import os
+import hashlib
+import sqlite3
+import threading
+from array import array
+from chromadb.api.types import EmbeddingFunction
+from util import *
+from chunking import get_tokenizer
+
+try:
+    import numpy as np
+except ImportError:  # Vectors are then read with plain file reads instead of a memory map
+    np = None
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS vectors (
+    key TEXT PRIMARY KEY,
+    row INTEGER NOT NULL
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+# SQLite limits the number of parameters of a query
+LOOKUP_BATCH_SIZE = 500
+
+def get_embedding_key(model_name, text):
+    return hashlib.sha256(f"{model_name}\0{text}".encode("utf-8")).hexdigest()
+
+class EmbeddingCache:
+    """Persistent store of float32 embedding vectors keyed by sha256(model name + text).
+
+    Vectors are appended as raw float32 rows to `vectors.f32` in the cache
+    directory, and an SQLite index maps each key to its row. With NumPy the
+    vector file is memory-mapped, so lookups don't load the whole cache. Writers
+    append while holding the SQLite write lock, so several processes can share
+    the cache. The number of committed rows is kept in the meta table, so bytes
+    left past it by an interrupted write are overwritten by the next one.
+    """
+    def __init__(self, directory=None):
+        self.directory = directory or CONFIG["embedding_cache_directory"]
+        os.makedirs(self.directory, exist_ok=True)
+        self.vector_filename = os.path.join(self.directory, "vectors.f32")
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.directory, "index.db"), timeout=30, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+            row = self.conn.execute("SELECT value FROM meta WHERE name = 'dim'").fetchone()
+        self.dim = int(row[0]) if row else None
+        self.mmap = None
+
+    def close(self):
+        self.conn.close()
+
+    def _read_rows(self, rows):
+        # Must be called with self.lock held
+        if np is not None:
+            count = os.path.getsize(self.vector_filename) // (4 * self.dim)
+            if self.mmap is None or len(self.mmap) < count:
+                self.mmap = np.memmap(self.vector_filename, dtype=np.float32, mode='r', shape=(count, self.dim))
+            return [np.array(self.mmap[row]) for row in rows]
+        vectors = []
+        with open(self.vector_filename, 'rb') as infile:
+            for row in rows:
+                infile.seek(row * 4 * self.dim)
+                vector = array('f')
+                vector.frombytes(infile.read(4 * self.dim))
+                vectors.append(vector.tolist())
+        return vectors
+
+    def get_many(self, keys):
+        """Returns {key: vector} for the keys found in the cache."""
+        found = {}
+        with self.lock:
+            for i in range(0, len(keys), LOOKUP_BATCH_SIZE):
+                batch = keys[i : i + LOOKUP_BATCH_SIZE]
+                rows = self.conn.execute(f"SELECT key, row FROM vectors WHERE key IN ({','.join('?' * len(batch))})", batch).fetchall()
+                if rows:
+                    for (key, _), vector in zip(rows, self._read_rows([row for _, row in rows])):
+                        found[key] = vector
+        return found
+
+    def _count_rows(self):
+        # Must be called inside the write transaction
+        row = self.conn.execute("SELECT value FROM meta WHERE name = 'rows'").fetchone()
+        if row:
+            return int(row[0])
+        # Caches written before the row count was kept: every row up to the last one referenced is committed
+        last_row = self.conn.execute("SELECT MAX(row) FROM vectors").fetchone()[0]
+        return 0 if last_row is None else last_row + 1
+
+    def put_many(self, keys, vectors):
+        if not keys:
+            return
+        dim = len(vectors[0])
+        data = array('f')
+        for vector in vectors:
+            data.extend(float(value) for value in vector)
+        with self.lock:
+            # BEGIN IMMEDIATE takes the write lock, which also serializes appends across processes
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.dim is None:
+                    self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('dim', ?)", (str(dim),))
+                    self.dim = dim
+                elif dim != self.dim:
+                    raise ValueError(f"Embedding dimension {dim} does not match the cache dimension {self.dim}")
+                first_row = self._count_rows()
+                with open(self.vector_filename, 'ab') as outfile:
+                    # Drop a partial or uncommitted tail, the file size alone would misplace every later row
+                    outfile.truncate(first_row * 4 * self.dim)
+                    data.tofile(outfile)
+                self.conn.executemany("INSERT OR REPLACE INTO vectors (key, row) VALUES (?, ?)",
+                                      [(key, first_row + i) for i, key in enumerate(keys)])
+                self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES ('rows', ?)", (str(first_row + len(keys)),))
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+class CachedEmbeddingFunction(EmbeddingFunction):
+    """Embedding function that looks texts up in an EmbeddingCache before calling the wrapped function.
+
+    Only the texts missing from the cache are sent to the wrapped function, and
+    their vectors are added to the cache.
+    """
+    def __init__(self, embedding_function, model_name, cache=None):
+        self.embedding_function = embedding_function
+        self.model_name = model_name
+        self.cache = cache or EmbeddingCache()
+
+    def __call__(self, input):
+        keys = [get_embedding_key(self.model_name, text) for text in input]
+        found = self.cache.get_many(keys)
+        missing = [i for i, key in enumerate(keys) if key not in found]
+        metrics.count("embedding_cache", len(keys) - len(missing), result="hit")
+        if missing:
+            metrics.count("embedding_cache", len(missing), result="miss")
+            # Repeated texts within one call are only embedded once
+            missing_keys = list(dict.fromkeys(keys[i] for i in missing))
+            texts = {keys[i]: input[i] for i in missing}
+            missing_texts = [texts[key] for key in missing_keys]
+            with metrics.span("openai.embed"):
+                vectors = self.embedding_function(missing_texts)
+            metrics.count("api_calls", api="openai", op="embed")
+            # The embedding function returns no usage, counting tokens takes a second tokenization
+            if metrics.is_enabled():
+                metrics.count("tokens", sum(len(tokens) for tokens in get_tokenizer().encode_batch(missing_texts)), api="openai", op="embed", kind="input")
+            self.cache.put_many(missing_keys, vectors)
+            found.update(zip(missing_keys, vectors))
+        vectors = [found[key] for key in keys]
+        if np is not None:
+            return [np.asarray(vector, dtype=np.float32) for vector in vectors]
+        return [list(vector) for vector in vectors]
+
+cached_embedding_function = None
+cached_embedding_function_lock = threading.Lock()
+
+def get_cached_embedding_function():
+    """Returns the shared OpenAI embedding function backed by the embedding cache."""
+    global cached_embedding_function
+    with cached_embedding_function_lock:
+        if cached_embedding_function is None:
+            cached_embedding_function = CachedEmbeddingFunction(get_openai_ef(), EMBEDDING_MODEL_NAME)
+        return cached_embedding_function
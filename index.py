@@ -1,110 +1,328 @@
 import os
-import google.generativeai as genai
+import hashlib
+import argparse
+import queue
+import threading
 from util import *
-import tiktoken
-import chromadb
-
-model = init_model()
-
-CHUNK_SIZE_TOKENS = 2000  # Chunk size in tokens
-CHUNK_OVERLAP_TOKENS = 200  # Overlap in tokens
-GPT4_ENCODING = "cl100k_base"
-tokenizer = tiktoken.get_encoding(GPT4_ENCODING)
-
-def load_podcast_transcripts(directory):
-    """Loads podcast transcripts from text files in a directory."""
-    transcripts = {}
-    for filename in os.listdir(directory):
-        if filename.endswith(".transcript.txt"):
-            filepath = os.path.join(directory, filename)
-            with open(filepath, 'r', encoding='utf-8') as f:
-                transcripts[filename[:-4]] = f.read()  # Remove .txt extension
-    return transcripts
-
-def chunk_text(text, chunk_size=500, chunk_overlap=50):
-    """Splits text into smaller chunks with overlap."""
-    chunks = []
-    start = 0
-    while start < len(text):
-        end = min(start + chunk_size, len(text))
-        chunks.append(text[start:end])
-        start += chunk_size - chunk_overlap
-    return chunks
-
-def chunk_text_by_tokens(text, chunk_size=CHUNK_SIZE_TOKENS, chunk_overlap=CHUNK_OVERLAP_TOKENS):
-    """Splits text into smaller chunks based on token count using tiktoken with overlap."""
-    tokens = tokenizer.encode(text)
-    #print(len(tokens))
-    chunks = []
-    start = 0
-    while start < len(tokens):
-        end = min(start + chunk_size, len(tokens))
-        chunk_tokens = tokens[start:end]
-        chunk_text = tokenizer.decode(chunk_tokens)
-        chunks.append(chunk_text)
-        start = end - chunk_overlap
-        if start < 0 or start + chunk_overlap == end:
-            start = end  # Avoid negative start
-    return chunks
+from chunking import *
+from manifest import EpisodeManifest, IndexManifest
+from embedding_cache import get_cached_embedding_function
+from keyword_index import KeywordIndex, rebuild_keyword_index
+from query_cache import bump_index_generation
+from vector_store import get_vector_store
 
 COLLECTION_NAME = "podcast_embeddings"
 EMBEDDING_BATCH_SIZE = CONFIG["embedding_batch_size"]
 
+# Part of the content hash, bump it to re-index every transcript after changing how chunks are made
+CHUNK_FORMAT_VERSION = 4
 
-def index_transcript():
-    # --- ChromaDB Setup ---
-    client = chromadb.PersistentClient(path=CONFIG["index_directory"])
-    try:
-        collection_name = CONFIG["vector_collection"]
-        collection = client.get_or_create_collection(name=collection_name, embedding_function=openai_ef)
-        print(f"Collection '{collection_name}' loaded/created.")
-    except ValueError:
-        collection = client.create_collection(name=collection_name, embedding_function=openai_ef)
-        print(f"Collection '{collection_name}' created.")
+def get_content_hash(text):
+    return hashlib.sha256(f"{CHUNK_FORMAT_VERSION}\0{text}".encode("utf-8")).hexdigest()
+
+def get_chunk_ids(source, start, end):
+    return [f"{source}_chunk_{i}" for i in range(start, end)]
+
+def delete_chunks(store, ids, keyword_index=None):
+    """Deletes chunk ids from the vector store, and from the keyword index if given, in batches."""
+    for i in range(0, len(ids), EMBEDDING_BATCH_SIZE):
+        store.delete(ids[i : i + EMBEDDING_BATCH_SIZE])
+        if keyword_index is not None:
+            keyword_index.delete(ids[i : i + EMBEDDING_BATCH_SIZE])
+
+def list_podcast_transcripts(directory):
+    """Returns {source: filepath} for the transcripts in a directory, without reading them."""
+    if not os.path.isdir(directory):
+        return {}
+    return {filename[:-4]: os.path.join(directory, filename)  # Remove .txt extension
+            for filename in os.listdir(directory) if filename.endswith(".transcript.txt")}
+
+def read_transcript(filepath):
+    with open(filepath, 'r', encoding='utf-8') as f:
+        return f.read()
+
+def adopt_unrecorded_transcripts(store, index_manifest, podcast_name, transcript_files, indexed):
+    """Records transcripts indexed before the index manifest existed.
+
+    Their chunk_0 ids are looked up with a single bulk get. Such transcripts are
+    recorded with the chunk count of the old chunker, whose chunks didn't
+    overlap, and without a hash, so they are chunked again and their old
+    chunks are replaced.
+    """
+    unrecorded = [source for source in transcript_files if source not in indexed]
+    if not unrecorded:
+        return
+    existing_ids = set()
+    for i in range(0, len(unrecorded), EMBEDDING_BATCH_SIZE):
+        existing_ids.update(store.get([f"{source}_chunk_0" for source in unrecorded[i : i + EMBEDDING_BATCH_SIZE]])["ids"])
+    for source in unrecorded:
+        if f"{source}_chunk_0" in existing_ids:
+            chunk_count = len(chunk_text_by_tokens(read_transcript(transcript_files[source]), chunk_overlap=0))
+            index_manifest.record(podcast_name, source, "", chunk_count)
+            indexed[source] = ("", chunk_count)
+
+def get_episode_metadata(podcast, episode):
+    """Returns the metadata of an episode stored with its chunks. Chroma doesn't accept None values.
+
+    The language comes from the podcast list. pub_ts is the publication time as
+    a Unix timestamp, which date range filters compare against.
+    """
+    metadata = {"podcast": podcast["podcast_name"]}
+    if podcast.get("language"):
+        metadata["language"] = podcast["language"]
+    for field in ("title", "pubDate", "pub_ts"):
+        if episode and episode.get(field):
+            metadata[field] = episode[field]
+    return metadata
+
+def get_chunk_metadata(document, index, chunk):
+    metadata = {"source": document["source"], "chunk": index}
+    metadata.update(document["metadata"])
+    if "start" in chunk:
+        metadata["start_time"] = chunk["start"]
+        metadata["end_time"] = chunk["end"]
+    if "speakers" in chunk:
+        metadata["speakers"] = chunk["speakers"]
+    return metadata
+
+# Bounds of the queues between the pipeline stages, they keep memory flat
+DOCUMENT_QUEUE_SIZE = 4
+EMBED_WORKERS = 4
+
+class IndexPipeline:
+    """Streaming pipeline that embeds and stores transcripts.
+
+    Stages run in their own threads and are connected by bounded queues:
+    chunk (chunk_transcript) -> batch (fills batches of EMBEDDING_BATCH_SIZE
+    chunks across transcript boundaries) -> embed (embed_workers concurrent
+    embedding requests) -> upsert (bulk upsert with precomputed embeddings into
+    the vector store, and into the keyword index).
+    The caller is the load stage and feeds transcripts with add(). Once every
+    chunk of a transcript is stored, its stale tail is deleted and it is recorded
+    in the index manifest and passed to on_indexed. A transcript with a failed
+    batch is not recorded, so the next run indexes it again.
+    """
+    def __init__(self, store, manifest, index_manifest, embedding_function, embed_workers=EMBED_WORKERS, keyword_index=None, on_indexed=None):
+        self.store = store
+        self.on_indexed = on_indexed
+        self.keyword_index = keyword_index
+        self.manifest = manifest
+        self.index_manifest = index_manifest
+        self.embedding_function = embedding_function
+        self.embed_workers = embed_workers
+        self.documents = queue.Queue(maxsize=DOCUMENT_QUEUE_SIZE)
+        self.chunks = queue.Queue(maxsize=DOCUMENT_QUEUE_SIZE)
+        self.batches = queue.Queue(maxsize=2 * embed_workers)
+        self.embedded = queue.Queue(maxsize=2 * embed_workers)
+        # Transcripts being indexed: key -> [remaining chunks, failed, document]
+        self.pending = {}
+        self.lock = threading.Lock()
+        self.threads = [threading.Thread(target=self._chunk), threading.Thread(target=self._batch), threading.Thread(target=self._upsert)]
+        self.threads += [threading.Thread(target=self._embed) for _ in range(embed_workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def add(self, podcast_name, source, transcript, content_hash, previous_chunk_count, metadata=None):
+        """Queues a transcript, blocks while the pipeline is full.
+
+        metadata holds the episode metadata stored with every chunk of the transcript.
+        """
+        self.documents.put({
+            "podcast": podcast_name,
+            "source": source,
+            "transcript": transcript,
+            "content_hash": content_hash,
+            "previous_chunk_count": previous_chunk_count,
+            "metadata": metadata or {},
+        })
+
+    def close(self):
+        """Waits until every queued transcript is processed."""
+        self.documents.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    # Every stage forwards its end sentinels in a finally block, so close() returns even if a stage fails
+
+    def _chunk(self):
+        try:
+            while True:
+                document = self.documents.get()
+                if document is None:
+                    return
+                key = (document["podcast"], document["source"])
+                try:
+                    with metrics.span("index.chunk"):
+                        chunks = chunk_transcript(document.pop("transcript"))
+                    records = [(key, f"{document['source']}_chunk_{i}", chunk["text"], get_chunk_metadata(document, i, chunk))
+                               for i, chunk in enumerate(chunks)]
+                except Exception as e:
+                    # The transcript is not recorded, so the next run indexes it again
+                    print(f"Error chunking {document['source']}, it will be retried on the next run: {e}")
+                    continue
+                document["chunk_count"] = len(chunks)
+                with self.lock:
+                    self.pending[key] = [len(chunks), False, document]
+                if not chunks:
+                    self._finish(key)
+                    continue
+                self.chunks.put(records)
+        finally:
+            self.chunks.put(None)
+
+    def _batch(self):
+        try:
+            batch = []
+            while True:
+                records = self.chunks.get()
+                if records is None:
+                    break
+                for record in records:
+                    batch.append(record)
+                    if len(batch) == EMBEDDING_BATCH_SIZE:
+                        self.batches.put(batch)
+                        batch = []
+            if batch:
+                self.batches.put(batch)
+        finally:
+            for _ in range(self.embed_workers):
+                self.batches.put(None)
+
+    def _embed(self):
+        try:
+            while True:
+                batch = self.batches.get()
+                if batch is None:
+                    return
+                try:
+                    with metrics.span("index.embed"):
+                        embeddings = self.embedding_function([record[2] for record in batch])
+                    metrics.count("embeddings", len(batch))
+                except Exception as e:
+                    print(f"Error generating embeddings for {batch[0][1]} to {batch[-1][1]}: {e}")
+                    embeddings = None
+                self.embedded.put((batch, embeddings))
+        finally:
+            self.embedded.put(None)
+
+    def _upsert(self):
+        finished_workers = 0
+        while finished_workers < self.embed_workers:
+            item = self.embedded.get()
+            if item is None:
+                finished_workers += 1
+                continue
+            batch, embeddings = item
+            if embeddings is not None:
+                try:
+                    ids = [record[1] for record in batch]
+                    documents = [record[2] for record in batch]
+                    metadatas = [record[3] for record in batch]
+                    with metrics.span("index.upsert"):
+                        self.store.upsert(ids, embeddings, documents, metadatas)
+                    if self.keyword_index is not None:
+                        with metrics.span("index.keyword_upsert"):
+                            self.keyword_index.upsert(ids, documents, metadatas)
+                    print(f"Indexed embeddings for {batch[0][1]} to {batch[-1][1]}")
+                except Exception as e:
+                    print(f"Error storing embeddings for {batch[0][1]} to {batch[-1][1]}: {e}")
+                    embeddings = None
+            for record in batch:
+                with self.lock:
+                    state = self.pending[record[0]]
+                    state[0] -= 1
+                    state[1] = state[1] or embeddings is None
+                    done = state[0] == 0
+                if done:
+                    self._finish(record[0])
+
+    def _finish(self, key):
+        with self.lock:
+            _, failed, document = self.pending.pop(key)
+        if failed:
+            print(f"Indexing of {document['source']} failed, it will be retried on the next run")
+            return
+        try:
+            # A regenerated transcript can have fewer chunks, its stale tail is removed
+            delete_chunks(self.store, get_chunk_ids(document["source"], document["chunk_count"], document["previous_chunk_count"]),
+                          self.keyword_index)
+            self.index_manifest.record(document["podcast"], document["source"], document["content_hash"], document["chunk_count"])
+            # Transcript names are "<audio filename>.transcript"
+            self.manifest.mark_by_filename(document["podcast"], document["source"][:-len(".transcript")], "indexed")
+            if self.on_indexed:
+                self.on_indexed(document)
+        except Exception as e:
+            print(f"Error finishing the index of {document['source']}: {e}")
+
+def index_transcript(embed_workers=EMBED_WORKERS, rebuild_keywords=False):
+    # Chunks embedded before, even into another collection, are served from the embedding cache
+    embedding_function = get_cached_embedding_function()
+    store = get_vector_store(embedding_function=embedding_function)
     
     podcasts = read_podcast_list(CONFIG["podcast_list_file"])
     if not podcasts:
         return
 
-    for podcast in podcasts:
-        print(f"Indexing podcast (Incremental Mode): {podcast['podcast_name']}")
-        safe_podcast_name = get_safe_podcast_name(podcast['podcast_name'])
-        podcast_directory = CONFIG["transcript_directory"] + "/" + safe_podcast_name
-        raw_transcripts = load_podcast_transcripts(podcast_directory)
+    keyword_index = KeywordIndex()
+    # Set when the index changes, query.py then drops its cached results
+    changed = False
+    if rebuild_keywords or (keyword_index.count() == 0 and store.count() > 0):
+        # Chunks indexed before the keyword index existed are added from the vector store
+        rebuild_keyword_index(store, keyword_index)
+        changed = True
 
-        all_documents = []
-        all_metadatas = []
-        all_ids = []
+    manifest = EpisodeManifest()
+    index_manifest = IndexManifest()
+    pipeline = IndexPipeline(store, manifest, index_manifest, embedding_function, embed_workers, keyword_index)
 
-        for podcast_name, transcript in raw_transcripts.items():
-            if (len(collection.get(ids=[f"{podcast_name}_chunk_0"])["ids"]) > 0):
-                print(f"Skipping {podcast_name}")
-                continue
-            chunks = chunk_text_by_tokens(transcript)
-            for i, chunk in enumerate(chunks):
-                all_documents.append(chunk)
-                all_metadatas.append({"source": podcast_name, "chunk": i})
-                all_ids.append(f"{podcast_name}_chunk_{i}")
-    
-            # Generate and add embeddings in batches
-            for i in range(0, len(all_documents), EMBEDDING_BATCH_SIZE):
-                batch_documents = all_documents[i : i + EMBEDDING_BATCH_SIZE]
-                batch_metadatas = all_metadatas[i : i + EMBEDDING_BATCH_SIZE]
-                batch_ids = all_ids[i : i + EMBEDDING_BATCH_SIZE]
-        
-                #embeddings = generate_embeddings_batch(batch_documents)
-                #print(len(embeddings))
-                #print(len(embeddings[18]))
-        
-                #if embeddings:
-                collection.add(
-                    #embeddings=embeddings,
-                    documents=batch_documents,
-                    metadatas=batch_metadatas,
-                    ids=batch_ids
-                )
-                print(f"Indexed embeddings for documents {i} to {i + len(batch_documents) - 1}")
-                # else:
-                #     print(f"Error generating embeddings for documents {i} to {i + len(batch_documents) - 1}")
-
-index_transcript()
\ No newline at end of file
+    try:
+        for podcast in podcasts:
+            print(f"Indexing podcast (Incremental Mode): {podcast['podcast_name']}")
+            safe_podcast_name = get_safe_podcast_name(podcast['podcast_name'])
+            podcast_directory = CONFIG["transcript_directory"] + "/" + safe_podcast_name
+            transcript_files = list_podcast_transcripts(podcast_directory)
+            episodes = {episode["filename"]: episode for episode in manifest.episodes(safe_podcast_name) if episode["filename"]}
+
+            # One query tells new, changed and deleted transcripts apart
+            indexed = index_manifest.documents(safe_podcast_name)
+            adopt_unrecorded_transcripts(store, index_manifest, safe_podcast_name, transcript_files, indexed)
+
+            for source, (content_hash, chunk_count) in indexed.items():
+                if source not in transcript_files:
+                    print(f"Removing deleted transcript {source}")
+                    delete_chunks(store, get_chunk_ids(source, 0, chunk_count), keyword_index)
+                    index_manifest.remove(safe_podcast_name, source)
+                    changed = True
+
+            # Transcripts are read one at a time and streamed into the pipeline
+            for source, filepath in sorted(transcript_files.items()):
+                transcript = read_transcript(filepath)
+                content_hash = get_content_hash(transcript)
+                previous_hash, previous_chunk_count = indexed.get(source, (None, 0))
+                if content_hash == previous_hash:
+                    print(f"Skipping {source}")
+                    manifest.mark_by_filename(safe_podcast_name, source[:-len(".transcript")], "indexed")
+                    continue
+                episode = episodes.get(source[:-len(".transcript")])
+                pipeline.add(safe_podcast_name, source, transcript, content_hash, previous_chunk_count,
+                             get_episode_metadata(podcast, episode))
+                changed = True
+    finally:
+        pipeline.close()
+        if changed:
+            bump_index_generation()
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Chunk and index podcast transcripts")
+    parser.add_argument('--embed-workers',
+                        type=positive_int,
+                        default=EMBED_WORKERS,
+                        help='Number of concurrent embedding requests')
+    parser.add_argument('--rebuild-keyword-index',
+                        action='store_true',
+                        help='Rebuild the keyword index from the vector store')
+    metrics.add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.profile:
+        metrics.enable_profile()
+    index_transcript(embed_workers=args.embed_workers, rebuild_keywords=args.rebuild_keyword_index)
@@ -0,0 +1,124 @@
+import os
+import re
+import sqlite3
+import threading
+from util import *
+
+# Chinese, Japanese and Korean characters. Runs of them have no word boundaries and are indexed as bigrams.
+CJK_CHARS = r"\u3040-\u30ff\u3400-\u4dbf\u4e00-\u9fff\uac00-\ud7af\uf900-\ufaff"
+CJK_RE = re.compile(rf"[{CJK_CHARS}]+")
+TERM_RE = re.compile(rf"[{CJK_CHARS}]+|(?:(?![{CJK_CHARS}])[^\W_])+")
+
+# Terms used from a query at most, long questions don't need more to find matching chunks
+MAX_QUERY_TERMS = 64
+
+COLUMNS = ("terms", "id", "podcast", "source", "language", "pub_ts")
+
+SCHEMA = """
+CREATE VIRTUAL TABLE IF NOT EXISTS chunks USING fts5(
+    terms,
+    id UNINDEXED,
+    podcast UNINDEXED,
+    source UNINDEXED,
+    language UNINDEXED,
+    pub_ts UNINDEXED,
+    tokenize = 'unicode61 remove_diacritics 0'
+);
+"""
+
+def tokenize(text):
+    """Splits text into index terms: lowercase words, and the character bigrams of CJK runs.
+
+    A CJK run of a single character is kept as a unigram, so single-character
+    queries still match.
+    """
+    terms = []
+    for match in TERM_RE.finditer(text.lower()):
+        term = match.group()
+        if CJK_RE.fullmatch(term):
+            if len(term) == 1:
+                terms.append(term)
+            else:
+                terms.extend(term[i : i + 2] for i in range(len(term) - 1))
+        else:
+            terms.append(term)
+    return terms
+
+class KeywordIndex:
+    """BM25 keyword index of the chunks, stored next to the vector store.
+
+    Chunks are tokenized with tokenize() and stored as space-separated terms in
+    an SQLite FTS5 table, whose inverted index and bm25() ranking do the search.
+    Chunk ids are the same as in the vector store, so hits can be fused with
+    vector hits and their documents fetched from the vector store.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename or CONFIG["keyword_index_file"]
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            columns = tuple(row[1] for row in self.conn.execute("PRAGMA table_info(chunks)"))
+            if columns and columns != COLUMNS:
+                # FTS5 tables can't be altered. The table is recreated empty, and index.py refills it.
+                self.conn.execute("DROP TABLE chunks")
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def upsert(self, ids, documents, metadatas):
+        rows = [(" ".join(tokenize(document)), chunk_id, metadata.get("podcast"), metadata.get("source"),
+                 metadata.get("language"), metadata.get("pub_ts"))
+                for chunk_id, document, metadata in zip(ids, documents, metadatas)]
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM chunks WHERE id = ?", [(chunk_id,) for chunk_id in ids])
+            self.conn.executemany(f"INSERT INTO chunks ({', '.join(COLUMNS)}) VALUES ({', '.join('?' * len(COLUMNS))})", rows)
+
+    def delete(self, ids):
+        with self.lock, self.conn:
+            self.conn.executemany("DELETE FROM chunks WHERE id = ?", [(chunk_id,) for chunk_id in ids])
+
+    def search(self, query, top_k, filters=None):
+        """Returns the (id, score) of the top_k chunks by BM25 score, best first.
+
+        filters optionally restricts the search to a list of "podcasts", a
+        "language", and chunks published "after" and "before" Unix timestamps.
+        """
+        terms = list(dict.fromkeys(tokenize(query)))[:MAX_QUERY_TERMS]
+        if not terms:
+            return []
+        # Terms only contain letters and digits, so quoting them is enough to escape them
+        clauses = ["chunks MATCH ?"]
+        params = [" OR ".join(f'"{term}"' for term in terms)]
+        filters = filters or {}
+        if filters.get("podcasts"):
+            clauses.append(f"podcast IN ({', '.join('?' * len(filters['podcasts']))})")
+            params.extend(filters["podcasts"])
+        if filters.get("language"):
+            clauses.append("language = ?")
+            params.append(filters["language"])
+        if filters.get("after") is not None:
+            clauses.append("pub_ts >= ?")
+            params.append(filters["after"])
+        if filters.get("before") is not None:
+            clauses.append("pub_ts < ?")
+            params.append(filters["before"])
+        with self.lock:
+            rows = self.conn.execute(f"SELECT id, bm25(chunks) FROM chunks WHERE {' AND '.join(clauses)} ORDER BY bm25(chunks) LIMIT ?",
+                                     params + [top_k]).fetchall()
+        # bm25() is negative, lower is better
+        return [(chunk_id, -score) for chunk_id, score in rows]
+
+def rebuild_keyword_index(store, keyword_index, batch_size=1000):
+    """Fills the keyword index with every chunk of the vector store."""
+    count = 0
+    for results in store.scan(batch_size):
+        keyword_index.upsert(results["ids"], results["documents"], results["metadatas"])
+        count += len(results["ids"])
+    print(f"Keyword index rebuilt with {count} chunks")
@@ -0,0 +1,114 @@
+import os
+import json
+import hashlib
+import sqlite3
+import threading
+import time
+from util import *
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS responses (
+    key TEXT PRIMARY KEY,
+    response TEXT NOT NULL,
+    size INTEGER NOT NULL,
+    created_at REAL NOT NULL,
+    accessed_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS responses_accessed_at ON responses (accessed_at);
+"""
+
+def make_cache_key(prompt, file_hash=None, model_name=MODEL_NAME, generation_config=GENERATION_CONFIG):
+    """Returns the cache key of a request: a sha256 of model name, generation config, prompt and attached file hash."""
+    payload = json.dumps([model_name, generation_config, prompt, file_hash], sort_keys=True, ensure_ascii=False)
+    return hashlib.sha256(payload.encode("utf-8")).hexdigest()
+
+class ResponseCache:
+    """Persistent content-addressed cache of LLM responses.
+
+    Responses are stored in SQLite under make_cache_key(). Entries older than
+    ttl_hours are treated as missing, and once the cached responses exceed
+    max_bytes the least recently used ones are evicted.
+    """
+    def __init__(self, filename=None, max_bytes=None, ttl_hours=None, enabled=True):
+        self.filename = filename or CONFIG["llm_cache_file"]
+        self.max_bytes = max_bytes or CONFIG["llm_cache_max_bytes"]
+        self.ttl_seconds = (ttl_hours or CONFIG["llm_cache_ttl_hours"]) * 3600
+        self.enabled = enabled
+        self.lock = threading.Lock()
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        self.conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+            self.total_bytes = self.conn.execute("SELECT COALESCE(SUM(size), 0) FROM responses").fetchone()[0]
+
+    def get(self, key):
+        if not self.enabled:
+            return None
+        now = time.time()
+        with self.lock, self.conn:
+            row = self.conn.execute("SELECT response, size, created_at FROM responses WHERE key = ?", (key,)).fetchone()
+            if row is None:
+                return None
+            response, size, created_at = row
+            if now - created_at > self.ttl_seconds:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                return None
+            self.conn.execute("UPDATE responses SET accessed_at = ? WHERE key = ?", (now, key))
+        return response
+
+    def put(self, key, response):
+        if not self.enabled or not response:
+            return
+        now = time.time()
+        size = len(response.encode("utf-8"))
+        with self.lock, self.conn:
+            old = self.conn.execute("SELECT size FROM responses WHERE key = ?", (key,)).fetchone()
+            self.conn.execute("INSERT OR REPLACE INTO responses (key, response, size, created_at, accessed_at) VALUES (?, ?, ?, ?, ?)",
+                              (key, response, size, now, now))
+            self.total_bytes += size - (old[0] if old else 0)
+            self._evict()
+
+    def _evict(self):
+        # Must be called with self.lock held, inside a transaction
+        while self.total_bytes > self.max_bytes:
+            rows = self.conn.execute("SELECT key, size FROM responses ORDER BY accessed_at LIMIT 100").fetchall()
+            if not rows:
+                self.total_bytes = 0
+                return
+            for key, size in rows:
+                self.conn.execute("DELETE FROM responses WHERE key = ?", (key,))
+                self.total_bytes -= size
+                if self.total_bytes <= self.max_bytes:
+                    return
+
+    def get_or_generate(self, prompt, generate, file_hash=None):
+        """Returns the cached response of a request, or calls generate() and caches its result.
+
+        Args:
+            prompt: The prompt text, or a list of texts for multi-turn requests.
+            generate: Function without arguments returning the response text.
+            file_hash: Content hash of a file attached to the request, if any.
+        """
+        key = make_cache_key(prompt, file_hash)
+        response = self.get(key)
+        if response is not None:
+            return response
+        response = generate()
+        self.put(key, response)
+        return response
+
+response_cache = None
+response_cache_lock = threading.Lock()
+
+def get_response_cache():
+    """Returns the shared ResponseCache. Setting PODCAST_RAG_NO_LLM_CACHE=1 bypasses it."""
+    global response_cache
+    with response_cache_lock:
+        if response_cache is None:
+            response_cache = ResponseCache(enabled=os.environ.get("PODCAST_RAG_NO_LLM_CACHE") != "1")
+        return response_cache
+
+def disable_response_cache():
+    get_response_cache().enabled = False
@@ -0,0 +1,242 @@
+import os
+import json
+import sqlite3
+import threading
+import time
+import argparse
+from util import *
+
+# Processing stages of an episode, in pipeline order
+STAGES = ("downloaded", "uploaded", "transcribed", "summarized", "indexed")
+
+# Stage that has to be completed before an episode needs work in a stage
+STAGE_REQUIRES = {
+    "downloaded": None,
+    "uploaded": "downloaded",
+    "transcribed": "downloaded",
+    "summarized": "transcribed",
+    "indexed": "transcribed",
+}
+
+EPISODE_FIELDS = ("title", "link", "description", "pubDate", "enclosure_url", "enclosure_type", "guid")
+
+SCHEMA = """
+CREATE TABLE IF NOT EXISTS episodes (
+    podcast TEXT NOT NULL,
+    guid TEXT NOT NULL,
+    title TEXT,
+    link TEXT,
+    description TEXT,
+    pubDate TEXT,
+    pub_ts REAL,
+    enclosure_url TEXT,
+    enclosure_type TEXT,
+    filename TEXT,
+    filesize INTEGER,
+    downloaded_at REAL,
+    uploaded_at REAL,
+    transcribed_at REAL,
+    summarized_at REAL,
+    indexed_at REAL,
+    PRIMARY KEY (podcast, guid)
+);
+CREATE INDEX IF NOT EXISTS episodes_filename ON episodes (podcast, filename);
+CREATE TABLE IF NOT EXISTS index_documents (
+    podcast TEXT NOT NULL,
+    source TEXT NOT NULL,
+    content_hash TEXT NOT NULL,
+    chunk_count INTEGER NOT NULL,
+    indexed_at REAL NOT NULL,
+    PRIMARY KEY (podcast, source)
+);
+"""
+
+def get_pub_timestamp(pub_date_str):
+    pub_date = parse_pub_date(pub_date_str) if pub_date_str else None
+    return pub_date.timestamp() if pub_date else None
+
+class EpisodeManifest:
+    """SQLite manifest of all episodes and of their processing state per stage.
+
+    Episodes are keyed by (safe podcast name, guid). Every stage in STAGES has a
+    `<stage>_at` column holding the time the stage completed, or NULL while the
+    episode still needs work, so each script finds its work with an indexed query
+    and updates rows in place. The database runs in WAL mode so the scripts can
+    read and write it concurrently.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename or CONFIG["manifest_file"]
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        created = not os.path.exists(self.filename)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        self.conn.row_factory = sqlite3.Row
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+            for stage in STAGES:
+                self.conn.execute(f"CREATE INDEX IF NOT EXISTS episodes_{stage} ON episodes (podcast, {stage}_at, pub_ts)")
+        if created and os.path.isdir(CONFIG["output_directory"]):
+            # One-time migration of the per-podcast JSON files written by earlier versions
+            import_json_files(self, CONFIG["output_directory"])
+
+    def close(self):
+        self.conn.close()
+
+    def upsert_episodes(self, podcast_name, episodes):
+        """Inserts episodes or updates their metadata. Episodes without a guid are ignored.
+
+        An episode with a non-empty "filename" is also marked as downloaded.
+        """
+        podcast = get_safe_podcast_name(podcast_name)
+        now = time.time()
+        rows = []
+        for episode in episodes:
+            if not episode.get("guid"):
+                continue
+            filename = episode.get("filename") or None
+            rows.append([podcast] + [episode.get(field) for field in EPISODE_FIELDS] + [
+                get_pub_timestamp(episode.get("pubDate")),
+                filename, episode.get("filesize"),
+                now if filename else None])
+        with self.lock, self.conn:
+            self.conn.executemany("""
+                INSERT INTO episodes (podcast, title, link, description, pubDate, enclosure_url, enclosure_type, guid,
+                                      pub_ts, filename, filesize, downloaded_at)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (podcast, guid) DO UPDATE SET
+                    title = excluded.title,
+                    link = excluded.link,
+                    description = excluded.description,
+                    pubDate = excluded.pubDate,
+                    pub_ts = excluded.pub_ts,
+                    enclosure_url = excluded.enclosure_url,
+                    enclosure_type = excluded.enclosure_type,
+                    filename = COALESCE(excluded.filename, filename),
+                    filesize = COALESCE(excluded.filesize, filesize),
+                    downloaded_at = COALESCE(downloaded_at, excluded.downloaded_at)
+            """, rows)
+
+    def known_guids(self, podcast_name):
+        podcast = get_safe_podcast_name(podcast_name)
+        with self.lock:
+            return {row[0] for row in self.conn.execute("SELECT guid FROM episodes WHERE podcast = ?", (podcast,))}
+
+    def episodes(self, podcast_name):
+        """Returns all episodes of a podcast as dicts, oldest first."""
+        podcast = get_safe_podcast_name(podcast_name)
+        with self.lock:
+            rows = self.conn.execute("SELECT * FROM episodes WHERE podcast = ? ORDER BY pub_ts", (podcast,)).fetchall()
+        return [dict(row) for row in rows]
+
+    def pending(self, stage, podcast_name=None, newest_first=False, limit=None):
+        """Returns the episodes that still need work in a stage, as dicts.
+
+        An episode needs work when the stage is not completed but the stage it
+        requires (see STAGE_REQUIRES) is.
+        """
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage: {stage}")
+        clauses = [f"{stage}_at IS NULL"]
+        params = []
+        if STAGE_REQUIRES[stage]:
+            clauses.append(f"{STAGE_REQUIRES[stage]}_at IS NOT NULL")
+        if podcast_name is not None:
+            clauses.append("podcast = ?")
+            params.append(get_safe_podcast_name(podcast_name))
+        query = f"SELECT * FROM episodes WHERE {' AND '.join(clauses)} ORDER BY pub_ts {'DESC' if newest_first else 'ASC'}"
+        if limit:
+            query += f" LIMIT {int(limit)}"
+        with self.lock:
+            rows = self.conn.execute(query, params).fetchall()
+        return [dict(row) for row in rows]
+
+    def mark(self, podcast_name, guid, stage, **fields):
+        """Marks a stage of an episode as completed, optionally updating other columns."""
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage: {stage}")
+        assignments = [f"{stage}_at = ?"] + [f"{field} = ?" for field in fields]
+        params = [time.time()] + list(fields.values()) + [get_safe_podcast_name(podcast_name), guid]
+        with self.lock, self.conn:
+            self.conn.execute(f"UPDATE episodes SET {', '.join(assignments)} WHERE podcast = ? AND guid = ?", params)
+
+    def mark_by_filename(self, podcast_name, filename, stage):
+        """Marks a stage as completed for the episode downloaded as filename."""
+        if stage not in STAGES:
+            raise ValueError(f"Unknown stage: {stage}")
+        with self.lock, self.conn:
+            self.conn.execute(f"UPDATE episodes SET {stage}_at = ? WHERE podcast = ? AND filename = ?",
+                              (time.time(), get_safe_podcast_name(podcast_name), filename))
+
+class IndexManifest:
+    """Records the content hash and chunk count of every transcript in the vector index.
+
+    Stored in the same SQLite database as EpisodeManifest. index.py loads the
+    entries of a podcast with one query to tell new, changed and deleted
+    transcripts apart, and uses the chunk count to find orphaned chunk ids.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename or CONFIG["manifest_file"]
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(self.filename, timeout=30, check_same_thread=False)
+        with self.lock, self.conn:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(SCHEMA)
+
+    def close(self):
+        self.conn.close()
+
+    def documents(self, podcast_name):
+        """Returns {source: (content_hash, chunk_count)} for the indexed transcripts of a podcast."""
+        podcast = get_safe_podcast_name(podcast_name)
+        with self.lock:
+            rows = self.conn.execute("SELECT source, content_hash, chunk_count FROM index_documents WHERE podcast = ?", (podcast,))
+            return {source: (content_hash, chunk_count) for source, content_hash, chunk_count in rows}
+
+    def record(self, podcast_name, source, content_hash, chunk_count):
+        with self.lock, self.conn:
+            self.conn.execute("INSERT OR REPLACE INTO index_documents (podcast, source, content_hash, chunk_count, indexed_at) VALUES (?, ?, ?, ?, ?)",
+                              (get_safe_podcast_name(podcast_name), source, content_hash, chunk_count, time.time()))
+
+    def remove(self, podcast_name, source):
+        with self.lock, self.conn:
+            self.conn.execute("DELETE FROM index_documents WHERE podcast = ? AND source = ?", (get_safe_podcast_name(podcast_name), source))
+
+def import_json_files(manifest, directory):
+    """Imports the per-podcast JSON files of earlier versions into the manifest.
+
+    Episodes whose transcript or summary file already exists are marked as
+    transcribed or summarized.
+    """
+    for json_filename in sorted(os.listdir(directory)):
+        if not json_filename.endswith(".json"):
+            continue
+        podcast = json_filename[:-5]
+        try:
+            with open(os.path.join(directory, json_filename), 'r', encoding='utf-8') as infile:
+                episodes = json.load(infile).get("episodes", [])
+        except Exception as e:
+            print(f"Error importing {json_filename}: {e}")
+            continue
+        manifest.upsert_episodes(podcast, episodes)
+        for episode in episodes:
+            audio_file = episode.get("filename")
+            if not audio_file or not episode.get("guid"):
+                continue
+            transcript_filename = CONFIG["transcript_directory"] + "/" + podcast + "/" + audio_file + ".transcript.txt"
+            summary_filename = CONFIG["summary_directory"] + "/" + podcast + "/" + audio_file + ".summary.txt"
+            if check_file_exists_and_size(transcript_filename, 100):
+                manifest.mark(podcast, episode["guid"], "transcribed")
+            if check_file_exists_and_size(summary_filename, 100):
+                manifest.mark(podcast, episode["guid"], "summarized")
+        print(f"Imported {len(episodes)} episodes from {json_filename}")
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Episode manifest maintenance")
+    parser.add_argument('--import-json',
+                        action='store_true',
+                        help='Import the per-podcast JSON files into the manifest')
+    args = parser.parse_args()
+    if args.import_json:
+        import_json_files(EpisodeManifest(), CONFIG["output_directory"])
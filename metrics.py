@@ -0,0 +1,242 @@
+import os
+import json
+import time
+import atexit
+import bisect
+import threading
+from contextlib import contextmanager
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+
+# Upper bounds in seconds of the duration histogram buckets, from a cache hit to a long transcription
+DURATION_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+METRIC_PREFIX = "podcast_rag_"
+# The --profile report compares the spans against the wall clock time since the start of the process
+PROCESS_START = time.time()
+
+def get_label_key(labels):
+    return tuple(sorted((name, str(value)) for name, value in labels.items()))
+
+def get_metric_name(name):
+    return METRIC_PREFIX + name.replace(".", "_").replace("-", "_")
+
+def format_labels(label_key, extra=()):
+    pairs = list(label_key) + list(extra)
+    if not pairs:
+        return ""
+    values = ",".join(f'{name}="{value}"'.replace("\n", " ") for name, value in pairs)
+    return "{" + values + "}"
+
+class Histogram:
+    def __init__(self, buckets=DURATION_BUCKETS):
+        self.buckets = buckets
+        self.counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.sum = 0.0
+        self.max = 0.0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.count += 1
+        self.sum += value
+        self.max = max(self.max, value)
+
+    def quantile(self, q):
+        """Returns the upper bound of the bucket holding the q quantile."""
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(self.buckets, self.counts):
+            seen += count
+            if seen >= rank:
+                return min(bound, self.max)
+        return self.max
+
+class Metrics:
+    """Timing spans, counters and histograms of one process.
+
+    Aggregates are kept in memory for the Prometheus endpoint and the --profile
+    report. When a log file is set, every span and counter update is also
+    appended to it as a JSON line.
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.counters = {}
+        self.histograms = {}
+        self.log_file = None
+        self.served = False
+        self.started = PROCESS_START
+
+    def set_log_file(self, filename):
+        with self.lock:
+            if self.log_file:
+                self.log_file.close()
+            self.log_file = None
+            if filename:
+                os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+                self.log_file = open(filename, "a", encoding="utf-8", buffering=1)
+
+    def is_enabled(self):
+        """True if the metrics are logged or served, callers can then afford measurements that cost time."""
+        return self.log_file is not None or self.served
+
+    def _log(self, event):
+        # Must be called with self.lock held
+        if self.log_file:
+            event["ts"] = round(time.time(), 6)
+            event["pid"] = os.getpid()
+            self.log_file.write(json.dumps(event, ensure_ascii=False) + "\n")
+
+    def count(self, name, value=1, **labels):
+        key = (name, get_label_key(labels))
+        with self.lock:
+            self.counters[key] = self.counters.get(key, 0) + value
+            self._log({"type": "counter", "name": name, "value": value, "labels": labels})
+
+    def observe(self, name, value, **labels):
+        key = (name, get_label_key(labels))
+        with self.lock:
+            histogram = self.histograms.get(key)
+            if histogram is None:
+                histogram = self.histograms[key] = Histogram()
+            histogram.observe(value)
+            self._log({"type": "span", "name": name, "seconds": round(value, 6), "labels": labels})
+
+    def format_prometheus(self):
+        """Returns the metrics in the Prometheus text exposition format."""
+        lines = []
+        with self.lock:
+            names = sorted({name for name, _ in self.counters})
+            for name in names:
+                metric = get_metric_name(name) + "_total"
+                lines.append(f"# TYPE {metric} counter")
+                for (counter_name, label_key), value in sorted(self.counters.items()):
+                    if counter_name == name:
+                        lines.append(f"{metric}{format_labels(label_key)} {value}")
+            names = sorted({name for name, _ in self.histograms})
+            for name in names:
+                metric = get_metric_name(name) + "_seconds"
+                lines.append(f"# TYPE {metric} histogram")
+                for (histogram_name, label_key), histogram in sorted(self.histograms.items()):
+                    if histogram_name != name:
+                        continue
+                    cumulative = 0
+                    for bound, count in zip(histogram.buckets + ("+Inf",), histogram.counts):
+                        cumulative += count
+                        lines.append(f"{metric}_bucket{format_labels(label_key, [('le', bound)])} {cumulative}")
+                    lines.append(f"{metric}_sum{format_labels(label_key)} {histogram.sum}")
+                    lines.append(f"{metric}_count{format_labels(label_key)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def format_profile(self):
+        """Returns the per-stage breakdown printed by --profile."""
+        elapsed = time.time() - self.started
+        lines = [f"--- Profile: {elapsed:.1f}s wall clock ---",
+                 f"{'span':40s} {'count':>7s} {'total s':>9s} {'mean s':>8s} {'p50 s':>8s} {'p99 s':>8s} {'max s':>8s} {'% wall':>7s}"]
+        with self.lock:
+            totals = {}
+            for (name, label_key), histogram in self.histograms.items():
+                label = name + format_labels(label_key)
+                totals[label] = histogram
+            # Concurrent spans can add up to more than the wall clock time
+            for label, histogram in sorted(totals.items(), key=lambda item: -item[1].sum):
+                lines.append(f"{label[:40]:40s} {histogram.count:7d} {histogram.sum:9.2f} {histogram.sum / histogram.count:8.3f} "
+                             f"{histogram.quantile(0.5):8.3f} {histogram.quantile(0.99):8.3f} {histogram.max:8.3f} "
+                             f"{100 * histogram.sum / elapsed if elapsed > 0 else 0:6.1f}%")
+            if self.counters:
+                lines.append(f"{'counter':60s} {'value':>14s}")
+                for (name, label_key), value in sorted(self.counters.items()):
+                    lines.append(f"{(name + format_labels(label_key))[:60]:60s} {value:14,.0f}")
+            cost = self._estimate_cost()
+        if cost:
+            lines.append(f"Estimated API cost: ${cost:.4f}")
+        return "\n".join(lines)
+
+    def _estimate_cost(self):
+        # Must be called with self.lock held
+        from util import CONFIG
+        prices = CONFIG.get("token_prices_per_million", {})
+        tokens = {}
+        for (name, label_key), value in self.counters.items():
+            if name == "tokens":
+                labels = dict(label_key)
+                price_key = f"{labels.get('api')}_{labels.get('kind')}"
+                tokens[price_key] = tokens.get(price_key, 0) + value
+        return sum(count * prices.get(price_key, 0) / 1e6 for price_key, count in tokens.items())
+
+registry = None
+registry_lock = threading.Lock()
+
+def get_metrics():
+    """Returns the metrics of this process. With CONFIG["metrics_log"] set, they are logged from the start."""
+    global registry
+    with registry_lock:
+        if registry is None:
+            from util import CONFIG
+            registry = Metrics()
+            if CONFIG.get("metrics_log"):
+                registry.set_log_file(CONFIG["metrics_file"])
+        return registry
+
+def is_enabled():
+    return get_metrics().is_enabled()
+
+def count(name, value=1, **labels):
+    """Adds value to a counter, e.g. count("api_calls", api="gemini", op="summarize")."""
+    get_metrics().count(name, value, **labels)
+
+def observe(name, seconds, **labels):
+    """Records a duration in seconds into a histogram."""
+    get_metrics().observe(name, seconds, **labels)
+
+@contextmanager
+def span(name, **labels):
+    """Times the enclosed block into the name histogram. Failed blocks get an error label."""
+    start = time.perf_counter()
+    try:
+        yield
+    except BaseException:
+        observe(name, time.perf_counter() - start, error="true", **labels)
+        raise
+    observe(name, time.perf_counter() - start, **labels)
+
+def count_usage(response, api, op):
+    """Counts the prompt and output tokens reported in the usage metadata of a Gemini response."""
+    usage = getattr(response, "usage_metadata", None)
+    if usage is None:
+        return
+    count("tokens", getattr(usage, "prompt_token_count", 0) or 0, api=api, op=op, kind="input")
+    count("tokens", getattr(usage, "candidates_token_count", 0) or 0, api=api, op=op, kind="output")
+
+class MetricsHandler(BaseHTTPRequestHandler):
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        if self.path.split("?")[0] != "/metrics":
+            self.send_error(404)
+            return
+        body = get_metrics().format_prometheus().encode("utf-8")
+        self.send_response(200)
+        self.send_header("Content-Type", "text/plain; version=0.0.4; charset=utf-8")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+def start_metrics_server(port, host="0.0.0.0"):
+    """Serves the metrics at http://host:port/metrics from a daemon thread."""
+    server = ThreadingHTTPServer((host, port), MetricsHandler)
+    server.daemon_threads = True
+    get_metrics().served = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    print(f"Serving metrics at http://{host}:{server.server_address[1]}/metrics")
+    return server
+
+def add_profile_argument(parser):
+    parser.add_argument('--profile',
+                        action='store_true',
+                        help='Log spans and counters as JSON lines and print a per-stage breakdown at exit')
+
+def enable_profile(log_file=None):
+    """Starts the JSON lines log, CONFIG["metrics_file"] by default, and prints the breakdown at exit."""
+    from util import CONFIG
+    get_metrics().set_log_file(log_file or CONFIG["metrics_file"])
+    atexit.register(lambda: print(get_metrics().format_profile()))
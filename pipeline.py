@@ -0,0 +1,292 @@
+import os
+import time
+import queue
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor, wait
+from util import *
+from manifest import EpisodeManifest, IndexManifest, get_pub_timestamp
+from download import DownloadEngine, FeedCache, find_incremental_episodes, HOST_DELAY_SECONDS
+from transcribe import transcript_episode, SEGMENT_OVERLAP_SECONDS
+from summarize import summarize_episode
+from index import (IndexPipeline, EMBED_WORKERS, get_content_hash, read_transcript, adopt_unrecorded_transcripts,
+                   get_episode_metadata)
+from embedding_cache import get_cached_embedding_function
+from keyword_index import KeywordIndex, rebuild_keyword_index
+from query_cache import bump_index_generation
+from vector_store import get_vector_store
+from llm_cache import disable_response_cache
+from google.api_core.exceptions import ResourceExhausted
+
+# Episodes waiting between two stages. A full queue blocks the stage before it,
+# so a fast download stage can't run far ahead of transcription.
+STAGE_QUEUE_SIZE = 8
+MAX_QUOTA_ATTEMPTS = 5
+
+class Stage:
+    """Worker threads processing the items of a bounded queue with a handler.
+
+    Errors of an item are printed and don't stop the stage. close() waits
+    until every queued item is processed.
+    """
+    def __init__(self, name, handler, workers, queue_size=STAGE_QUEUE_SIZE):
+        self.name = name
+        self.handler = handler
+        self.queue = queue.Queue(maxsize=queue_size)
+        self.lock = threading.Lock()
+        self.processed = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self.threads = [threading.Thread(target=self._work, name=f"{name}-{i}") for i in range(workers)]
+        for thread in self.threads:
+            thread.start()
+
+    def put(self, item):
+        """Queues an item, blocks while the stage is full."""
+        self.queue.put(item)
+
+    def close(self):
+        for _ in self.threads:
+            self.queue.put(None)
+        for thread in self.threads:
+            thread.join()
+
+    def _work(self):
+        while True:
+            item = self.queue.get()
+            if item is None:
+                return
+            start = time.monotonic()
+            failed = False
+            try:
+                self.handler(*item)
+            except Exception as e:
+                failed = True
+                print(f"Error in {self.name} stage: {e}")
+            seconds = time.monotonic() - start
+            metrics.observe(f"pipeline.{self.name}", seconds, **({"error": "true"} if failed else {}))
+            with self.lock:
+                self.processed += 1
+                self.failed += failed
+                self.busy_seconds += seconds
+
+    def report(self, elapsed):
+        utilization = self.busy_seconds / (elapsed * len(self.threads)) if elapsed > 0 else 0
+        print(f"{self.name:12s} {self.processed:6d} episodes  {self.failed:4d} failed  busy {self.busy_seconds:8.1f}s  "
+              f"{len(self.threads):3d} workers  {utilization:6.1%} utilized")
+
+class EpisodePipeline:
+    """Moves every episode through the processing stages as soon as the previous stage is done with it.
+
+    download (DownloadEngine) -> transcribe -> summarize and index in parallel.
+
+    Each stage has its own workers and takes episodes from a bounded queue, so
+    the stages overlap and a run takes about as long as its slowest stage. The
+    transcribe and summarize stages share one Gemini RateLimiter. The index
+    stage feeds an IndexPipeline, and the index generation is bumped after each
+    indexed episode so query.py serves it right away.
+
+    Work left over from earlier runs (downloaded but not transcribed, or
+    transcribed but not summarized or indexed) is queued at start, while the
+    feeds are fetched. Removing the chunks of deleted transcripts is left to
+    index.py.
+    """
+    def __init__(self, podcasts, download_workers=4, per_host=1, host_delay=HOST_DELAY_SECONDS, transcribe_workers=4,
+                 summarize_workers=4, embed_workers=EMBED_WORKERS, rpm=None, tpm=None, segment_seconds=0,
+                 overlap_seconds=SEGMENT_OVERLAP_SECONDS, queue_size=STAGE_QUEUE_SIZE):
+        self.podcasts = {get_safe_podcast_name(podcast["podcast_name"]): podcast for podcast in podcasts}
+        self.manifest = EpisodeManifest()
+        self.index_manifest = IndexManifest()
+        self.feed_cache = FeedCache()
+        self.limiter = RateLimiter(rpm=rpm, tpm=tpm)
+        self.segment_seconds = segment_seconds
+        self.overlap_seconds = overlap_seconds
+        self.download_workers = download_workers
+
+        embedding_function = get_cached_embedding_function()
+        self.store = get_vector_store(embedding_function=embedding_function)
+        self.keyword_index = KeywordIndex()
+        if self.keyword_index.count() == 0 and self.store.count() > 0:
+            rebuild_keyword_index(self.store, self.keyword_index)
+            bump_index_generation()
+        self.index_pipeline = IndexPipeline(self.store, self.manifest, self.index_manifest, embedding_function, embed_workers,
+                                            self.keyword_index, on_indexed=lambda document: bump_index_generation())
+
+        self.engine = DownloadEngine(workers=download_workers, per_host=per_host, host_delay=host_delay)
+        self.transcribe_stage = Stage("transcribe", self._transcribe, transcribe_workers, queue_size)
+        self.summarize_stage = Stage("summarize", self._summarize, summarize_workers, queue_size)
+        # The IndexPipeline embeds concurrently, one thread is enough to feed it
+        self.index_stage = Stage("index", self._index, 1, queue_size)
+
+    def _downloaded(self, future, podcast):
+        # Runs on a download thread, which waits here while the transcribe stage is full
+        try:
+            episode = future.result()
+        except Exception as e:
+            print(f"Error downloading episode for {podcast['podcast_name']}: {e}")
+            return
+        if not episode.get("filename"):
+            return
+        self.manifest.upsert_episodes(podcast["podcast_name"], [episode])
+        episode.setdefault("pub_ts", get_pub_timestamp(episode.get("pubDate")))
+        self.transcribe_stage.put((episode, podcast))
+
+    def _discover(self, podcast, download_futures):
+        print(f"Processing podcast (Pipeline Mode): {podcast['podcast_name']}")
+        episodes, feed_cache_entry = find_incremental_episodes(podcast, self.manifest, self.feed_cache)
+        futures = []
+        for episode in episodes:
+            future = self.engine.submit(episode, podcast["podcast_name"])
+            future.add_done_callback(lambda future, podcast=podcast: self._downloaded(future, podcast))
+            futures.append(future)
+        download_futures.append((podcast, futures, feed_cache_entry))
+
+    def _transcribe(self, episode, podcast):
+        for attempt in range(MAX_QUOTA_ATTEMPTS):
+            try:
+                transcribed = transcript_episode(episode, podcast["podcast_name"], podcast["language"], self.manifest, self.limiter,
+                                                 self.segment_seconds, self.overlap_seconds)
+                break
+            except ResourceExhausted as e:
+                pause = self.limiter.backoff()
+                print(f"Quota limit reached for {episode['title']} (Attempt {attempt + 1}), pausing {pause:.0f}s: {e}")
+        else:
+            print(f"Giving up on {episode['title']} after {MAX_QUOTA_ATTEMPTS} quota errors")
+            return
+        if transcribed:
+            self.summarize_stage.put((episode, podcast))
+            self.index_stage.put((episode, podcast))
+
+    def _summarize(self, episode, podcast):
+        safe_podcast_name = get_safe_podcast_name(podcast["podcast_name"])
+        if summarize_episode(episode, safe_podcast_name, podcast["language"], self.limiter):
+            self.manifest.mark(safe_podcast_name, episode["guid"], "summarized")
+
+    def _index(self, episode, podcast):
+        safe_podcast_name = get_safe_podcast_name(podcast["podcast_name"])
+        source = episode["filename"] + ".transcript"
+        filepath = CONFIG["transcript_directory"] + "/" + safe_podcast_name + "/" + source + ".txt"
+        indexed = self.index_manifest.documents(safe_podcast_name)
+        adopt_unrecorded_transcripts(self.store, self.index_manifest, safe_podcast_name, {source: filepath}, indexed)
+        transcript = read_transcript(filepath)
+        content_hash = get_content_hash(transcript)
+        previous_hash, previous_chunk_count = indexed.get(source, (None, 0))
+        if content_hash == previous_hash:
+            self.manifest.mark(safe_podcast_name, episode["guid"], "indexed")
+            return
+        self.index_pipeline.add(safe_podcast_name, source, transcript, content_hash, previous_chunk_count,
+                                get_episode_metadata(podcast, episode))
+
+    def get_pending(self):
+        """Returns the (stage, episode, podcast) jobs an earlier run left between stages."""
+        jobs = []
+        for safe_podcast_name, podcast in self.podcasts.items():
+            jobs += [(self.summarize_stage, episode, podcast) for episode in self.manifest.pending("summarized", safe_podcast_name)]
+            jobs += [(self.index_stage, episode, podcast) for episode in self.manifest.pending("indexed", safe_podcast_name)]
+            jobs += [(self.transcribe_stage, episode, podcast) for episode in self.manifest.pending("transcribed", safe_podcast_name, newest_first=True)
+                     if episode.get("filename")]
+        return jobs
+
+    def run(self, download=True):
+        start = time.monotonic()
+        # Taken before any download, so episodes downloaded by this run aren't queued twice
+        pending = self.get_pending()
+        download_futures = []
+        try:
+            with ThreadPoolExecutor(max_workers=self.download_workers) as feed_executor:
+                feeds = [feed_executor.submit(self._discover, podcast, download_futures) for podcast in self.podcasts.values()] if download else []
+                # Leftover work runs while the feeds are fetched
+                for stage, episode, podcast in pending:
+                    stage.put((episode, podcast))
+                for future in feeds:
+                    if future.exception():
+                        print(f"Error processing podcast feed: {future.exception()}")
+            for podcast, futures, feed_cache_entry in download_futures:
+                wait(futures)
+                if feed_cache_entry:
+                    self.feed_cache.update(podcast["rss_url"], feed_cache_entry)
+        finally:
+            # Each stage is closed after the stages feeding it
+            self.engine.close()
+            self.transcribe_stage.close()
+            self.summarize_stage.close()
+            self.index_stage.close()
+            self.index_pipeline.close()
+        elapsed = time.monotonic() - start
+        print(f"Pipeline finished in {elapsed:.1f}s")
+        for stage in (self.transcribe_stage, self.summarize_stage, self.index_stage):
+            stage.report(elapsed)
+
+def run_pipeline(download_workers=4, per_host=1, host_delay=HOST_DELAY_SECONDS, transcribe_workers=4, summarize_workers=4,
+                 embed_workers=EMBED_WORKERS, rpm=CONFIG["gemini_rpm"], tpm=CONFIG["gemini_tpm"], segment_seconds=0,
+                 overlap_seconds=SEGMENT_OVERLAP_SECONDS, queue_size=STAGE_QUEUE_SIZE, download=True):
+    podcasts = read_podcast_list(CONFIG["podcast_list_file"])
+    if not podcasts:
+        return
+    os.makedirs(CONFIG["output_directory"], exist_ok=True)
+    pipeline = EpisodePipeline(podcasts, download_workers, per_host, host_delay, transcribe_workers, summarize_workers,
+                               embed_workers, rpm, tpm, segment_seconds, overlap_seconds, queue_size)
+    pipeline.run(download)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Download, transcribe, summarize and index episodes in one overlapping pipeline")
+    parser.add_argument('--download-workers',
+                        type=positive_int,
+                        default=4,
+                        help='Number of concurrent downloads across all hosts')
+    parser.add_argument('--per-host',
+                        type=positive_int,
+                        default=1,
+                        help='Maximum number of concurrent downloads from the same host')
+    parser.add_argument('--host-delay',
+                        type=float,
+                        default=HOST_DELAY_SECONDS,
+                        help='Minimum number of seconds between two downloads from the same host')
+    parser.add_argument('--transcribe-workers',
+                        type=positive_int,
+                        default=4,
+                        help='Number of episodes transcribed in parallel')
+    parser.add_argument('--summarize-workers',
+                        type=positive_int,
+                        default=4,
+                        help='Number of episodes summarized in parallel')
+    parser.add_argument('--embed-workers',
+                        type=positive_int,
+                        default=EMBED_WORKERS,
+                        help='Number of concurrent embedding requests')
+    parser.add_argument('--rpm',
+                        type=int,
+                        default=CONFIG["gemini_rpm"],
+                        help='Gemini requests per minute shared by transcription and summarization')
+    parser.add_argument('--tpm',
+                        type=int,
+                        default=CONFIG["gemini_tpm"],
+                        help='Gemini tokens per minute shared by transcription and summarization')
+    parser.add_argument('--segment-seconds',
+                        type=int,
+                        default=0,
+                        help='Transcribe episodes as segments of this many seconds in parallel (0 transcribes the whole file)')
+    parser.add_argument('--overlap-seconds',
+                        type=int,
+                        default=SEGMENT_OVERLAP_SECONDS,
+                        help='Overlap between consecutive segments in seconds')
+    parser.add_argument('--queue-size',
+                        type=positive_int,
+                        default=STAGE_QUEUE_SIZE,
+                        help='Episodes waiting between two stages at most')
+    parser.add_argument('--no-download',
+                        action='store_true',
+                        help='Only process episodes left between stages by earlier runs, without fetching feeds')
+    parser.add_argument('--no-llm-cache',
+                        action='store_true',
+                        help='Always call Gemini instead of reusing cached transcriptions and summaries')
+    metrics.add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.profile:
+        metrics.enable_profile()
+    if args.no_llm_cache:
+        disable_response_cache()
+    run_pipeline(download_workers=args.download_workers, per_host=args.per_host, host_delay=args.host_delay,
+                 transcribe_workers=args.transcribe_workers, summarize_workers=args.summarize_workers,
+                 embed_workers=args.embed_workers, rpm=args.rpm, tpm=args.tpm, segment_seconds=args.segment_seconds,
+                 overlap_seconds=args.overlap_seconds, queue_size=args.queue_size, download=not args.no_download)
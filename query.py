@@ -1,58 +1,290 @@
-import gradio as gr
-import chromadb
+import re
+import time
+import asyncio
+import argparse
+import threading
+from datetime import datetime
 from util import *
+from llm_cache import get_response_cache, make_cache_key
+from embedding_cache import get_cached_embedding_function
+from keyword_index import KeywordIndex
+from query_cache import QueryCache, normalize_query
+from context_assembler import assemble_context
+from vector_store import get_vector_store
 
-TOP_K_RETRIEVAL = 30
+# Chunks passed to the model, after fusing the vector and keyword hits
+TOP_K_RETRIEVAL = 10
+# Hits taken from each retriever before fusion
+CANDIDATE_K = 30
+# Reciprocal rank fusion constant, damps the weight of the top ranks
+RRF_K = 60
+# Number of retrieved chunks listed as sources below the answer
+CITATION_COUNT = 5
+
+# Inline filters in a question: podcast:<name> (quoted if it has spaces), lang:<code>, after:<date>, before:<date>
+FILTER_RE = re.compile(r'(?<!\S)(podcast|lang|after|before):(?:"([^"]*)"|(\S+))')
+DATE_FORMATS = ("%Y-%m-%d", "%Y-%m", "%Y")
+
+# Loaded on first use, so importing query.py is cheap and has no side effects
+podcasts = None
+podcasts_lock = threading.Lock()
+
+# Created by init_retrieval() on the first question
+store = None
+keyword_index = None
+query_cache = None
+retrieval_lock = threading.Lock()
+
+def init_retrieval():
+    """Opens the vector store, the keyword index and the query cache once."""
+    global store, keyword_index, query_cache
+    with retrieval_lock:
+        if store is None:
+            embedding_function = get_cached_embedding_function()
+            keyword_index = KeywordIndex()
+            query_cache = QueryCache(embedding_function)
+            store = get_vector_store(embedding_function=embedding_function)
+
+def get_podcasts():
+    """Returns the podcast list, read once from CONFIG["podcast_list_file"]."""
+    global podcasts
+    with podcasts_lock:
+        if podcasts is None:
+            podcasts = read_podcast_list(CONFIG["podcast_list_file"])
+        return podcasts
+
+def parse_date(value):
+    """Returns the Unix timestamp of the start of a YYYY-MM-DD, YYYY-MM or YYYY date, or None."""
+    for fmt in DATE_FORMATS:
+        try:
+            return datetime.strptime(value.strip(), fmt).timestamp()
+        except ValueError:
+            pass
+    if value.strip():
+        print(f"Ignoring invalid date filter: {value}")
+    return None
+
+def resolve_podcast_name(name):
+    """Returns the podcast list name matching name or its safe name, ignoring case, so inline filters can be typed loosely."""
+    for podcast in get_podcasts():
+        if name.lower() in (podcast["podcast_name"].lower(), get_safe_podcast_name(podcast["podcast_name"]).lower()):
+            return podcast["podcast_name"]
+    return name
+
+def get_filters(query, podcast_names=None, language=None, after="", before=""):
+    """Combines the filter controls with the inline filters of the query.
+
+    Returns the query without its inline filters, and a filters dict with the
+    optional keys "podcasts", "language", "after" and "before" (Unix timestamps,
+    "before" being exclusive). Inline filters take precedence, except that
+    podcasts add up.
+    """
+    filters = {}
+    podcast_names = list(podcast_names or [])
+    values = {"lang": language or "", "after": after or "", "before": before or ""}
+    for match in FILTER_RE.finditer(query):
+        value = match.group(2) if match.group(2) is not None else match.group(3)
+        if match.group(1) == "podcast":
+            podcast_names.append(resolve_podcast_name(value))
+        else:
+            values[match.group(1)] = value
+    if podcast_names:
+        filters["podcasts"] = list(dict.fromkeys(podcast_names))
+    if values["lang"]:
+        filters["language"] = values["lang"]
+    for key in ("after", "before"):
+        timestamp = parse_date(values[key]) if values[key] else None
+        if timestamp is not None:
+            filters[key] = timestamp
+    return " ".join(FILTER_RE.sub(" ", query).split()), filters
 
 # --- Retrieval and Generation Functions ---
-def retrieve_relevant_chunks(query, top_k=TOP_K_RETRIEVAL):
+def reciprocal_rank_fusion(rankings, k=RRF_K):
+    """Fuses ranked lists of ids, scoring each id by the sum of 1 / (k + rank) over the lists."""
+    scores = {}
+    for ranking in rankings:
+        for rank, chunk_id in enumerate(ranking):
+            scores[chunk_id] = scores.get(chunk_id, 0) + 1 / (k + rank + 1)
+    return sorted(scores, key=scores.get, reverse=True)
+
+def retrieve_relevant_chunks(query, top_k=TOP_K_RETRIEVAL, candidate_k=CANDIDATE_K, filters=None):
+    """Retrieves chunks by vector similarity and by BM25 keyword match, fused with reciprocal rank fusion.
+
+    filters (see get_filters) restrict both searches, so scoped questions only
+    search the matching chunks.
+
+    Query embeddings and the fused chunk ids are cached, so a repeated question
+    skips the embedding request and both searches. Returns the top_k chunks in
+    the shape of a Chroma query result.
+    """
     print(query)
-    #query_embedding = generate_embeddings_batch([query])
-    #print(query_embedding)
-    results = collection.query(
-        #query_embeddings=query_embedding,
-        query_texts = query,
-        n_results=top_k
-    )
-    #print(results)
-    return results
+    init_retrieval()
+    with metrics.span("query.embed"):
+        embedding = query_cache.get_embedding(query)
+    key = query_cache.result_key(embedding, filters, (top_k, candidate_k))
+    fused_ids = query_cache.get_results(key)
+    metrics.count("query_cache", result="miss" if fused_ids is None else "hit")
+    chunks = {}
+    if fused_ids is None:
+        with metrics.span("query.vector_search"):
+            results = store.query(embedding, candidate_k, filters)
+        vector_ids = results["ids"]
+        with metrics.span("query.keyword_search"):
+            keyword_ids = [chunk_id for chunk_id, _ in keyword_index.search(normalize_query(query), candidate_k, filters)]
+        fused_ids = reciprocal_rank_fusion([vector_ids, keyword_ids])[:top_k]
+        query_cache.put_results(key, fused_ids)
+        chunks = {chunk_id: (document, metadata) for chunk_id, document, metadata in
+                  zip(vector_ids, results["documents"], results["metadatas"])}
+    # Chunks only found by keyword, or all chunks of a cached result, are fetched from the vector store
+    missing = [chunk_id for chunk_id in fused_ids if chunk_id not in chunks]
+    if missing:
+        fetched = store.get(missing)
+        chunks.update({chunk_id: (document, metadata) for chunk_id, document, metadata in
+                       zip(fetched["ids"], fetched["documents"], fetched["metadatas"])})
+    fused_ids = [chunk_id for chunk_id in fused_ids if chunk_id in chunks]
+    return {
+        "ids": [fused_ids],
+        "documents": [[chunks[chunk_id][0] for chunk_id in fused_ids]],
+        "metadatas": [[chunks[chunk_id][1] for chunk_id in fused_ids]],
+    }
+
+def format_citation(metadata):
+    """Returns "podcast《title》(pubDate) 00:12:30-00:15:10 speakers" for the metadata of a chunk."""
+    metadata = metadata or {}
+    citation = metadata.get("podcast", "")
+    citation += f"《{metadata.get('title') or metadata.get('source', '')}》"
+    if metadata.get("pubDate"):
+        citation += f" ({metadata['pubDate']})"
+    if "start_time" in metadata:
+        citation += f" {format_timestamp(metadata['start_time'], True)}-{format_timestamp(metadata['end_time'], True)}"
+    if metadata.get("speakers"):
+        citation += f" {metadata['speakers']}"
+    return citation.strip()
 
-def generate_response(query, context_chunks):
+def format_citations(metadatas, count=CITATION_COUNT):
+    citations = list(dict.fromkeys(format_citation(metadata) for metadata in metadatas))[:count]
+    return "\n".join(f"[{i + 1}] {citation}" for i, citation in enumerate(citations))
+
+def build_prompt(query, context_chunks, metadatas=None):
+    if metadatas:
+        # Each chunk is labeled with its episode and time range, so the answer can cite them
+        context_chunks = [f"[{format_citation(metadata)}]\n{chunk}" for chunk, metadata in zip(context_chunks, metadatas)]
     context = "\n\n".join(context_chunks)
-    prompt = f"""根据提供的上下文（5个*之间）回答下面的问题（5个&之间），并提供相应的播客信息。
+    prompt = f"""根据提供的上下文（5个*之间）回答下面的问题（5个&之间），并提供相应的播客信息，引用时注明节目和时间段。
 
     上下文:
     *****{context}*****
 
     问题: &&&&&{query}&&&&&
     """
-    response = model.generate_content(prompt)
+    return prompt
+
+def generate_response(query, context_chunks, metadatas=None):
+    prompt = build_prompt(query, context_chunks, metadatas)
+    # Repeated questions over the same context are answered from the response cache
+    return get_response_cache().get_or_generate(prompt, lambda: generate_answer(prompt))
+
+def generate_answer(prompt):
+    with metrics.span("gemini.generate", op="answer"):
+        response = get_model().generate_content(prompt)
+    metrics.count("api_calls", api="gemini", op="answer")
+    metrics.count_usage(response, "gemini", "answer")
     return response.text
 
+async def generate_response_stream(query, context_chunks, metadatas=None):
+    """Yields the response generated so far each time Gemini streams more of it.
+
+    A cached response is yielded at once, a streamed one is cached when complete.
+    """
+    prompt = build_prompt(query, context_chunks, metadatas)
+    cache = get_response_cache()
+    key = make_cache_key(prompt)
+    response = await asyncio.to_thread(cache.get, key)
+    if response is not None:
+        metrics.count("llm_cache_hits", op="answer")
+        yield response
+        return
+    response = ""
+    chunk = None
+    start = time.perf_counter()
+    async for chunk in await get_model().generate_content_async(prompt, stream=True):
+        if not response:
+            metrics.observe("gemini.first_chunk", time.perf_counter() - start, op="answer")
+        response += chunk.text
+        yield response
+    metrics.observe("gemini.generate", time.perf_counter() - start, op="answer")
+    metrics.count("api_calls", api="gemini", op="answer")
+    # The last streamed chunk carries the usage of the whole response
+    metrics.count_usage(chunk, "gemini", "answer")
+    await asyncio.to_thread(cache.put, key, response)
+
 # --- Chatbot Interface ---
-def chatbot(query):
-    retrieved_chunks = retrieve_relevant_chunks(query)
-    if retrieved_chunks and retrieved_chunks['documents']:
-        context_chunks = retrieved_chunks['documents'] # Using top K now
-        #print(context_chunks)
-        response = generate_response(query, context_chunks[0])
-        return response
+def retrieve_context(query, filters):
+    """Retrieves and assembles the context chunks of a question, timing both steps."""
+    with metrics.span("query.retrieve"):
+        retrieved_chunks = retrieve_relevant_chunks(query, filters=filters)
+    if not retrieved_chunks or not retrieved_chunks['documents'][0]:
+        return None, None
+    # Adjacent chunks are merged without their overlap and packed within the token budget
+    with metrics.span("query.assemble"):
+        return assemble_context(retrieved_chunks['documents'][0], retrieved_chunks['metadatas'][0])
+
+async def chatbot(query, podcast_names=None, language=None, after="", before=""):
+    start = time.perf_counter()
+    metrics.count("queries")
+    query, filters = get_filters(query, podcast_names, language, after, before)
+    if not query:
+        # Nothing left to embed or search once the inline filters are stripped
+        yield "Please ask a question, the filters alone don't say what to look for."
+        return
+    # Retrieval blocks on Chroma and SQLite, it runs in a worker thread to keep the event loop free
+    context_chunks, metadatas = await asyncio.to_thread(retrieve_context, query, filters)
+    if context_chunks:
+        response = ""
+        async for response in generate_response_stream(query, context_chunks, metadatas):
+            yield response
+        if metadatas:
+            yield response + "\n\n来源:\n" + format_citations(metadatas)
     else:
-        return "I couldn't find relevant information in the podcast transcripts for that question."
+        yield "I couldn't find relevant information in the podcast transcripts for that question."
+    metrics.observe("query.chatbot", time.perf_counter() - start)
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve the podcast chatbot")
+    parser.add_argument('--metrics-port',
+                        type=int,
+                        default=CONFIG["metrics_port"],
+                        help='Serve Prometheus metrics at http://0.0.0.0:<port>/metrics')
+    metrics.add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.profile:
+        metrics.enable_profile()
+    if args.metrics_port:
+        metrics.start_metrics_server(args.metrics_port)
 
-iface = gr.Interface(
-    fn=chatbot,
-    inputs=gr.Textbox(placeholder="Ask me anything about the podcasts!"),
-    outputs=gr.Textbox(),
-    title="Podcast Chatbot",
-    description="Ask questions about the content of the transcribed podcasts."
-)
+    # Gradio takes seconds to import and is only needed to serve the interface
+    import gradio as gr
+    podcasts = get_podcasts()
+    iface = gr.Interface(
+        fn=chatbot,
+        inputs=[
+            gr.Textbox(placeholder="Ask me anything about the podcasts!"),
+            gr.Dropdown(choices=[podcast["podcast_name"] for podcast in podcasts], multiselect=True, label="Podcasts"),
+            gr.Dropdown(choices=sorted({podcast["language"] for podcast in podcasts if podcast.get("language")}), label="Language"),
+            gr.Textbox(label="Published after (YYYY-MM-DD)"),
+            gr.Textbox(label="Published before (YYYY-MM-DD)"),
+        ],
+        outputs=gr.Textbox(),
+        title="Podcast Chatbot",
+        description="Ask questions about the content of the transcribed podcasts. Filters can also be typed in the question: podcast:<name> lang:<code> after:<date> before:<date>"
+    )
 
-collection_name = CONFIG["vector_collection"]
-client = chromadb.PersistentClient(path=CONFIG["index_directory"])
-collection = client.get_or_create_collection(name=collection_name, embedding_function=openai_ef)
-print(f"Collection '{collection_name}' loaded/created.")
+    # Open the stores and the model before the first question instead of during it
+    init_retrieval()
+    get_model()
 
-model = init_model()
+    # Requests beyond the concurrency limit wait in Gradio's queue
+    iface.queue(default_concurrency_limit=CONFIG["query_concurrency"]).launch()
 
-iface.launch()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
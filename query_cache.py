@@ -0,0 +1,111 @@
+import os
+import json
+import hashlib
+import threading
+import unicodedata
+from array import array
+from collections import OrderedDict
+from util import *
+
+# Entries kept by each LRU cache of a QueryCache
+QUERY_CACHE_SIZE = 1024
+
+def normalize_query(query):
+    """Normalizes a query so that questions differing only in case, width or spacing share cache entries."""
+    return " ".join(unicodedata.normalize("NFKC", query).lower().split())
+
+def read_index_generation(filename=None):
+    """Returns the index generation counter, 0 before the first index run."""
+    try:
+        with open(filename or CONFIG["index_generation_file"], 'r', encoding='utf-8') as infile:
+            return int(infile.read().strip() or 0)
+    except (FileNotFoundError, ValueError):
+        return 0
+
+def bump_index_generation(filename=None):
+    """Increments the index generation counter, which invalidates the cached query results."""
+    filename = filename or CONFIG["index_generation_file"]
+    os.makedirs(os.path.dirname(filename) or ".", exist_ok=True)
+    generation = read_index_generation(filename) + 1
+    tmp_filename = filename + ".tmp"
+    with open(tmp_filename, 'w', encoding='utf-8') as outfile:
+        outfile.write(str(generation))
+    os.replace(tmp_filename, filename)
+    return generation
+
+class LRUCache:
+    def __init__(self, max_entries=QUERY_CACHE_SIZE):
+        self.max_entries = max_entries
+        self.entries = OrderedDict()
+        self.lock = threading.Lock()
+
+    def get(self, key):
+        with self.lock:
+            value = self.entries.get(key)
+            if value is not None:
+                self.entries.move_to_end(key)
+            return value
+
+    def put(self, key, value):
+        with self.lock:
+            self.entries[key] = value
+            self.entries.move_to_end(key)
+            while len(self.entries) > self.max_entries:
+                self.entries.popitem(last=False)
+
+    def clear(self):
+        with self.lock:
+            self.entries.clear()
+
+class QueryCache:
+    """In-process cache of query embeddings and retrieval results.
+
+    Normalized queries map to their embedding. Misses go to the embedding
+    function, which is backed by the persistent embedding cache, so only new
+    questions reach the OpenAI API. Retrieval results are cached as chunk ids
+    under (embedding, filters, k) and are dropped when index.py bumps the index
+    generation counter. The counter file is only read again when its mtime changes.
+    """
+    def __init__(self, embedding_function, max_entries=QUERY_CACHE_SIZE, generation_file=None):
+        self.embedding_function = embedding_function
+        self.generation_file = generation_file or CONFIG["index_generation_file"]
+        self.embeddings = LRUCache(max_entries)
+        self.results = LRUCache(max_entries)
+        self.lock = threading.Lock()
+        self.generation_mtime = None
+        self.generation = None
+
+    def _check_generation(self):
+        try:
+            mtime = os.stat(self.generation_file).st_mtime_ns
+        except FileNotFoundError:
+            mtime = None
+        with self.lock:
+            if mtime == self.generation_mtime and self.generation is not None:
+                return
+            generation = read_index_generation(self.generation_file)
+            if generation != self.generation:
+                self.results.clear()
+            self.generation_mtime = mtime
+            self.generation = generation
+
+    def get_embedding(self, query):
+        key = normalize_query(query)
+        embedding = self.embeddings.get(key)
+        if embedding is None:
+            embedding = [float(value) for value in self.embedding_function([key])[0]]
+            self.embeddings.put(key, embedding)
+        return embedding
+
+    def result_key(self, embedding, filters=None, k=None):
+        digest = hashlib.sha256(array('f', embedding).tobytes()).hexdigest()
+        return (digest, json.dumps(filters, sort_keys=True, ensure_ascii=False), k)
+
+    def get_results(self, key):
+        """Returns the cached chunk ids of a retrieval, or None."""
+        self._check_generation()
+        return self.results.get(key)
+
+    def put_results(self, key, ids):
+        self._check_generation()
+        self.results.put(key, list(ids))
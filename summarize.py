@@ -1,43 +1,112 @@
-import google.generativeai as genai
 import os
 import csv
 import json
 from typing import List
 import subprocess
 from util import *
+from manifest import EpisodeManifest
+from chunking import chunk_text_by_tokens, count_tokens
+from llm_cache import get_response_cache, make_cache_key, disable_response_cache
 import time
+import argparse
+from concurrent.futures import ThreadPoolExecutor
 from google.api_core.exceptions import ResourceExhausted
 
-model = init_model()
+# Transcripts longer than this are summarized with map-reduce: the chunks are
+# summarized in parallel, then the chunk summaries are merged into one summary
+MAP_REDUCE_THRESHOLD_TOKENS = 60000
+MAP_CHUNK_TOKENS = 20000
+MAP_CHUNK_OVERLAP_TOKENS = 500
+MAP_WORKERS = 4
 
-def process_podcast_data():
+def process_podcast_data(workers=4, rpm=CONFIG["gemini_rpm"], tpm=CONFIG["gemini_tpm"]):
     podcasts = read_podcast_list(CONFIG["podcast_list_file"])
     if not podcasts:
         return
 
+    manifest = EpisodeManifest()
+    limiter = RateLimiter(rpm=rpm, tpm=tpm)
+    jobs = []
     for podcast in podcasts:
         print(f"Processing podcast (Incremental Mode): {podcast['podcast_name']}")
         safe_podcast_name = get_safe_podcast_name(podcast['podcast_name'])
-        previous_data_file = os.path.join(CONFIG["output_directory"], f"{safe_podcast_name}.json")
-        previous_episodes = {}
-        if os.path.exists(previous_data_file):
-            try:
-                with open(previous_data_file, 'r', encoding='utf-8') as infile:
-                    previous_data = json.load(infile)
-                    previous_episodes = {ep["guid"]: ep for ep in previous_data.get("episodes", []) if ep.get("guid")}
-            except Exception as e:
-                print(f"Error loading previous data for {safe_podcast_name}: {e}")
-        #print(previous_episodes)
-    
-        for episode in previous_episodes:
-            summarize_episode(previous_episodes[episode], safe_podcast_name, podcast['language'])
+        for episode in manifest.pending("summarized", safe_podcast_name):
+            jobs.append((episode, safe_podcast_name, podcast['language']))
+
+    def summarize_job(job):
+        episode, safe_podcast_name, language = job
+        try:
+            if summarize_episode(episode, safe_podcast_name, language, limiter):
+                manifest.mark(safe_podcast_name, episode["guid"], "summarized")
+        except Exception as e:
+            print(f"Error summarizing {episode['filename']}: {e}")
 
-def summarize_episode(episode, podcast_name, language):
+    # Episodes are summarized concurrently, the shared limiter keeps them within quota
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        list(executor.map(summarize_job, jobs))
+
+def summarize_episode(episode, podcast_name, language, limiter=None):
     if (len(episode["filename"]) == 0):
-        return
-    summarize_transcript(episode["filename"], podcast_name, language, episode["title"], episode["description"])
+        return False
+    return summarize_transcript(episode["filename"], podcast_name, language, episode["title"], episode["description"], limiter=limiter)
+
+def generate_summary(prompt, limiter=None, max_retries=3):
+    """Generates text for a prompt, backing off through the limiter on quota errors.
+
+    Responses are served from the response cache when the same prompt was summarized before.
+
+    Returns:
+        The generated text, or None on a ResourceExhausted error that is not quota related.
+    """
+    cache_key = make_cache_key(prompt)
+    cached_summary = get_response_cache().get(cache_key)
+    if cached_summary:
+        metrics.count("llm_cache_hits", op="summarize")
+        return cached_summary
+    # The tokenizer is OpenAI's, close enough to Gemini's to pace requests against the tokens per minute quota
+    prompt_tokens = count_tokens(prompt) if limiter else 0
+    retries = 0
+    while True:
+        if limiter:
+            limiter.acquire(prompt_tokens)
+        try:
+            with metrics.span("gemini.generate", op="summarize"):
+                response = get_model().generate_content(prompt)
+            metrics.count("api_calls", api="gemini", op="summarize")
+            metrics.count_usage(response, "gemini", "summarize")
+            if limiter:
+                limiter.success()
+            get_response_cache().put(cache_key, response.text)
+            return response.text
+        except ResourceExhausted as e:
+            print(f"Quota limit reached (Attempt {retries + 1}). Error: {e}")
+            metrics.count("quota_errors", api="gemini", op="summarize")
+            if "quota" not in str(e).lower() and "rate limit" not in str(e).lower():
+                # It's a ResourceExhausted error but not likely a quota issue
+                print("A ResourceExhausted error occurred that might not be quota-related. Aborting.")
+                return None
+            retries += 1
+            if retries == max_retries:
+                raise ResourceExhausted(f"No quota after {max_retries} retries")
+            metrics.count("retries", api="gemini", op="summarize")
+            if limiter:
+                print(f"Pausing {limiter.backoff():.0f}s before retrying...")
+            else:
+                print("Sleeping for 1 minute before retrying...")
+                time.sleep(60)
+
+def summarize_chunks(chunks, podcast_name, podcast_title, limiter=None):
+    """Map step: summarizes the chunks of a long transcript in parallel. Returns None if any chunk failed."""
+    prompts = [f"这是播客《{podcast_name}》一期节目转录稿的第{i + 1}/{len(chunks)}部分，在三个单引号之间。请总结这一部分的主要内容和要点。播客标题:{podcast_title}。'''{chunk}'''"
+               for i, chunk in enumerate(chunks)]
+    with ThreadPoolExecutor(max_workers=MAP_WORKERS) as executor:
+        summaries = list(executor.map(lambda prompt: generate_summary(prompt, limiter), prompts))
+    if not all(summaries):
+        return None
+    return summaries
 
-def summarize_transcript(audio_file, podcast_name, podcast_language, podcast_title, podcast_shownotes, max_retries=3):
+def summarize_transcript(audio_file, podcast_name, podcast_language, podcast_title, podcast_shownotes, max_retries=3, limiter=None):
+    """Summarizes the transcript of an episode unless its summary exists. Returns True if the summary exists afterwards."""
     transcript_filename = CONFIG["transcript_directory"] + "/" + podcast_name + "/" + audio_file + ".transcript.txt"
     summary_filename = CONFIG["summary_directory"] + "/" + podcast_name + "/" + audio_file + ".summary.txt"
 
@@ -48,40 +117,62 @@ def summarize_transcript(audio_file, podcast_name, podcast_language, podcast_tit
 
     if (len(transcript_detail) == 0):
         print(f"Empty transcript file {transcript_filename}")
-        return
+        return False
     
     if (check_file_exists_and_size(summary_filename, 100)):
         print(f"{summary_filename} exists... skip transcribing...")
-        return
-    
-    initial_prompt = f"这是播客《{podcast_name}》的一期节目转录稿，在三个单引号之间。请根据提供的播客标题，shownotes和文字转录稿，生成这期播客的摘要。播客标题:{podcast_title}。播客shownotes:{podcast_shownotes}。'''{transcript_detail}'''"
+        return True
 
     print(f"Summarize episode {audio_file}")
+    with metrics.span("summarize.episode"):
+        summary = generate_transcript_summary(transcript_detail, podcast_name, podcast_title, podcast_shownotes, max_retries, limiter)
+    if summary is None:
+        return False
 
-    retries = 0
-    done = False
-    while retries < max_retries and not done:
-        try:
-            response = model.generate_content(initial_prompt)
-            time.sleep(1) # Otherwise will hit limit too soon
-            if(response):
-                done = True
-        except ResourceExhausted as e:
-            print(f"Quota limit reached (Attempt {retries + 1}). Error: {e}")
-            if "quota" in str(e).lower() or "rate limit" in str(e).lower():
-                print("Sleeping for 1 minute before retrying...")
-                time.sleep(60)
-                retries += 1
-            else:
-                # It's a ResourceExhausted error but not likely a quota issue
-                print("A ResourceExhausted error occurred that might not be quota-related. Aborting.")
-                return None
-
-    if (retries == max_retries):
-        raise ResourceExhausted(f"No quota after {max_retries} retries")
-        
-    #print(response.text)
+    #print(summary)
+    os.makedirs(os.path.dirname(summary_filename), exist_ok=True)
     with open(summary_filename, "w") as f:
-        f.write(response.text)
+        f.write(summary)
+    return True
+
+def generate_transcript_summary(transcript_detail, podcast_name, podcast_title, podcast_shownotes, max_retries=3, limiter=None):
+    """Generates the summary of a transcript, with map-reduce for long ones. Returns None on failure."""
+
+    chunks = chunk_text_by_tokens(transcript_detail, MAP_CHUNK_TOKENS, MAP_CHUNK_OVERLAP_TOKENS)
+    if len(chunks) > MAP_REDUCE_THRESHOLD_TOKENS // MAP_CHUNK_TOKENS:
+        print(f"Long transcript, summarizing {len(chunks)} parts first")
+        chunk_summaries = summarize_chunks(chunks, podcast_name, podcast_title, limiter)
+        if chunk_summaries is None:
+            return None
+        # Reduce step: the part summaries replace the transcript in the prompt
+        joined_summaries = "\n\n".join(f"第{i + 1}部分: {summary}" for i, summary in enumerate(chunk_summaries))
+        initial_prompt = f"这是播客《{podcast_name}》一期节目转录稿各部分的摘要，按顺序排列，在三个单引号之间。请根据提供的播客标题，shownotes和各部分摘要，生成这期播客的摘要。播客标题:{podcast_title}。播客shownotes:{podcast_shownotes}。'''{joined_summaries}'''"
+    else:
+        initial_prompt = f"这是播客《{podcast_name}》的一期节目转录稿，在三个单引号之间。请根据提供的播客标题，shownotes和文字转录稿，生成这期播客的摘要。播客标题:{podcast_title}。播客shownotes:{podcast_shownotes}。'''{transcript_detail}'''"
+
+    return generate_summary(initial_prompt, limiter, max_retries)
 
-process_podcast_data()
\ No newline at end of file
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Summarize podcast transcripts")
+    parser.add_argument('--workers',
+                        type=positive_int,
+                        default=4,
+                        help='Number of episodes summarized in parallel')
+    parser.add_argument('--rpm',
+                        type=int,
+                        default=CONFIG["gemini_rpm"],
+                        help='Gemini requests per minute shared by all workers')
+    parser.add_argument('--tpm',
+                        type=int,
+                        default=CONFIG["gemini_tpm"],
+                        help='Gemini tokens per minute shared by all workers')
+    parser.add_argument('--no-llm-cache',
+                        action='store_true',
+                        help='Always call Gemini instead of reusing cached summaries')
+    metrics.add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.profile:
+        metrics.enable_profile()
+    if args.no_llm_cache:
+        disable_response_cache()
+    process_podcast_data(workers=args.workers, rpm=args.rpm, tpm=args.tpm)
@@ -0,0 +1,23 @@
+from chunking import parse_turn_line, parse_turns
+
+def test_speaker_labels():
+    assert parse_turn_line("[00:12:30] 主持人: 欢迎收听") == (750, "主持人")
+    assert parse_turn_line("**01:05** Speaker A：大家好") == (65, "Speaker A")
+    assert parse_turn_line("嘉宾B：我来说两句") == (None, "嘉宾B")
+    assert parse_turn_line("**主持人**：好的") == (None, "主持人")
+    assert parse_turn_line("Speaker 2: right") == (None, "Speaker 2")
+    assert parse_turn_line("主持人（张三）：开始吧") == (None, "主持人（张三）")
+
+def test_colons_that_are_not_speaker_labels():
+    assert parse_turn_line("Note: this part was cut") is None
+    assert parse_turn_line("http://example.com/episode") is None
+    assert parse_turn_line("比如说：我们去年做的项目") is None
+    assert parse_turn_line("so basically: it works") is None
+    assert parse_turn_line("1: the first point") is None
+    assert parse_turn_line("我们约在 10:30 见面") is None
+    assert parse_turn_line("[00:10] Note: 这段有删减") == (10, None)
+
+def test_non_speaker_lines_stay_in_the_turn():
+    text = "[00:00] Host: welcome\nNote: ads removed\nhttps://example.com\n比如说：一个例子\n[00:30] Guest: thanks"
+    turns = parse_turns(text)
+    assert [(turn["start"], turn["speaker"]) for turn in turns] == [(0, "Host"), (30, "Guest")]
@@ -1,28 +1,67 @@
-import google.generativeai as genai
 import os
 import csv
 import json
 from typing import List
 import subprocess
+import argparse
+import heapq
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from util import *
+from manifest import EpisodeManifest
+from upload_registry import get_upload_registry
+from llm_cache import get_response_cache, make_cache_key, disable_response_cache
+from google.api_core.exceptions import ResourceExhausted
 
-model = init_model()
+# Gemini counts 32 tokens per second of audio, the size based estimate assumes 128 kbps audio
+AUDIO_TOKENS_PER_BYTE = 32 / 16000
 
-def transcribe_audio_with_history(audio_file_path: str, initial_prompt: str, continuous_prompt: str) -> str:
+def estimate_audio_tokens(audio_file_path):
+    """Estimates the prompt tokens of an audio file from its size."""
+    try:
+        return int(os.path.getsize(audio_file_path) * AUDIO_TOKENS_PER_BYTE)
+    except OSError:
+        return 0
+
+def get_history_tokens(response, fallback):
+    """Returns the prompt plus output tokens of a chat turn, which the next turn resends as history.
+
+    Uses the usage metadata of the response, or fallback if the response has none.
+    """
+    usage = getattr(response, "usage_metadata", None)
+    tokens = (getattr(usage, "prompt_token_count", 0) or 0) + (getattr(usage, "candidates_token_count", 0) or 0)
+    return tokens or fallback
+
+def transcribe_audio_with_history(audio_file_path: str, initial_prompt: str, continuous_prompt: str, on_uploaded=None, limiter=None) -> str:
     """
     Transcribes an audio file using Google Gemini API, handling potentially
     large outputs by maintaining conversation history.
 
     Args:
         audio_file_path: Path to the audio file.
+        on_uploaded: Optional callback invoked with the uploaded file.
+        limiter: Optional RateLimiter every request waits for. Quota errors are then
+            raised to the caller instead of being swallowed, so it can back off and retry.
 
     Returns:
         The full transcribed text.
     """
+    # Every turn resends the audio in the chat history, so each request is charged for it
+    audio_tokens = estimate_audio_tokens(audio_file_path)
     try:
-        audio_file = upload_to_gemini(audio_file_path, mime_type="audio/mpeg")
+        # Transcriptions are cached by audio content and prompts, a re-run only pays for new audio
+        cache_key = make_cache_key([initial_prompt, continuous_prompt], get_upload_registry().content_hash(audio_file_path))
+        cached_transcription = get_response_cache().get(cache_key)
+        if cached_transcription:
+            print(f"Using cached transcription of {audio_file_path}")
+            return cached_transcription
+
+        # Retries and re-transcriptions reuse a recent upload of the same audio
+        audio_file = upload_to_gemini(audio_file_path, mime_type="audio/mpeg", registry=get_upload_registry())
+        if on_uploaded:
+            on_uploaded(audio_file)
         # Start the conversation
-        chat = model.start_chat(
+        chat = get_model().start_chat(
             history=[{
                     "role": "user",
                     "parts": [audio_file],
@@ -30,7 +69,12 @@ def transcribe_audio_with_history(audio_file_path: str, initial_prompt: str, con
             ]
         )
 
-        response = chat.send_message(initial_prompt, request_options={"timeout": 1000})
+        if limiter:
+            limiter.acquire(audio_tokens)
+        with metrics.span("gemini.generate", op="transcribe"):
+            response = chat.send_message(initial_prompt, request_options={"timeout": 1000})
+        metrics.count("api_calls", api="gemini", op="transcribe")
+        metrics.count_usage(response, "gemini", "transcribe")
 
         full_transcription = response.text
 
@@ -42,20 +86,27 @@ def transcribe_audio_with_history(audio_file_path: str, initial_prompt: str, con
         while str(response.candidates[0].finish_reason) != 'FinishReason.STOP':  # 'STOP' typically indicates a natural end
         #if True:
             print("Continuing transcription...")
-            # Create a new turn in the conversation, asking to continue
-            contents = [
-                {
-                    "parts": [
-                        continuous_prompt
-                    ]
-                }
-            ]
-            response = chat.send_message(continuous_prompt, request_options={"timeout": 1000})
+            if limiter:
+                # The continuation resends the previous turn, audio and transcription so far included
+                limiter.acquire(get_history_tokens(response, audio_tokens))
+            with metrics.span("gemini.generate", op="transcribe_continue"):
+                response = chat.send_message(continuous_prompt, request_options={"timeout": 1000})
+            metrics.count("api_calls", api="gemini", op="transcribe_continue")
+            metrics.count_usage(response, "gemini", "transcribe")
             full_transcription += response.text
 
         print("\nTranscription complete.")
+        if limiter:
+            limiter.success()
+        get_response_cache().put(cache_key, full_transcription)
         return full_transcription
 
+    except ResourceExhausted as e:
+        metrics.count("quota_errors", api="gemini", op="transcribe")
+        if limiter:
+            raise
+        print(f"An error occurred during transcription: {e}")
+        return ""
     except FileNotFoundError:
         print(f"Error: Audio file not found at {audio_file_path}")
         return ""
@@ -64,20 +115,141 @@ def transcribe_audio_with_history(audio_file_path: str, initial_prompt: str, con
         return ""
 
 
-def transcript_audiofile(audio_file, podcast_name, podcast_language,podcast_title, podcast_shownotes):
+# Segmenting mode: long episodes are cut into overlapping windows transcribed concurrently
+SEGMENT_OVERLAP_SECONDS = 30
+SEGMENT_WORKERS = 4
+
+def get_audio_duration(audio_file_path):
+    """Returns the duration of an audio file in seconds using ffprobe."""
+    result = subprocess.run(
+        ["ffprobe", "-v", "error", "-show_entries", "format=duration", "-of", "default=noprint_wrappers=1:nokey=1", audio_file_path],
+        capture_output=True, text=True, check=True)
+    return float(result.stdout.strip())
+
+def split_audio(audio_file_path, segment_seconds, overlap_seconds, segment_dir):
+    """Cuts an audio file into windows of segment_seconds, each overlapping the next by overlap_seconds.
+
+    Segments are cut with ffmpeg without re-encoding and are reused if they already exist.
+
+    Returns:
+        A list of (start_seconds, segment_path) tuples.
+    """
+    duration = get_audio_duration(audio_file_path)
+    step = segment_seconds - overlap_seconds
+    if step <= 0:
+        raise ValueError("segment_seconds must be larger than overlap_seconds")
+    os.makedirs(segment_dir, exist_ok=True)
+    ext = os.path.splitext(audio_file_path)[1]
+    segments = []
+    start = 0
+    while start < duration:
+        segment_path = os.path.join(segment_dir, f"{int(start):06d}{ext}")
+        if not check_file_exists_and_size(segment_path, 0):
+            subprocess.run(
+                ["ffmpeg", "-y", "-v", "error", "-ss", str(start), "-t", str(segment_seconds), "-i", audio_file_path, "-c", "copy", segment_path],
+                check=True)
+        segments.append((start, segment_path))
+        if start + segment_seconds >= duration:
+            break
+        start += step
+    return segments
+
+def shift_timestamp(line, offset_seconds):
+    """Adds offset_seconds to the timestamp a line starts with, the one marking when the line starts."""
+    match = match_line_timestamp(line)
+    if not offset_seconds or not match:
+        return line
+    return line[:match.start()] + format_timestamp(parse_timestamp(match) + offset_seconds, match.group(1) is not None) + line[match.end():]
+
+def stitch_segments(segment_texts, segment_seconds, overlap_seconds):
+    """Joins the transcripts of overlapping segments into one transcript.
+
+    Line timestamps are shifted by the start of their segment. The middle of each overlap
+    is used as the cut: a segment keeps the lines up to it, and the next segment the
+    lines after it. Lines without a timestamp follow the closest timestamped line
+    above them. Segments without any timestamp fall back to dropping their leading
+    lines that repeat the tail of the previous segment.
+
+    Args:
+        segment_texts: A list of (start_seconds, text) tuples ordered by start.
+    """
+    stitched = []
+    for k, (start, text) in enumerate(segment_texts):
+        lower = start + overlap_seconds / 2 if k > 0 else float("-inf")
+        upper = start + segment_seconds - overlap_seconds / 2 if k + 1 < len(segment_texts) else float("inf")
+        lines = text.splitlines()
+        if not any(match_line_timestamp(line) for line in lines):
+            tail = {line.strip() for line in stitched[-50:] if line.strip()}
+            while lines and (not lines[0].strip() or lines[0].strip() in tail):
+                lines.pop(0)
+            stitched.extend(lines)
+            continue
+        # Lines before the first timestamp are treated as starting with the segment
+        line_time = start
+        for line in lines:
+            match = match_line_timestamp(line)
+            if match:
+                line_time = start + parse_timestamp(match)
+            if lower <= line_time < upper:
+                stitched.append(shift_timestamp(line, start))
+    return "\n".join(stitched)
+
+def transcribe_audio_segmented(audio_file_path: str, initial_prompt: str, continuous_prompt: str, segment_seconds: int,
+                               overlap_seconds: int = SEGMENT_OVERLAP_SECONDS, mark_stage=None, limiter=None,
+                               segment_workers: int = SEGMENT_WORKERS) -> str:
+    """
+    Transcribes an audio file as overlapping segments transcribed concurrently, then
+    stitches the segment transcripts together with stitch_segments().
+
+    mark_stage, if given, is called with "uploaded" once every segment is uploaded and transcribed.
+
+    Returns:
+        The full transcribed text, or "" if any segment failed.
+    """
+    try:
+        segment_dir = os.path.join(CONFIG["segment_directory"], os.path.relpath(audio_file_path, CONFIG["audio_download_directory"]))
+        segments = split_audio(audio_file_path, segment_seconds, overlap_seconds, segment_dir)
+    except (OSError, subprocess.CalledProcessError, ValueError) as e:
+        print(f"Error splitting {audio_file_path} into segments: {e}")
+        return ""
+    print(f"Transcribing {audio_file_path} as {len(segments)} segments")
+
+    with ThreadPoolExecutor(max_workers=segment_workers) as executor:
+        futures = [executor.submit(transcribe_audio_with_history, segment_path, initial_prompt, continuous_prompt, None, limiter)
+                   for _, segment_path in segments]
+        texts = [future.result() for future in futures]
+    if not all(texts):
+        print(f"Error: some segments of {audio_file_path} could not be transcribed")
+        return ""
+    if mark_stage:
+        mark_stage("uploaded")
+    return stitch_segments(list(zip([start for start, _ in segments], texts)), segment_seconds, overlap_seconds)
+
+def transcript_audiofile(audio_file, podcast_name, podcast_language,podcast_title, podcast_shownotes, mark_stage=None, limiter=None,
+                         segment_seconds=0, overlap_seconds=SEGMENT_OVERLAP_SECONDS):
+    """Transcribes an audio file unless its transcript exists. Returns True if the transcript exists afterwards.
+
+    mark_stage, if given, is called with the manifest stage reached, "uploaded" once the audio is uploaded.
+    """
     if (len(audio_file) == 0):
-        return
+        return False
     download_dir = CONFIG["transcript_directory"] + "/" + podcast_name
     transcript_filename = download_dir + "/" + audio_file + ".transcript.txt"
     if (check_file_exists_and_size(transcript_filename, 100)):
         #print(f"{transcript_filename} exists... skip transcribing...")
-        return
+        return True
     prompts = read_prompts()
     #initial_prompt = f"这是播客《{podcast_name}》的一期节目，请生成音频记录，包括每个转录的说话者信息和时间轴（开始时间），按照事件发生的时间来组织转录。播客标题: {podcast_title}。播客shownotes: {podcast_shownotes}"
     #continuous_prompt = "请根据上面已经生成的内容继续生成转录文字稿。"
     initial_prompt = prompts[podcast_language]['initial_prompt'].format(podcast_name=podcast_name, podcast_title=podcast_title, podcast_shownotes=podcast_shownotes)
     continuous_prompt = prompts[podcast_language]['continuous_prompt']
-    transcribed_text = transcribe_audio_with_history(CONFIG["audio_download_directory"] + "/" + podcast_name + "/" + audio_file, initial_prompt, continuous_prompt)
+    audio_file_path = CONFIG["audio_download_directory"] + "/" + podcast_name + "/" + audio_file
+    with metrics.span("transcribe.episode"):
+        if segment_seconds:
+            transcribed_text = transcribe_audio_segmented(audio_file_path, initial_prompt, continuous_prompt, segment_seconds, overlap_seconds, mark_stage, limiter)
+        else:
+            on_uploaded = (lambda uploaded_file: mark_stage("uploaded")) if mark_stage else None
+            transcribed_text = transcribe_audio_with_history(audio_file_path, initial_prompt, continuous_prompt, on_uploaded, limiter)
 
     if transcribed_text:
         print(f"--- Full Transcribed Text for {audio_file} ---")
@@ -86,32 +258,120 @@ def transcript_audiofile(audio_file, podcast_name, podcast_language,podcast_titl
         # You can save the transcribed text to a file if needed
         with open(transcript_filename, "w") as f:
             f.write(transcribed_text)
-    
-def process_podcast_data():
+        return True
+    return False
+
+
+class TranscriptionScheduler:
+    """Transcribes episodes on a pool of workers sharing one Gemini quota.
+
+    Each worker runs its own upload and chat session. Every request waits for the
+    shared RateLimiter, and a quota error pauses all workers through the limiter's
+    adaptive backoff before the episode goes back into the queue. Episodes are
+    processed newest first across all podcasts.
+    """
+    def __init__(self, manifest, workers=4, rpm=None, tpm=None, max_attempts=5, segment_seconds=0, overlap_seconds=SEGMENT_OVERLAP_SECONDS):
+        self.manifest = manifest
+        self.segment_seconds = segment_seconds
+        self.overlap_seconds = overlap_seconds
+        self.workers = workers
+        self.limiter = RateLimiter(rpm=rpm, tpm=tpm)
+        self.max_attempts = max_attempts
+        self.queue = []
+        self.lock = threading.Lock()
+        self.counter = 0
+
+    def add(self, episode, podcast_name, language, attempt=0):
+        with self.lock:
+            # The counter keeps the heap stable and avoids comparing episode dicts
+            self.counter += 1
+            heapq.heappush(self.queue, (-(episode.get("pub_ts") or 0), self.counter, attempt, episode, podcast_name, language))
+
+    def _next(self):
+        with self.lock:
+            return heapq.heappop(self.queue) if self.queue else None
+
+    def _work(self):
+        while True:
+            job = self._next()
+            if job is None:
+                return
+            _, _, attempt, episode, podcast_name, language = job
+            try:
+                transcript_episode(episode, podcast_name, language, self.manifest, self.limiter, self.segment_seconds, self.overlap_seconds)
+            except ResourceExhausted as e:
+                pause = self.limiter.backoff()
+                if attempt + 1 < self.max_attempts:
+                    print(f"Quota limit reached for {episode['title']} (Attempt {attempt + 1}), pausing {pause:.0f}s: {e}")
+                    metrics.count("retries", api="gemini", op="transcribe")
+                    self.add(episode, podcast_name, language, attempt + 1)
+                else:
+                    print(f"Giving up on {episode['title']} after {self.max_attempts} quota errors")
+            except Exception as e:
+                print(f"Error transcribing {episode['title']}: {e}")
+
+    def run(self):
+        threads = [threading.Thread(target=self._work) for _ in range(self.workers)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+
+def process_podcast_data(workers=4, rpm=CONFIG["gemini_rpm"], tpm=CONFIG["gemini_tpm"], segment_seconds=0, overlap_seconds=SEGMENT_OVERLAP_SECONDS):
     podcasts = read_podcast_list(CONFIG["podcast_list_file"])
     if not podcasts:
         return
 
+    manifest = EpisodeManifest()
+    scheduler = TranscriptionScheduler(manifest, workers=workers, rpm=rpm, tpm=tpm, segment_seconds=segment_seconds, overlap_seconds=overlap_seconds)
     for podcast in podcasts:
-        print(f"Processing podcast (Incremental Mode): {podcast['podcast_name']}")
-        safe_podcast_name = get_safe_podcast_name(podcast['podcast_name'])
-        previous_data_file = os.path.join(CONFIG["output_directory"], f"{safe_podcast_name}.json")
-        previous_episodes = {}
-        if os.path.exists(previous_data_file):
-            try:
-                with open(previous_data_file, 'r', encoding='utf-8') as infile:
-                    previous_data = json.load(infile)
-                    previous_episodes = {ep["guid"]: ep for ep in previous_data.get("episodes", []) if ep.get("guid")}
-            except Exception as e:
-                print(f"Error loading previous data for {podcast['podcast_name']}: {e}")
-        #print(previous_episodes)
-    
-        for episode in previous_episodes:
-            transcript_episode(previous_episodes[episode], podcast['podcast_name'], podcast['language'])
+        episodes = manifest.pending("transcribed", podcast['podcast_name'])
+        print(f"Processing podcast (Incremental Mode): {podcast['podcast_name']}, {len(episodes)} episodes to transcribe")
+        for episode in episodes:
+            scheduler.add(episode, podcast['podcast_name'], podcast['language'])
+    scheduler.run()
 
-def transcript_episode(episode, podcast_name, language):
+def transcript_episode(episode, podcast_name, language, manifest=None, limiter=None, segment_seconds=0, overlap_seconds=SEGMENT_OVERLAP_SECONDS):
+    """Transcribes an episode and marks it in the manifest. Returns True if its transcript exists afterwards."""
     print(episode["title"])
-    transcript_audiofile(episode["filename"], get_safe_podcast_name(podcast_name), language, episode["title"], episode["description"])
+    mark_stage = None
+    if manifest:
+        mark_stage = lambda stage: manifest.mark(podcast_name, episode["guid"], stage)
+    transcribed = transcript_audiofile(episode["filename"], get_safe_podcast_name(podcast_name), language, episode["title"], episode["description"], mark_stage, limiter,
+                                       segment_seconds, overlap_seconds)
+    if transcribed and manifest:
+        manifest.mark(podcast_name, episode["guid"], "transcribed")
+    return transcribed
 
 if __name__ == "__main__":
-    process_podcast_data()
+    parser = argparse.ArgumentParser(description="Transcribe downloaded podcast episodes")
+    parser.add_argument('--workers',
+                        type=positive_int,
+                        default=4,
+                        help='Number of episodes transcribed in parallel')
+    parser.add_argument('--rpm',
+                        type=int,
+                        default=CONFIG["gemini_rpm"],
+                        help='Gemini requests per minute shared by all workers')
+    parser.add_argument('--tpm',
+                        type=int,
+                        default=CONFIG["gemini_tpm"],
+                        help='Gemini tokens per minute shared by all workers')
+    parser.add_argument('--segment-seconds',
+                        type=int,
+                        default=0,
+                        help='Transcribe episodes as segments of this many seconds in parallel (0 transcribes the whole file)')
+    parser.add_argument('--overlap-seconds',
+                        type=int,
+                        default=SEGMENT_OVERLAP_SECONDS,
+                        help='Overlap between consecutive segments in seconds')
+    parser.add_argument('--no-llm-cache',
+                        action='store_true',
+                        help='Always call Gemini instead of reusing cached transcriptions')
+    metrics.add_profile_argument(parser)
+    args = parser.parse_args()
+    if args.profile:
+        metrics.enable_profile()
+    if args.no_llm_cache:
+        disable_response_cache()
+    process_podcast_data(workers=args.workers, rpm=args.rpm, tpm=args.tpm, segment_seconds=args.segment_seconds, overlap_seconds=args.overlap_seconds)
@@ -0,0 +1,99 @@
+import os
+import json
+import hashlib
+import threading
+import time
+from util import *
+
+# Gemini deletes uploaded files after 48 hours. Files are only reused while they
+# are young enough for a transcription started now to finish before that.
+REUSE_HOURS = 46
+
+def file_sha256(path):
+    sha256 = hashlib.sha256()
+    with open(path, 'rb') as infile:
+        for block in iter(lambda: infile.read(1024 * 1024), b""):
+            sha256.update(block)
+    return sha256.hexdigest()
+
+class UploadRegistry:
+    """Local registry of the files uploaded to Gemini, keyed by the sha256 of their content.
+
+    Each entry records the remote name, URI, display name and upload time, so a
+    retry or re-transcription of the same audio reuses the remote file, and old
+    uploads can be found and deleted without listing every remote file. Content
+    hashes are remembered per local path, size and mtime to avoid rehashing.
+    """
+    def __init__(self, filename=None):
+        self.filename = filename or CONFIG["upload_registry_file"]
+        self.lock = threading.Lock()
+        self.uploads = {}
+        self.hashes = {}
+        if os.path.exists(self.filename):
+            try:
+                with open(self.filename, 'r', encoding='utf-8') as infile:
+                    data = json.load(infile)
+                    self.uploads = data.get("uploads", {})
+                    self.hashes = data.get("hashes", {})
+            except Exception as e:
+                print(f"Error loading upload registry {self.filename}: {e}")
+
+    def _save(self):
+        # Must be called with self.lock held
+        os.makedirs(os.path.dirname(self.filename) or ".", exist_ok=True)
+        tmp_filename = self.filename + ".tmp"
+        with open(tmp_filename, 'w', encoding='utf-8') as outfile:
+            json.dump({"uploads": self.uploads, "hashes": self.hashes}, outfile, indent=4)
+        os.replace(tmp_filename, self.filename)
+
+    def content_hash(self, path):
+        stat = os.stat(path)
+        key = os.path.abspath(path)
+        with self.lock:
+            cached = self.hashes.get(key)
+        if cached and cached["size"] == stat.st_size and cached["mtime"] == stat.st_mtime:
+            return cached["sha256"]
+        sha256 = file_sha256(path)
+        with self.lock:
+            self.hashes[key] = {"size": stat.st_size, "mtime": stat.st_mtime, "sha256": sha256}
+            self._save()
+        return sha256
+
+    def get(self, content_hash, max_age_hours=REUSE_HOURS):
+        """Returns the entry of an upload of this content younger than max_age_hours, or None."""
+        with self.lock:
+            entry = self.uploads.get(content_hash)
+        if entry and time.time() - entry["uploaded_at"] < max_age_hours * 3600:
+            return entry
+        return None
+
+    def add(self, content_hash, file):
+        with self.lock:
+            self.uploads[content_hash] = {
+                "name": file.name,
+                "uri": file.uri,
+                "display_name": file.display_name,
+                "uploaded_at": time.time(),
+            }
+            self._save()
+
+    def remove(self, content_hash):
+        with self.lock:
+            self.uploads.pop(content_hash, None)
+            self._save()
+
+    def expired(self, hours):
+        """Returns (content_hash, entry) for every upload older than hours."""
+        cutoff = time.time() - hours * 3600
+        with self.lock:
+            return [(content_hash, entry) for content_hash, entry in self.uploads.items() if entry["uploaded_at"] < cutoff]
+
+upload_registry = None
+upload_registry_lock = threading.Lock()
+
+def get_upload_registry():
+    global upload_registry
+    with upload_registry_lock:
+        if upload_registry is None:
+            upload_registry = UploadRegistry()
+        return upload_registry
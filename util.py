@@ -1,8 +1,13 @@
 import os
+import re
 import csv
+from datetime import datetime
+import argparse
 import subprocess
-import google.generativeai as genai
-import chromadb.utils.embedding_functions as embedding_functions
+import threading
+import time
+import random
+import metrics
 
 data_dir = "data"
 
@@ -12,14 +17,55 @@ CONFIG = {
     "podcast_list_file": f"{data_dir}/podcasts.csv",
     "prompts_file": "podcast_prompts.tsv",
     "output_directory": f"{data_dir}/podcast_data",
+    "feed_cache_file": f"{data_dir}/feed_cache.json",
+    "manifest_file": f"{data_dir}/manifest.db",
+    "upload_registry_file": f"{data_dir}/gemini_uploads.json",
+    "llm_cache_file": f"{data_dir}/llm_cache.db",
+    "llm_cache_max_bytes": 512 * 1024 * 1024,
+    "llm_cache_ttl_hours": 30 * 24,
     "audio_download_directory": f"{data_dir}/podcast_audio",
+    "segment_directory": f"{data_dir}/podcast_segments",
     "transcript_directory": f"{data_dir}/podcast_transcript",
     "summary_directory": f"{data_dir}/podcast_summary",
     "index_directory": f"{data_dir}/chroma_db",
+    "embedding_cache_directory": f"{data_dir}/embedding_cache",
+    "keyword_index_file": f"{data_dir}/keyword_index.db",
+    # Bumped by index.py after every change to the index, invalidates cached query results
+    "index_generation_file": f"{data_dir}/index_generation",
+    # Tokens of retrieved transcript text put into a query prompt at most
+    "context_token_budget": 8000,
+    # Chatbot requests served at the same time
+    "query_concurrency": 4,
     "vector_collection" : "podcast_embeddings",
-    "embedding_batch_size" : 100
+    # Vector store used by index.py and query.py: "chroma", or "local" for the memory-mapped LocalVectorStore
+    "vector_backend": "chroma",
+    "local_vector_directory": f"{data_dir}/local_vectors",
+    # Vector type of a new local store: "float16", or "int8" for half the size
+    "local_vector_dtype": "float16",
+    "embedding_batch_size" : 100,
+    # Gemini quota shared by the workers of a script
+    "gemini_rpm": 15,
+    "gemini_tpm": 1000000,
+    # Spans and counters are appended here as JSON lines with --profile, or always if metrics_log is set
+    "metrics_file": f"{data_dir}/metrics.jsonl",
+    "metrics_log": False,
+    # Port of the Prometheus metrics endpoint of query.py, None to disable it
+    "metrics_port": None,
+    # USD per million tokens, used to estimate the cost of a run in the --profile report
+    "token_prices_per_million": {
+        "gemini_input": 0.075,
+        "gemini_output": 0.30,
+        "openai_input": 0.02,
+    },
 }
 
+def positive_int(value):
+    """argparse type for counts that must be at least 1, such as numbers of workers."""
+    number = int(value)
+    if number < 1:
+        raise argparse.ArgumentTypeError(f"must be at least 1, got {value}")
+    return number
+
 def check_file_exists_and_size(filename, min_size_bytes):
   """
   Checks if a file exists and its size is larger than a specified value.
@@ -49,13 +95,35 @@ def check_file_exists_and_size(filename, min_size_bytes):
   else:
     return False
 
-def upload_to_gemini(path, mime_type=None):
+def upload_to_gemini(path, mime_type=None, registry=None):
   """Uploads the given file to Gemini.
 
+  With an UploadRegistry, a file with the same content that was uploaded
+  recently is reused instead of being uploaded again.
+
   See https://ai.google.dev/gemini-api/docs/prompting_with_media
   """
-  file = genai.upload_file(path, mime_type=mime_type)
+  import google.generativeai as genai
+  content_hash = None
+  if registry is not None:
+    content_hash = registry.content_hash(path)
+    entry = registry.get(content_hash)
+    if entry:
+      try:
+        file = genai.get_file(entry["name"])
+        print(f"Reusing uploaded file '{file.display_name}' as: {file.uri}")
+        metrics.count("uploads_reused")
+        return file
+      except Exception as e:
+        print(f"Uploaded file {entry['name']} is no longer available: {e}")
+        registry.remove(content_hash)
+  with metrics.span("gemini.upload"):
+    file = genai.upload_file(path, mime_type=mime_type)
+  metrics.count("api_calls", api="gemini", op="upload")
+  metrics.count("upload_bytes", os.path.getsize(path))
   print(f"Uploaded file '{file.display_name}' as: {file.uri}")
+  if registry is not None:
+    registry.add(content_hash, file)
   return file
 
 
@@ -63,24 +131,45 @@ def get_gemini_key():
     # Run a command and get its output
     return os.environ.get("GEMINI_API_KEY")
 
+# Select the Gemini Flash 1.5 model
+MODEL_NAME = "gemini-1.5-flash"
+GENERATION_CONFIG = {
+  "temperature": 1,
+  "top_p": 0.95,
+  "top_k": 40,
+  "max_output_tokens": 8192,
+  "response_mime_type": "text/plain",
+}
+
 def init_model():
+    # The Gemini SDK takes about a second to import, so only scripts that use the model pay for it
+    import google.generativeai as genai
     api_key = get_gemini_key()
     
     # Configure the API key
     genai.configure(api_key=api_key)
 
     # Create the model
-    generation_config = {
-      "temperature": 1,
-      "top_p": 0.95,
-      "top_k": 40,
-      "max_output_tokens": 8192,
-      "response_mime_type": "text/plain",
-    }
-    # Select the Gemini Flash 1.5 model
-    model = genai.GenerativeModel("gemini-1.5-flash", generation_config=generation_config)
+    model = genai.GenerativeModel(MODEL_NAME, generation_config=GENERATION_CONFIG)
     return model
 
+_model = None
+_model_lock = threading.Lock()
+
+def get_model():
+    """Returns the shared Gemini model, created on first use."""
+    global _model
+    with _model_lock:
+        if _model is None:
+            _model = init_model()
+        return _model
+
+def set_model(model):
+    """Replaces the shared model, e.g. with a stand-in that doesn't call Gemini."""
+    global _model
+    with _model_lock:
+        _model = model
+
 # Function to read podcast list from CSV
 def read_podcast_list(filename):
     podcasts = []
@@ -94,9 +183,145 @@ def read_podcast_list(filename):
     print(podcasts)
     return podcasts
 
+class TokenBucket:
+    """Thread-safe token bucket used to pace requests.
+
+    Args:
+        rate (float): Tokens added per second.
+        capacity (float): Maximum number of tokens the bucket can hold.
+    """
+    def __init__(self, rate, capacity=1):
+        if rate <= 0:
+            raise ValueError("rate must be positive")
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.lock = threading.Lock()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def acquire(self, tokens=1):
+        """Blocks until `tokens` tokens are available and consumes them."""
+        # Requests larger than the bucket would never be satisfied, let them drain it instead
+        tokens = min(tokens, self.capacity)
+        while True:
+            with self.lock:
+                self._refill()
+                if self.tokens >= tokens:
+                    self.tokens -= tokens
+                    return
+                wait = (tokens - self.tokens) / self.rate
+            time.sleep(wait)
+
+    def try_acquire(self, tokens=1):
+        """Consumes `tokens` tokens if available without blocking.
+
+        Returns:
+            0 if the tokens were consumed, otherwise the seconds until they will be available.
+        """
+        tokens = min(tokens, self.capacity)
+        with self.lock:
+            self._refill()
+            if self.tokens >= tokens:
+                self.tokens -= tokens
+                return 0
+            return (tokens - self.tokens) / self.rate
+
+class RateLimiter:
+    """Requests-per-minute and tokens-per-minute budget shared by concurrent workers.
+
+    acquire() blocks until both budgets allow a request. After a quota error,
+    backoff() pauses every worker sharing the limiter, doubling the pause on each
+    consecutive error up to max_backoff seconds; success() resets it.
+    """
+    def __init__(self, rpm=None, tpm=None, initial_backoff=5, max_backoff=300):
+        self.requests = TokenBucket(rpm / 60.0, capacity=rpm) if rpm else None
+        self.tokens = TokenBucket(tpm / 60.0, capacity=tpm) if tpm else None
+        self.initial_backoff = initial_backoff
+        self.max_backoff = max_backoff
+        self.backoff_seconds = 0
+        self.paused_until = 0
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=0):
+        while True:
+            with self.lock:
+                delay = self.paused_until - time.monotonic()
+            if delay <= 0:
+                break
+            time.sleep(delay)
+        if self.requests:
+            self.requests.acquire(1)
+        if self.tokens and tokens:
+            self.tokens.acquire(tokens)
+
+    def backoff(self):
+        """Records a quota error and returns the number of seconds all workers pause."""
+        with self.lock:
+            self.backoff_seconds = min(self.max_backoff, max(self.initial_backoff, self.backoff_seconds * 2))
+            # Jitter keeps the workers from retrying in lockstep
+            pause = self.backoff_seconds * random.uniform(1.0, 1.25)
+            self.paused_until = max(self.paused_until, time.monotonic() + pause)
+            return pause
+
+    def success(self):
+        with self.lock:
+            self.backoff_seconds = 0
+
+# Helper function to parse pubDate string to datetime object
+def parse_pub_date(date_string):
+    # Attempt to parse with different common formats
+    formats = [
+        "%a, %d %b %Y %H:%M:%S %Z",
+        "%a, %d %b %Y %H:%M:%S %z",
+        "%a, %d %b %Y %H:%M %Z",
+        "%a, %d %b %Y %H:%M %z",
+        "%d %b %Y %H:%M:%S %Z",
+        "%d %b %Y %H:%M:%S %z",
+        "%Y-%m-%dT%H:%M:%S%z",
+        "%Y-%m-%dT%H:%M:%SZ",
+    ]
+    for fmt in formats:
+        try:
+            return datetime.strptime(date_string, fmt)
+        except ValueError:
+            pass
+    return None
+
 def get_safe_podcast_name(podcast_name):
     return "".join(c if c.isalnum() else '_' for c in podcast_name)
 
+# [hh:]mm:ss timestamps as written by the transcription prompts
+TIMESTAMP_RE = re.compile(r'(?<![\d:])(?:(\d{1,2}):)?(\d{1,2}):(\d{2})(?![\d:])')
+
+# Markup that can precede the timestamp a line starts with, e.g. "[00:12:30]" or "**01:05**"
+LINE_TIMESTAMP_PREFIX_CHARS = " \t*#>-–—[]()（）【】|"
+
+def match_line_timestamp(line):
+    """Returns the TIMESTAMP_RE match of the timestamp a line starts with, or None.
+
+    Timestamps mentioned later in the line ("at 12:30 we...") are ignored.
+    """
+    match = TIMESTAMP_RE.search(line)
+    if match and not line[:match.start()].strip(LINE_TIMESTAMP_PREFIX_CHARS):
+        return match
+    return None
+
+def format_timestamp(seconds, with_hours=False):
+    seconds = int(seconds)
+    hours, rest = divmod(seconds, 3600)
+    if hours or with_hours:
+        return f"{hours:02d}:{rest // 60:02d}:{rest % 60:02d}"
+    return f"{rest // 60:02d}:{rest % 60:02d}"
+
+def parse_timestamp(match):
+    hours, minutes, seconds = match.groups()
+    return int(hours or 0) * 3600 + int(minutes) * 60 + int(seconds)
+
 prompts = {}
 def read_prompts():
     if (len(prompts) > 0):
@@ -112,7 +337,25 @@ def read_prompts():
     return prompts
 
 
-openai_ef = embedding_functions.OpenAIEmbeddingFunction(
-    api_key=os.environ.get("OPENAI_API_KEY"),
-    model_name="text-embedding-3-small"
-)
\ No newline at end of file
+EMBEDDING_MODEL_NAME = "text-embedding-3-small"
+
+_openai_ef = None
+_openai_ef_lock = threading.Lock()
+
+def get_openai_ef():
+    """Returns the shared OpenAI embedding function, created on first use."""
+    global _openai_ef
+    with _openai_ef_lock:
+        if _openai_ef is None:
+            import chromadb.utils.embedding_functions as embedding_functions
+            _openai_ef = embedding_functions.OpenAIEmbeddingFunction(
+                api_key=os.environ.get("OPENAI_API_KEY"),
+                model_name=EMBEDDING_MODEL_NAME
+            )
+        return _openai_ef
+
+def __getattr__(name):
+    # util.openai_ef used to be built at import time
+    if name == "openai_ef":
+        return get_openai_ef()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
\ No newline at end of file
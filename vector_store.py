@@ -0,0 +1,365 @@
+import os
+import json
+import sqlite3
+import threading
+import argparse
+import chromadb
+from util import *
+from embedding_cache import get_cached_embedding_function
+
+try:
+    import numpy as np
+except ImportError:  # LocalVectorStore needs NumPy, the Chroma backend doesn't
+    np = None
+
+# Rows scored per block, bounds the float32 copy of the matrix made while scoring
+SCORE_BLOCK_ROWS = 8192
+# Below this fraction of matching rows, only the matching rows are read from the matrix
+PREFILTER_FRACTION = 0.5
+LOCAL_DTYPES = ("float16", "int8")
+
+def get_where_clause(filters):
+    """Returns the Chroma where clause of a filters dict, or None without filters.
+
+    filters optionally holds a list of "podcasts", a "language", and "after"
+    and "before" Unix timestamps ("before" being exclusive).
+    """
+    filters = filters or {}
+    clauses = []
+    if filters.get("podcasts"):
+        clauses.append({"podcast": {"$in": filters["podcasts"]}})
+    if filters.get("language"):
+        clauses.append({"language": filters["language"]})
+    if filters.get("after") is not None:
+        clauses.append({"pub_ts": {"$gte": filters["after"]}})
+    if filters.get("before") is not None:
+        clauses.append({"pub_ts": {"$lt": filters["before"]}})
+    if not clauses:
+        return None
+    return clauses[0] if len(clauses) == 1 else {"$and": clauses}
+
+class ChromaStore:
+    """Vector store backed by the persistent Chroma collection.
+
+    Vector stores share this interface: upsert(), delete(), get() and query()
+    take and return flat lists, scan() yields every chunk in batches, count()
+    returns the number of chunks.
+    """
+    def __init__(self, embedding_function=None, collection_name=None, directory=None):
+        collection_name = collection_name or CONFIG["vector_collection"]
+        client = chromadb.PersistentClient(path=directory or CONFIG["index_directory"])
+        self.collection = client.get_or_create_collection(name=collection_name, embedding_function=embedding_function)
+        print(f"Collection '{collection_name}' loaded/created.")
+
+    def count(self):
+        return self.collection.count()
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        self.collection.upsert(ids=ids, embeddings=embeddings, documents=documents, metadatas=metadatas)
+
+    def delete(self, ids):
+        self.collection.delete(ids=ids)
+
+    def get(self, ids):
+        """Returns {"ids", "documents", "metadatas"} of the chunks found among ids."""
+        results = self.collection.get(ids=ids, include=["documents", "metadatas"])
+        return {"ids": results["ids"], "documents": results["documents"], "metadatas": results["metadatas"]}
+
+    def query(self, embedding, n_results, filters=None):
+        """Returns {"ids", "documents", "metadatas", "distances"} of the nearest chunks, nearest first."""
+        results = self.collection.query(query_embeddings=[embedding], n_results=n_results, where=get_where_clause(filters))
+        return {key: results[key][0] for key in ("ids", "documents", "metadatas", "distances")}
+
+    def scan(self, batch_size=1000, include_embeddings=False):
+        include = ["documents", "metadatas"] + (["embeddings"] if include_embeddings else [])
+        offset = 0
+        while True:
+            results = self.collection.get(include=include, limit=batch_size, offset=offset)
+            if not results["ids"]:
+                return
+            yield results
+            offset += len(results["ids"])
+
+LOCAL_SCHEMA = """
+CREATE TABLE IF NOT EXISTS chunks (
+    row INTEGER PRIMARY KEY,
+    id TEXT UNIQUE NOT NULL,
+    document TEXT,
+    metadata TEXT,
+    podcast TEXT,
+    language TEXT,
+    pub_ts REAL
+);
+CREATE TABLE IF NOT EXISTS free_rows (
+    row INTEGER PRIMARY KEY
+);
+CREATE TABLE IF NOT EXISTS meta (
+    name TEXT PRIMARY KEY,
+    value TEXT NOT NULL
+);
+"""
+
+class LocalVectorStore:
+    """Exact vector store keeping the vectors in a memory-mapped float16 or int8 matrix.
+
+    Vectors are normalized and stored as rows of `vectors.<dtype>` in the store
+    directory. int8 rows are scaled to the range of the row, and the scales are
+    kept in `scales.f32`. Documents, metadata and the id of every row are kept
+    in SQLite next to it, and rows of deleted chunks are reused. A query scores
+    every matching row with a NumPy dot product and returns the exact top k by
+    cosine similarity. Podcast, language and date filters select the rows
+    before scoring. Every write bumps a version in SQLite, which tells readers
+    in other processes to reload the row metadata.
+    """
+    def __init__(self, directory=None, dtype=None):
+        if np is None:
+            raise ImportError("LocalVectorStore requires numpy")
+        self.directory = directory or CONFIG["local_vector_directory"]
+        os.makedirs(self.directory, exist_ok=True)
+        self.lock = threading.Lock()
+        self.conn = sqlite3.connect(os.path.join(self.directory, "store.db"), timeout=30, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.conn.execute("PRAGMA journal_mode=WAL")
+            self.conn.executescript(LOCAL_SCHEMA)
+            meta = dict(self.conn.execute("SELECT name, value FROM meta").fetchall())
+        self.dtype = meta.get("dtype") or dtype or CONFIG["local_vector_dtype"]
+        if dtype and dtype != self.dtype:
+            raise ValueError(f"Store {self.directory} holds {self.dtype} vectors, not {dtype}")
+        if self.dtype not in LOCAL_DTYPES:
+            raise ValueError(f"Unsupported vector dtype: {self.dtype}")
+        self.dim = int(meta["dim"]) if "dim" in meta else None
+        self.vector_filename = os.path.join(self.directory, f"vectors.{self.dtype}")
+        self.scale_filename = os.path.join(self.directory, "scales.f32")
+        self.version = None
+
+    def close(self):
+        self.conn.close()
+
+    def count(self):
+        with self.lock:
+            return self.conn.execute("SELECT COUNT(*) FROM chunks").fetchone()[0]
+
+    def _meta(self, name, default=None):
+        row = self.conn.execute("SELECT value FROM meta WHERE name = ?", (name,)).fetchone()
+        return row[0] if row else default
+
+    def _set_meta(self, name, value):
+        self.conn.execute("INSERT OR REPLACE INTO meta (name, value) VALUES (?, ?)", (name, str(value)))
+
+    def _encode(self, embeddings):
+        """Returns the stored rows of embeddings, and their int8 scales."""
+        vectors = np.asarray(embeddings, dtype=np.float32)
+        norms = np.linalg.norm(vectors, axis=1, keepdims=True)
+        vectors = vectors / np.where(norms == 0, 1, norms)
+        if self.dtype == "float16":
+            return vectors.astype(np.float16), None
+        scales = np.abs(vectors).max(axis=1) / 127
+        scales[scales == 0] = 1
+        return np.round(vectors / scales[:, None]).astype(np.int8), scales.astype(np.float32)
+
+    def upsert(self, ids, embeddings, documents, metadatas):
+        if not ids:
+            return
+        vectors, scales = self._encode(embeddings)
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                if self.dim is None:
+                    self.dim = vectors.shape[1]
+                    self._set_meta("dim", self.dim)
+                    self._set_meta("dtype", self.dtype)
+                elif vectors.shape[1] != self.dim:
+                    raise ValueError(f"Embedding dimension {vectors.shape[1]} does not match the store dimension {self.dim}")
+                row_count = int(self._meta("rows", 0))
+                rows = []
+                for chunk_id in ids:
+                    existing = self.conn.execute("SELECT row FROM chunks WHERE id = ?", (chunk_id,)).fetchone()
+                    if existing:
+                        rows.append(existing[0])
+                        continue
+                    free = self.conn.execute("SELECT row FROM free_rows LIMIT 1").fetchone()
+                    if free:
+                        self.conn.execute("DELETE FROM free_rows WHERE row = ?", free)
+                        rows.append(free[0])
+                    else:
+                        rows.append(row_count)
+                        row_count += 1
+                self._write_rows(self.vector_filename, rows, vectors)
+                if scales is not None:
+                    self._write_rows(self.scale_filename, rows, scales[:, None])
+                self.conn.executemany("INSERT OR REPLACE INTO chunks (row, id, document, metadata, podcast, language, pub_ts) VALUES (?, ?, ?, ?, ?, ?, ?)",
+                                      [(row, chunk_id, document, json.dumps(metadata or {}, ensure_ascii=False),
+                                        (metadata or {}).get("podcast"), (metadata or {}).get("language"), (metadata or {}).get("pub_ts"))
+                                       for row, chunk_id, document, metadata in zip(rows, ids, documents, metadatas)])
+                self._set_meta("rows", row_count)
+                self._set_meta("version", int(self._meta("version", 0)) + 1)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def _write_rows(self, filename, rows, data):
+        # Must be called inside the write transaction
+        row_bytes = data.shape[1] * data.itemsize
+        with open(filename, 'r+b' if os.path.exists(filename) else 'w+b') as outfile:
+            for row, values in zip(rows, data):
+                outfile.seek(row * row_bytes)
+                outfile.write(values.tobytes())
+
+    def delete(self, ids):
+        with self.lock:
+            self.conn.execute("BEGIN IMMEDIATE")
+            try:
+                for chunk_id in ids:
+                    row = self.conn.execute("SELECT row FROM chunks WHERE id = ?", (chunk_id,)).fetchone()
+                    if row:
+                        self.conn.execute("DELETE FROM chunks WHERE row = ?", row)
+                        self.conn.execute("INSERT OR IGNORE INTO free_rows (row) VALUES (?)", row)
+                self._set_meta("version", int(self._meta("version", 0)) + 1)
+                self.conn.execute("COMMIT")
+            except Exception:
+                self.conn.execute("ROLLBACK")
+                raise
+
+    def get(self, ids):
+        found = {}
+        with self.lock:
+            for i in range(0, len(ids), 500):
+                batch = ids[i : i + 500]
+                for chunk_id, document, metadata in self.conn.execute(
+                        f"SELECT id, document, metadata FROM chunks WHERE id IN ({','.join('?' * len(batch))})", batch):
+                    found[chunk_id] = (document, json.loads(metadata))
+        ids = [chunk_id for chunk_id in ids if chunk_id in found]
+        return {"ids": ids, "documents": [found[chunk_id][0] for chunk_id in ids], "metadatas": [found[chunk_id][1] for chunk_id in ids]}
+
+    def _load(self):
+        # Must be called with self.lock held. Reloads the row metadata and the memory maps after a write.
+        version = self._meta("version", "0")
+        if version == self.version:
+            return
+        self.dim = self.dim or int(self._meta("dim", 0)) or None
+        row_count = int(self._meta("rows", 0))
+        self.ids = np.full(row_count, None, dtype=object)
+        self.valid = np.zeros(row_count, dtype=bool)
+        self.pub_ts = np.full(row_count, np.nan)
+        self.podcasts = np.full(row_count, None, dtype=object)
+        self.languages = np.full(row_count, None, dtype=object)
+        for row, chunk_id, podcast, language, pub_ts in self.conn.execute("SELECT row, id, podcast, language, pub_ts FROM chunks"):
+            self.ids[row] = chunk_id
+            self.valid[row] = True
+            self.podcasts[row] = podcast
+            self.languages[row] = language
+            if pub_ts is not None:
+                self.pub_ts[row] = pub_ts
+        self.vectors = None
+        self.scales = None
+        if row_count and self.dim:
+            self.vectors = np.memmap(self.vector_filename, dtype=np.dtype(self.dtype), mode='r', shape=(row_count, self.dim))
+            if self.dtype == "int8":
+                self.scales = np.memmap(self.scale_filename, dtype=np.float32, mode='r', shape=(row_count,))
+        self.version = version
+
+    def _filter_mask(self, filters):
+        mask = self.valid.copy()
+        filters = filters or {}
+        if filters.get("podcasts"):
+            mask &= np.isin(self.podcasts, list(filters["podcasts"]))
+        if filters.get("language"):
+            mask &= self.languages == filters["language"]
+        # Comparisons with the NaN of chunks without a date are False, so dated filters exclude them
+        with np.errstate(invalid='ignore'):
+            if filters.get("after") is not None:
+                mask &= self.pub_ts >= filters["after"]
+            if filters.get("before") is not None:
+                mask &= self.pub_ts < filters["before"]
+        return mask
+
+    def _score(self, rows, query):
+        scores = np.empty(len(rows) if rows is not None else len(self.vectors), dtype=np.float32)
+        for start in range(0, len(scores), SCORE_BLOCK_ROWS):
+            end = min(start + SCORE_BLOCK_ROWS, len(scores))
+            selection = slice(start, end) if rows is None else rows[start:end]
+            block = np.asarray(self.vectors[selection], dtype=np.float32)
+            scores[start:end] = block @ query
+            if self.scales is not None:
+                scores[start:end] *= self.scales[selection]
+        return scores
+
+    def query(self, embedding, n_results, filters=None):
+        query = np.asarray(embedding, dtype=np.float32)
+        # A new array, the caller's embedding must not be normalized in place
+        query = query / (np.linalg.norm(query) or 1)
+        with self.lock:
+            self._load()
+            if self.vectors is None:
+                return {"ids": [], "documents": [], "metadatas": [], "distances": []}
+            mask = self._filter_mask(filters)
+            matching = np.flatnonzero(mask)
+            if len(matching) < PREFILTER_FRACTION * len(mask):
+                # Only the matching rows are read and scored
+                rows = matching
+                scores = self._score(rows, query)
+            else:
+                rows = np.arange(len(mask))
+                scores = self._score(None, query)
+                scores[~mask] = -np.inf
+            n_results = min(n_results, len(matching))
+            if n_results == 0:
+                return {"ids": [], "documents": [], "metadatas": [], "distances": []}
+            top = np.argpartition(-scores, n_results - 1)[:n_results]
+            top = top[np.argsort(-scores[top])]
+            ids = [self.ids[rows[i]] for i in top]
+            distances = [float(1 - scores[i]) for i in top]
+        results = self.get(ids)
+        results["distances"] = distances
+        return results
+
+    def scan(self, batch_size=1000, include_embeddings=False):
+        last_row = -1
+        while True:
+            with self.lock:
+                rows = self.conn.execute("SELECT row, id, document, metadata FROM chunks WHERE row > ? ORDER BY row LIMIT ?",
+                                         (last_row, batch_size)).fetchall()
+                if include_embeddings and rows:
+                    self._load()
+                    embeddings = [np.asarray(self.vectors[row], dtype=np.float32) * (self.scales[row] if self.scales is not None else 1)
+                                  for row, _, _, _ in rows]
+            if not rows:
+                return
+            results = {"ids": [row[1] for row in rows], "documents": [row[2] for row in rows], "metadatas": [json.loads(row[3]) for row in rows]}
+            if include_embeddings:
+                results["embeddings"] = embeddings
+            yield results
+            last_row = rows[-1][0]
+
+def get_vector_store(backend=None, embedding_function=None):
+    """Opens the vector store of CONFIG["vector_backend"]: "chroma" or "local"."""
+    backend = backend or CONFIG["vector_backend"]
+    if backend == "chroma":
+        return ChromaStore(embedding_function)
+    if backend == "local":
+        return LocalVectorStore()
+    raise ValueError(f"Unknown vector backend: {backend}")
+
+def export_chroma(target, source=None, batch_size=1000):
+    """Copies every chunk of the Chroma collection, with its embedding, into another vector store."""
+    source = source or ChromaStore(get_cached_embedding_function())
+    exported = 0
+    for results in source.scan(batch_size, include_embeddings=True):
+        target.upsert(results["ids"], results["embeddings"], results["documents"], results["metadatas"])
+        exported += len(results["ids"])
+        print(f"Exported {exported} chunks")
+    return exported
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Vector store maintenance")
+    parser.add_argument('--export-chroma',
+                        action='store_true',
+                        help='Copy the Chroma collection into the local vector store')
+    parser.add_argument('--dtype',
+                        choices=LOCAL_DTYPES,
+                        default=None,
+                        help='Vector type of a new local store')
+    args = parser.parse_args()
+    if args.export_chroma:
+        export_chroma(LocalVectorStore(dtype=args.dtype))